@@ -9,7 +9,10 @@ Supports two data sources:
   1. JSON paste mode: data already stored in pandas via DataManager
   2. BigQuery mode: agent fetches columns from BQ into pandas
 """
+import asyncio
+import logging
 import os
+import uuid
 from dotenv import load_dotenv
 
 # Load .env BEFORE importing ADK so env vars are available
@@ -20,6 +23,9 @@ os.environ["GOOGLE_GENAI_USE_VERTEXAI"] = "TRUE"
 
 from google.adk.agents import Agent
 from data_manager import data_manager
+from history_compactor import compact_session_contents
+
+logger = logging.getLogger(__name__)
 
 # ──────────────────────────────────────────────
 # Tool functions (auto-wrapped by ADK as FunctionTools)
@@ -40,7 +46,7 @@ def get_data_schema(data_id: str) -> dict:
     return data_manager.get_schema(data_id)
 
 
-def query_data(data_id: str, operation: str) -> dict:
+async def query_data(data_id: str, operation: str) -> dict:
     """Query and transform a dataset using pandas operations.
 
     Use this tool to filter, aggregate, sort, or select specific columns
@@ -60,10 +66,16 @@ def query_data(data_id: str, operation: str) -> dict:
                    The DataFrame is available as 'df' in the expression.
 
     Returns:
-        dict: A dictionary with 'data' (list of records) and 'row_count',
+        dict: A dictionary with 'data' (list of records), 'row_count' and
+              'result_id' (reference this in the final chart JSON),
               or 'error' if the operation failed.
     """
-    return data_manager.query_data(data_id, operation)
+    # Column loading, pushdown and evaluation block — keep them off the event loop
+    result = await asyncio.to_thread(data_manager.query_data, data_id, operation)
+    if isinstance(result.get("data"), list):
+        # The pipeline injects these records into the chart server-side
+        result = {**result, "result_id": f"r_{uuid.uuid4().hex[:6]}"}
+    return result
 
 
 
@@ -86,13 +98,15 @@ A response without a preceding `query_data` tool call is INVALID and FORBIDDEN.
 Read the user's question and the conversation history. Identify what data operation is needed.
 
 ### Step 2: Inspect schema (if needed)
-If you are unsure about column names or data types, call `get_data_schema(data_id)`.
+If the user message contains a DATA SCHEMA section, use it and go straight to Step 3.
+Otherwise, if you are unsure about column names or data types, call `get_data_schema(data_id)`.
 
 ### Step 3: CALL `query_data` — THIS IS MANDATORY
 You MUST call the `query_data(data_id, operation)` tool with a pandas expression.
 - Use the `data_id` provided in the user message.
 - The DataFrame is available as `df` in the expression.
 - Limit results to at most 30 rows.
+- Only the columns your expression names are loaded. When returning raw rows, select the columns you need explicitly (e.g. `df[df['amount'] > 100][['date', 'amount']]`).
 - For date filtering, use `pd.Timestamp("YYYY-MM-DD")`. Do NOT cast columns manually as they are **already converted** to pandas datetime objects.
 - Example operations:
   - `df.groupby('category')['amount'].sum().reset_index().sort_values('amount', ascending=False).head(10)`
@@ -106,9 +120,9 @@ ONLY after you receive the `query_data` result, produce your final answer as pur
     "rejected": false,
     "chart_type": "<line|bar|pie|scatter|area>",
     "chart_config": {
+        "result_id": "<the result_id returned by the query_data call to chart>",
         "x_field": "<column_name_for_x_axis>",
         "y_field": "<column_name_for_y_axis>",
-        "data": <PASTE THE EXACT RECORDS FROM query_data HERE>,
         "title": "<descriptive title>",
         "x_label": "<x axis label>",
         "y_label": "<y axis label>"
@@ -117,7 +131,7 @@ ONLY after you receive the `query_data` result, produce your final answer as pur
 }
 
 ## RULES
-1. The `data` field MUST contain the EXACT records returned by `query_data`. NEVER invent data.
+1. Do NOT copy the records into your answer. Reference them with `result_id`; the server attaches the EXACT records returned by `query_data`. NEVER invent data.
 2. If the user question is unrelated to data visualization, return: {"rejected": true, "reject_reason": "..."}
 3. Chart types: line, bar, pie, scatter, area.
 4. Chart type selection: use "line" for time-series, "bar" for category comparisons, "pie" for proportions (≤7 slices), "scatter" for correlations, "area" for cumulative volume.
@@ -127,6 +141,7 @@ ONLY after you receive the `query_data` result, produce your final answer as pur
 - NEVER skip the `query_data` tool call.
 - NEVER output the final JSON before calling `query_data`.
 - NEVER fabricate or estimate data values.
+- NEVER paste query_data records into the final JSON — use `result_id`.
 - NEVER wrap your JSON in markdown code fences (no triple backticks).
 """
 
@@ -136,11 +151,20 @@ ONLY after you receive the `query_data` result, produce your final answer as pur
 
 from google.genai import types
 
+def compact_session_history(callback_context, llm_request):
+    """before_model_callback: bound what a reused session resends from its earlier turns."""
+    llm_request.contents, saved = compact_session_contents(llm_request.contents)
+    if saved:
+        logger.info(f"[SESSION] Compacted earlier turns, ~{saved} tokens saved")
+    return None
+
+
 root_agent = Agent(
     name="visualization_agent",
     model="gemini-2.0-flash",
     description="Agent that creates data visualizations from user datasets.",
     instruction=SYSTEM_INSTRUCTION,
     tools=[get_data_schema, query_data],
+    before_model_callback=compact_session_history,
 )
 
@@ -0,0 +1,146 @@
+"""
+Agent Sessions — ADK session lifecycle for the visualization agent.
+
+Requests without a conversation get a throwaway session that is deleted as
+soon as the request finishes. Requests with a `conversation_id` reuse one
+ADK session per (user, conversation), so follow-ups rely on the session's
+native event history instead of a re-serialized transcript.
+
+Conversation sessions are deleted after ADK_SESSION_IDLE_TTL_SECONDS of
+inactivity, and least recently used sessions are deleted whenever the
+retained sessions exceed ADK_SESSION_MAX_BYTES in total. Turns within one
+session are serialized so concurrent follow-ups do not interleave events.
+The agent's before_model_callback omits the records of earlier turns'
+`query_data` responses and holds earlier turns to HISTORY_MAX_TOKENS
+(see history_compactor), so a reused session does not resend them.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator
+
+logger = logging.getLogger(__name__)
+
+ADK_SESSION_IDLE_TTL_SECONDS = int(os.getenv("ADK_SESSION_IDLE_TTL_SECONDS", str(30 * 60)))
+ADK_SESSION_MAX_BYTES = int(os.getenv("ADK_SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+@dataclass
+class _SessionEntry:
+    user_id: str
+    session_id: str
+    last_used: float = field(default_factory=time.monotonic)
+    bytes: int = 0
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+class AgentSessionRegistry:
+    """Creates, reuses and garbage-collects ADK sessions in a session service."""
+
+    def __init__(
+        self,
+        session_service,
+        app_name: str,
+        idle_ttl_seconds: int = ADK_SESSION_IDLE_TTL_SECONDS,
+        max_bytes: int = ADK_SESSION_MAX_BYTES,
+    ):
+        self.session_service = session_service
+        self.app_name = app_name
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_bytes = max_bytes
+        self._sessions: OrderedDict[str, _SessionEntry] = OrderedDict()  # least recently used first
+        self.reuses = 0
+        self.deleted = 0
+
+    @asynccontextmanager
+    async def session(self, user_id: str, conversation_id: str | None = None) -> AsyncIterator[tuple[str, bool]]:
+        """
+        `async with registry.session(user_id, conversation_id) as (session_id, fresh):`
+
+        `fresh` is True when the session has no events yet, i.e. the caller
+        must include any context (history, schema) in its message.
+        """
+        if not conversation_id:
+            session_id = f"session_{uuid.uuid4().hex[:8]}"
+            await self.session_service.create_session(app_name=self.app_name, user_id=user_id, session_id=session_id)
+            try:
+                yield session_id, True
+            finally:
+                await self._delete(user_id, session_id)
+            return
+
+        await self.sweep()
+        session_id = "conv_" + hashlib.sha1(f"{user_id}:{conversation_id}".encode("utf-8")).hexdigest()[:16]
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            # Register before any await so concurrent first turns share one entry
+            # (and its lock); the session itself is created under the lock below
+            entry = self._sessions[session_id] = _SessionEntry(user_id, session_id)
+
+        async with entry.lock:
+            session = await self.session_service.get_session(
+                app_name=self.app_name, user_id=user_id, session_id=session_id
+            )
+            if session is None:
+                # First turn, or deleted underneath us (e.g. by the byte cap)
+                await self.session_service.create_session(app_name=self.app_name, user_id=user_id, session_id=session_id)
+            fresh = session is None or not session.events
+            if not fresh:
+                self.reuses += 1
+            self._sessions[session_id] = entry
+            self._sessions.move_to_end(session_id)
+            try:
+                yield session_id, fresh
+            finally:
+                entry.last_used = time.monotonic()
+                entry.bytes = await self._measure(user_id, session_id)
+                await self._enforce_cap(keep=session_id)
+
+    async def _measure(self, user_id: str, session_id: str) -> int:
+        session = await self.session_service.get_session(app_name=self.app_name, user_id=user_id, session_id=session_id)
+        if session is None:
+            return 0
+        return sum(len(event.model_dump_json(exclude_none=True)) for event in session.events)
+
+    async def _delete(self, user_id: str, session_id: str):
+        self._sessions.pop(session_id, None)
+        try:
+            await self.session_service.delete_session(app_name=self.app_name, user_id=user_id, session_id=session_id)
+            self.deleted += 1
+        except Exception as e:
+            logger.warning(f"[SESSION] Failed to delete {session_id}: {e}")
+
+    async def sweep(self):
+        """Delete conversation sessions idle for longer than the TTL."""
+        cutoff = time.monotonic() - self.idle_ttl_seconds
+        for entry in [e for e in self._sessions.values() if e.last_used < cutoff and not e.lock.locked()]:
+            logger.info(f"[SESSION] Deleting idle session {entry.session_id}")
+            await self._delete(entry.user_id, entry.session_id)
+
+    async def _enforce_cap(self, keep: str):
+        """Delete least recently used idle sessions until the retained bytes fit the cap."""
+        total = sum(e.bytes for e in self._sessions.values())
+        for entry in list(self._sessions.values()):
+            if total <= self.max_bytes:
+                break
+            if entry.session_id == keep or entry.lock.locked():
+                continue
+            total -= entry.bytes
+            logger.info(f"[SESSION] Over {self.max_bytes:,} bytes, deleting {entry.session_id}")
+            await self._delete(entry.user_id, entry.session_id)
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "bytes": sum(e.bytes for e in self._sessions.values()),
+            "max_bytes": self.max_bytes,
+            "idle_ttl_seconds": self.idle_ttl_seconds,
+            "reuses": self.reuses,
+            "deleted": self.deleted,
+        }
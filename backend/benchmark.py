@@ -0,0 +1,439 @@
+"""
+Micro-benchmarks for backend hot paths.
+
+Each benchmark runs on synthetic data shaped like our datamarts, so no
+BigQuery or Vertex AI access is needed unless stated otherwise:
+
+    python benchmark.py serialize     # DataManager._to_serializable_dict
+    python benchmark.py compact       # string compaction: memory, groupby time, identical results
+    python benchmark.py engines       # pandas vs DuckDB query_data latency
+    python benchmark.py loadtest --url http://localhost:8000 --token <session JWT>
+                                      # concurrent /api/visualize throughput + /api/quota latency
+                                      # against a running server (uses Vertex AI and quota)
+    python benchmark.py modes         # agent vs fast pipelines: turns, tokens, wall time (uses Vertex AI)
+    python benchmark.py schema        # agent with vs without schema pre-injection (uses Vertex AI)
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python benchmark.py quota
+                                      # single-doc transaction vs sharded token counters
+                                      # (requires the Firestore emulator: gcloud emulators firestore start)
+"""
+
+import argparse
+import asyncio
+import math
+import sys
+import time
+from pathlib import Path
+
+# Ensure backend is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+import numpy as np
+import pandas as pd
+
+from data_manager import DataManager
+import duckdb_engine
+from check_pushdown import records_match
+
+
+def make_frame(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Synthetic datamart: dates, low-cardinality strings, numerics with gaps."""
+    rng = np.random.default_rng(seed)
+    amount = rng.gamma(2.0, 150.0, rows)
+    amount[rng.random(rows) < 0.02] = np.nan
+    return pd.DataFrame({
+        "posting_date": pd.Timestamp("2025-01-01") + pd.to_timedelta(rng.integers(0, 450, rows), unit="D"),
+        "region": rng.choice(["North", "South", "East", "West", "Central"], rows),
+        "category": rng.choice([f"CAT-{i:02d}" for i in range(40)], rows),
+        "status": rng.choice(["open", "closed", "pending", None], rows),
+        "sku": [f"SKU-{n:06d}" for n in rng.integers(0, rows // 2 + 1, rows)],
+        "qty": rng.integers(1, 50, rows),
+        "amount": amount,
+        "margin": rng.normal(0.2, 0.05, rows),
+    })
+
+
+def timed(fn, repeat: int = 5) -> float:
+    """Best-of-`repeat` wall time in milliseconds."""
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+# ── serialize ────────────────────────────────────────────────────────
+
+
+def legacy_to_serializable_dict(df: pd.DataFrame) -> list[dict]:
+    """The per-cell serializer DataManager used before it was vectorized."""
+    if df.empty:
+        return []
+    temp_df = df.copy()
+    for col in temp_df.columns:
+        if pd.api.types.is_datetime64_any_dtype(temp_df[col]):
+            temp_df[col] = temp_df[col].dt.strftime('%Y-%m-%d %H:%M:%S').replace('NaT', None)
+        elif pd.api.types.is_object_dtype(temp_df[col]):
+            converted = pd.to_datetime(temp_df[col], errors='coerce')
+            if not converted.isna().all():
+                temp_df[col] = converted.dt.strftime('%Y-%m-%d %H:%M:%S').where(converted.notna(), temp_df[col])
+    records = temp_df.to_dict(orient="records")
+    for row in records:
+        for key, val in row.items():
+            if isinstance(val, float) and (math.isnan(val) or math.isinf(val)):
+                row[key] = None
+            elif pd.isna(val):
+                row[key] = None
+    return records
+
+
+def bench_serialize(sizes: list[int]):
+    dm = DataManager()
+    print(f"{'rows':>8} {'legacy ms':>12} {'vectorized ms':>15} {'+json bytes ms':>16} {'speedup':>9}")
+    for rows in sizes:
+        df = make_frame(rows)
+        legacy = timed(lambda: legacy_to_serializable_dict(df), repeat=3)
+        vectorized = timed(lambda: dm._to_serializable_dict(df))
+        with_json = timed(lambda: dm.to_json_bytes(dm._to_serializable_dict(df)))
+        print(f"{rows:>8} {legacy:>12.1f} {vectorized:>15.1f} {with_json:>16.1f} {legacy / vectorized:>8.1f}x")
+
+
+# ── compact ──────────────────────────────────────────────────────────
+
+# Query shapes the agent generates most often
+AGENT_QUERIES = [
+    "df.groupby('region')['amount'].sum().reset_index()",
+    "df.groupby('category')['amount'].sum().reset_index().sort_values('amount', ascending=False).head(10)",
+    "df.groupby(['region', 'status'])['qty'].sum().reset_index()",
+    "df[df['amount'] > 100].groupby('category')['qty'].mean().reset_index()",
+    "df.groupby(pd.Grouper(key='posting_date', freq='W'))['amount'].sum().reset_index()",
+    "df['status'].value_counts().reset_index()",
+    "df[df['region'] == 'West'][['posting_date', 'sku', 'amount']].sort_values('amount', ascending=False).head(20)",
+    "df.groupby('sku')['amount'].sum().nlargest(10)",
+]
+
+
+# Shapes where a compact dtype could change the answer: int arithmetic that
+# overflows narrow ints, and value_counts/groupby over filtered or tied strings
+COMPACT_CHECKS = [
+    "df.assign(rev=df['qty'] * 100000).groupby('region')['rev'].sum()",
+    "(df['qty'] * 1_000_000_000).sum()",
+    "df['qty'] * df['qty'] * 100000",
+    "df[df['region'] == 'North'].value_counts('region')",
+    "df[df['region'] == 'North']['region'].value_counts()",
+    "df['status'].value_counts(dropna=False)",
+    "df['sku'].value_counts().head(20)",
+    "df['sku'].describe()",
+    "df['status'].unique()",
+    "df[df['region'] == 'North'].groupby('region')['qty'].sum()",
+    "df.groupby('status', dropna=False)['qty'].sum()",
+    "df.pivot_table(index='region', columns='status', values='qty', aggfunc='sum')",
+    "df['region'] + '-' + df['category']",
+]
+
+
+def resident_bytes(df: pd.DataFrame) -> int:
+    """Frame memory counting each shared str object once (memory_usage(deep=True) counts it per cell)."""
+    total = int(df.memory_usage(deep=False, index=True).sum())
+    for col in df.columns:
+        if df[col].dtype == object:
+            distinct = {id(v): v for v in df[col].to_numpy()}
+            total += sum(sys.getsizeof(v) for v in distinct.values())
+    return total
+
+
+def bench_compact(rows: int):
+    plain = DataManager()
+    compact = DataManager()
+    compact.compact_dtypes = True
+    # Time the queries themselves, not result cache hits
+    plain.result_cache.max_entries = 0
+    compact.result_cache.max_entries = 0
+
+    plain.store_frame("bench", make_frame(rows))
+    compact.store_frame("bench", make_frame(rows))
+    before = resident_bytes(plain._get("bench"))
+    after = resident_bytes(compact._get("bench"))
+    print(f"{rows:,} rows: {before / 1e6:.1f} MB → {after / 1e6:.1f} MB resident ({after / before:.0%})\n")
+
+    print(f"{'plain ms':>10} {'compact ms':>11} {'identical':>10}  query")
+    for op in AGENT_QUERIES:
+        expected = plain.query_data("bench", op)
+        actual = compact.query_data("bench", op)
+        t_plain = timed(lambda: plain.query_data("bench", op))
+        t_compact = timed(lambda: compact.query_data("bench", op))
+        print(f"{t_plain:>10.1f} {t_compact:>11.1f} {str(expected == actual):>10}  {op}")
+
+    mismatches = [op for op in COMPACT_CHECKS if plain.query_data("bench", op) != compact.query_data("bench", op)]
+    print(f"\n{len(COMPACT_CHECKS) - len(mismatches)}/{len(COMPACT_CHECKS)} compaction checks identical")
+    for op in mismatches:
+        print(f"  MISMATCH  {op}")
+    if mismatches:
+        sys.exit(1)
+
+
+def bench_engines(rows: int):
+    frame = make_frame(rows)
+    manager = DataManager()
+    manager.result_cache.max_entries = 0  # time the engines, not result cache hits
+    manager.store_frame("bench", frame)
+    stored = manager._get("bench")
+
+    print(f"{rows:,} rows\n")
+    print(f"{'pandas ms':>10} {'duckdb ms':>10} {'engine':>9} {'identical':>10}  query")
+    for op in AGENT_QUERIES:
+        handled = duckdb_engine.run(stored, op) is not None
+        expected = manager.query_data("bench", op)
+        t_pandas = timed(lambda: manager.query_data("bench", op))
+
+        manager.set_frame_engine("bench", duckdb_engine.run)
+        actual = manager.query_data("bench", op)
+        t_duckdb = timed(lambda: manager.query_data("bench", op))
+        manager._engines.pop("bench", None)
+
+        engine = "duckdb" if handled else "fallback"
+        identical = records_match(expected["data"], actual["data"])
+        print(f"{t_pandas:>10.1f} {t_duckdb:>10.1f} {engine:>9} {str(identical):>10}  {op}")
+
+
+# ── loadtest ─────────────────────────────────────────────────────────
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def _loadtest_level(client, url: str, headers: dict, payload: dict, concurrency: int, requests: int) -> dict:
+    """Run `requests` visualizations with `concurrency` in flight while probing /api/quota."""
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses: list[int] = []
+    probe_ms: list[float] = []
+    done = asyncio.Event()
+
+    async def visualize():
+        async with semaphore:
+            response = await client.post(f"{url}/api/visualize", json=payload, headers=headers)
+            statuses.append(response.status_code)
+
+    async def probe():
+        # An unrelated, cheap endpoint: its latency shows whether the event loop is blocked
+        while not done.is_set():
+            start = time.perf_counter()
+            await client.get(f"{url}/api/quota", headers=headers)
+            probe_ms.append((time.perf_counter() - start) * 1000)
+            await asyncio.sleep(0.05)
+
+    prober = asyncio.create_task(probe())
+    start = time.perf_counter()
+    await asyncio.gather(*(visualize() for _ in range(requests)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await prober
+
+    return {
+        "throughput": requests / elapsed,
+        "ok": sum(1 for code in statuses if code == 200),
+        "quota_p50": _percentile(probe_ms, 50),
+        "quota_p99": _percentile(probe_ms, 99),
+    }
+
+
+def bench_loadtest(url: str, token: str, levels: list[int], rows: int, prompt: str):
+    import httpx
+
+    payload = {"prompt": prompt, "data": DataManager()._to_serializable_dict(make_frame(rows))}
+    headers = {"Authorization": f"Bearer {token}"}
+
+    async def run():
+        async with httpx.AsyncClient(timeout=300) as client:
+            print(f"{'concurrency':>11} {'req/s':>7} {'ok':>5} {'quota p50 ms':>13} {'quota p99 ms':>13}")
+            for concurrency in levels:
+                # Two rounds per level so the throughput is not dominated by one slow call
+                result = await _loadtest_level(client, url, headers, payload, concurrency, concurrency * 2)
+                print(f"{concurrency:>11} {result['throughput']:>7.2f} {result['ok']:>5} "
+                      f"{result['quota_p50']:>13.1f} {result['quota_p99']:>13.1f}")
+
+    asyncio.run(run())
+
+
+# ── modes ────────────────────────────────────────────────────────────
+
+PIPELINE_PROMPTS = [
+    "Total amount by region",
+    "Top 10 categories by amount",
+    "Weekly amount trend",
+    "Share of orders by status",
+    "Average quantity per category for orders above 100",
+]
+
+
+def _compare_pipelines(rows: int, variants: list[tuple[str, dict]]):
+    """Run PIPELINE_PROMPTS through each (label, run_agent_pipeline kwargs) variant."""
+    from main import run_agent_pipeline, parse_agent_response
+    from data_manager import data_manager
+
+    async def run():
+        print(f"{'variant':>12} {'turns':>6} {'tokens':>8} {'wall ms':>9} {'chart':>6}  prompt")
+        totals = {label: [0, 0, 0.0] for label, _ in variants}
+        for prompt in PIPELINE_PROMPTS:
+            for label, kwargs in variants:
+                data_id = f"bench_{label}"
+                data_manager.store_frame(data_id, make_frame(rows))
+                start = time.perf_counter()
+                raw, usage, results = await run_agent_pipeline(prompt, data_id, **kwargs)
+                elapsed = (time.perf_counter() - start) * 1000
+                data_manager.clear(data_id)
+
+                ok = not parse_agent_response(raw, results).rejected
+                totals[label][0] += usage.agent_turns
+                totals[label][1] += usage.total_tokens
+                totals[label][2] += elapsed
+                print(f"{label:>12} {usage.agent_turns:>6} {usage.total_tokens:>8} {elapsed:>9.0f} {str(ok):>6}  {prompt}")
+
+        print("\nmean per request:")
+        for label, (turns, tokens, wall) in totals.items():
+            n = len(PIPELINE_PROMPTS)
+            print(f"{label:>12} {turns / n:>6.1f} {tokens / n:>8.0f} {wall / n:>9.0f}")
+
+    asyncio.run(run())
+
+
+def bench_modes(rows: int, modes: list[str]):
+    _compare_pipelines(rows, [(mode, {"mode": mode}) for mode in modes])
+
+
+def bench_schema(rows: int):
+    _compare_pipelines(rows, [
+        ("no-schema", {"mode": "agent", "inject_schema": False}),
+        ("schema", {"mode": "agent", "inject_schema": True}),
+    ])
+
+
+# ── quota ────────────────────────────────────────────────────────────
+
+BENCH_QUOTA_EMAIL = "bench-quota@example.com"
+
+
+def bench_quota(levels: list[int], requests: int):
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+        sys.exit("Set FIRESTORE_EMULATOR_HOST (e.g. localhost:8080) — this benchmark writes to Firestore")
+
+    import firestore_config as fs
+    from google.cloud import firestore
+
+    today = time.strftime("%Y-%m-%d")
+    user_ref = fs._db.collection(fs.USERS_COLLECTION).document(BENCH_QUOTA_EMAIL)
+
+    def transactional(amount: int):
+        """The single-doc read-modify-write transaction token usage used before sharding."""
+        @firestore.transactional
+        def _consume(txn):
+            data = user_ref.get(transaction=txn).to_dict()
+            if data.get("usage_date") != today:
+                data["usage_date"], data["used_today"] = today, 0
+            data["used_today"] = data.get("used_today", 0) + amount
+            txn.set(user_ref, data)
+        _consume(fs._db.transaction())
+
+    def sharded(amount: int):
+        fs.add_token_usage(BENCH_QUOTA_EMAIL, amount, today)
+
+    def reserved(amount: int):
+        """Reserve an estimate at request start, then settle the difference (two increments)."""
+        estimate = 20_000
+        fs.add_token_usage(BENCH_QUOTA_EMAIL, estimate, today)
+        fs.add_token_usage(BENCH_QUOTA_EMAIL, amount - estimate, today)
+
+    def reset():
+        for ref in fs._usage_shard_refs(BENCH_QUOTA_EMAIL, today):
+            ref.delete()
+        user_ref.set({"email": BENCH_QUOTA_EMAIL, "daily_limit": 10**12, "used_today": 0, "usage_date": today})
+
+    def total(label: str) -> int:
+        if label != "transactional":
+            return fs.get_token_usage(BENCH_QUOTA_EMAIL, today)
+        return user_ref.get().to_dict().get("used_today", 0)
+
+    print(f"{requests} consumptions of 100 tokens per run, one user\n")
+    print(f"{'variant':>14} {'concurrency':>11} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7} {'total ok':>9}")
+    for concurrency in levels:
+        for label, consume in (("transactional", transactional), ("sharded", sharded), ("reserved", reserved)):
+            reset()
+            latencies: list[float] = []
+            errors = 0
+
+            def one(_):
+                nonlocal errors
+                start = time.perf_counter()
+                try:
+                    consume(100)
+                except Exception:
+                    # e.g. the transaction gave up after its retries
+                    errors += 1
+                latencies.append((time.perf_counter() - start) * 1000)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(one, range(requests)))
+            elapsed = time.perf_counter() - start
+
+            correct = total(label) == 100 * (requests - errors)
+            print(f"{label:>14} {concurrency:>11} {requests / elapsed:>8.1f} {_percentile(latencies, 50):>8.1f} "
+                  f"{_percentile(latencies, 95):>8.1f} {errors:>7} {str(correct):>9}")
+
+    reset()
+    user_ref.delete()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = sub.add_parser("serialize", help="Record serialization on 1k/10k/100k row frames")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+
+    p = sub.add_parser("compact", help="Memory, timing and result checks with/without string compaction")
+    p.add_argument("--rows", type=int, default=100_000)
+
+    p = sub.add_parser("engines", help="query_data latency with pandas vs DuckDB")
+    p.add_argument("--rows", type=int, default=1_000_000)
+
+    p = sub.add_parser("loadtest", help="Concurrent /api/visualize against a running server")
+    p.add_argument("--url", default="http://localhost:8000")
+    p.add_argument("--token", required=True, help="Session JWT (Authorization: Bearer)")
+    p.add_argument("--levels", type=int, nargs="+", default=[1, 5, 10, 20])
+    p.add_argument("--rows", type=int, default=500, help="Rows of pasted data per request")
+    p.add_argument("--prompt", default="Total amount by region as a bar chart")
+
+    p = sub.add_parser("modes", help="Agent vs fast pipelines on synthetic data (uses Vertex AI)")
+    p.add_argument("--rows", type=int, default=10_000)
+    p.add_argument("--modes", nargs="+", default=["agent", "fast", "fast_local"])
+
+    p = sub.add_parser("schema", help="Agent turns/latency with and without schema pre-injection (uses Vertex AI)")
+    p.add_argument("--rows", type=int, default=10_000)
+
+    p = sub.add_parser("quota", help="Token accounting: single-doc transaction vs sharded counters (Firestore emulator)")
+    p.add_argument("--levels", type=int, nargs="+", default=[1, 8, 32])
+    p.add_argument("--requests", type=int, default=200, help="Consumptions per run")
+
+    args = parser.parse_args()
+    if args.benchmark == "serialize":
+        bench_serialize(args.sizes)
+    elif args.benchmark == "compact":
+        bench_compact(args.rows)
+    elif args.benchmark == "engines":
+        bench_engines(args.rows)
+    elif args.benchmark == "loadtest":
+        bench_loadtest(args.url, args.token, args.levels, args.rows, args.prompt)
+    elif args.benchmark == "modes":
+        bench_modes(args.rows, args.modes)
+    elif args.benchmark == "schema":
+        bench_schema(args.rows)
+    elif args.benchmark == "quota":
+        bench_quota(args.levels, args.requests)
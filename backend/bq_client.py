@@ -5,6 +5,7 @@ Uses the same service account credentials as the rest of the backend.
 Dataset is passed dynamically per-request (selected by the user as "Company").
 """
 import os
+import pandas as pd
 from google.cloud import bigquery
 from dotenv import load_dotenv
 
@@ -18,6 +19,8 @@ BQ_LOCATION = os.getenv("BIGQUERY_LOCATION", "asia-southeast2")
 # Import get_allowed_datasets where needed.
 from firestore_config import get_allowed_datasets
 
+# Row cap applied to every table download
+MAX_ROWS = 100000
 
 
 class BQClient:
@@ -40,8 +43,26 @@ class BQClient:
         tables = self._client.list_tables(ref)
         return [{"name": table.table_id} for table in tables]
 
+    def get_table_metadata(self, table_name: str, dataset: str) -> dict:
+        """
+        Return table metadata without reading any rows.
+
+        Returns:
+            {
+                "version": str,           # last-modified timestamp (snapshot version)
+                "num_rows": int,
+                "columns": {name: bigquery_type},
+            }
+        """
+        table = self._client.get_table(f"{self._dataset_ref(dataset)}.{table_name}")
+        return {
+            "version": table.modified.isoformat() if table.modified else "",
+            "num_rows": table.num_rows or 0,
+            "columns": {field.name: field.field_type for field in table.schema},
+        }
+
     def fetch_all_rows(
-        self, table_name: str, dataset: str, limit: int = 100000
+        self, table_name: str, dataset: str, limit: int = MAX_ROWS
     ) -> list[dict]:
         """
         Fetch ALL columns from a table, limited to `limit` rows.
@@ -52,8 +73,45 @@ class BQClient:
         result = self._client.query(query, location=BQ_LOCATION).result()
         return [dict(row) for row in result]
 
+    def fetch_table_frame(
+        self,
+        table_name: str,
+        dataset: str,
+        columns: list[str] | None = None,
+        limit: int = MAX_ROWS,
+    ) -> pd.DataFrame:
+        """
+        Fetch a table (or a subset of its columns) straight into a DataFrame.
+
+        Rows are streamed as Arrow record batches through the BigQuery Storage
+        Read API and assembled column-wise, so no per-row Python objects are
+        created. Falls back to the REST download when the Storage API is
+        unavailable (handled inside the client library).
+        """
+        table_ref = f"{self._dataset_ref(dataset)}.{table_name}"
+        cols_str = ", ".join(f"`{col}`" for col in columns) if columns else "*"
+        query = f"SELECT {cols_str} FROM `{table_ref}` LIMIT {limit}"
+        result = self._client.query(query, location=BQ_LOCATION).result()
+        arrow_table = result.to_arrow(create_bqstorage_client=True)
+        return arrow_table.to_pandas()
+
+    def table_ref(self, table_name: str, dataset: str) -> str:
+        """Return the fully-qualified `project.dataset.table` name."""
+        return f"{self._dataset_ref(dataset)}.{table_name}"
+
+    def run_query_frame(self, sql: str, params: dict[str, str] | None = None) -> pd.DataFrame:
+        """Run a (small-result) SQL query with named STRING parameters and return a DataFrame."""
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter(name, "STRING", value)
+                for name, value in (params or {}).items()
+            ]
+        )
+        result = self._client.query(sql, job_config=job_config, location=BQ_LOCATION).result()
+        return result.to_arrow().to_pandas()
+
     def fetch_columns(
-        self, table_name: str, columns: list[str], dataset: str, limit: int = 100000
+        self, table_name: str, columns: list[str], dataset: str, limit: int = MAX_ROWS
     ) -> list[dict]:
         """
         Fetch specific columns from a table, limited to `limit` rows.
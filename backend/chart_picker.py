@@ -0,0 +1,125 @@
+"""
+Chart Picker — local heuristic chart configuration for query results.
+
+Used by the fast pipeline instead of a formatting model call: picks the chart
+type and axes from the shape of the result records and the user's question,
+following the same chart-type rules the prompts give the model.
+"""
+import re
+from typing import Any
+
+_DATE_PATTERN = re.compile(r"^\d{4}-\d{2}(-\d{2})?([ T]\d{2}:\d{2}(:\d{2})?)?$")
+_PROPORTION_WORDS = re.compile(r"\b(share|proportion|percent(age)?|breakdown|composition|split|pie)\b", re.IGNORECASE)
+_CUMULATIVE_WORDS = re.compile(r"\b(cumulative|running total|area)\b", re.IGNORECASE)
+_CORRELATION_WORDS = re.compile(r"\b(correlat\w*|versus|vs\.?|relationship|scatter)\b", re.IGNORECASE)
+
+# Pie charts stay readable up to this many slices
+_MAX_PIE_SLICES = 7
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_date(value: Any) -> bool:
+    return isinstance(value, str) and bool(_DATE_PATTERN.match(value.strip()))
+
+
+def _column_kind(records: list[dict], column: str) -> str:
+    """Classify a column as 'number', 'date' or 'category' from its non-null values."""
+    values = [row.get(column) for row in records if row.get(column) is not None]
+    if values and all(_is_number(v) for v in values):
+        return "number"
+    if values and all(_is_date(v) for v in values):
+        return "date"
+    return "category"
+
+
+def _label(column: str) -> str:
+    return column.replace("_", " ").strip().title()
+
+
+def _title(question: str) -> str:
+    title = question.strip().rstrip("?.!")[:80]
+    return title[:1].upper() + title[1:]
+
+
+def _format_value(value: Any) -> str:
+    if isinstance(value, float):
+        return f"{value:,.2f}"
+    if isinstance(value, int):
+        return f"{value:,}"
+    return str(value)
+
+
+def pick_chart(records: list[dict], question: str) -> dict:
+    """
+    Return a chart response dict (same shape the model produces) for `records`.
+
+    `chart_config.data` is left out — the caller injects the records.
+    """
+    if not records:
+        return {"rejected": True, "reject_reason": "The query returned no rows to chart."}
+
+    columns = list(records[0].keys())
+    kinds = {c: _column_kind(records, c) for c in columns}
+    numeric = [c for c in columns if kinds[c] == "number"]
+    dates = [c for c in columns if kinds[c] == "date"]
+    categories = [c for c in columns if kinds[c] == "category"]
+
+    if not numeric:
+        return {"rejected": True, "reject_reason": "The query result has no numeric column to plot."}
+
+    if dates:
+        x_field = dates[0]
+        chart_type = "area" if _CUMULATIVE_WORDS.search(question) else "line"
+    elif categories:
+        x_field = categories[0]
+        if len(records) <= _MAX_PIE_SLICES and _PROPORTION_WORDS.search(question):
+            chart_type = "pie"
+        else:
+            chart_type = "bar"
+    else:
+        # Only numeric columns: compare the first two
+        x_field = numeric[0]
+        chart_type = "scatter" if len(numeric) > 1 and _CORRELATION_WORDS.search(question) else "bar"
+
+    y_candidates = [c for c in numeric if c != x_field]
+    y_field = y_candidates[0] if y_candidates else numeric[0]
+
+    return {
+        "rejected": False,
+        "chart_type": chart_type,
+        "chart_config": {
+            "x_field": x_field,
+            "y_field": y_field,
+            "title": _title(question) or f"{_label(y_field)} by {_label(x_field)}",
+            "x_label": _label(x_field),
+            "y_label": _label(y_field),
+        },
+        "insight": _insight(records, chart_type, x_field, y_field),
+    }
+
+
+def _insight(records: list[dict], chart_type: str, x_field: str, y_field: str) -> str:
+    rows = [r for r in records if _is_number(r.get(y_field))]
+    if not rows:
+        return ""
+
+    if chart_type in ("line", "area"):
+        ordered = sorted(rows, key=lambda r: str(r.get(x_field)))
+        first, last = ordered[0][y_field], ordered[-1][y_field]
+        direction = "rose" if last > first else "fell" if last < first else "was flat"
+        return (
+            f"{_label(y_field)} {direction} from {_format_value(first)} on {ordered[0][x_field]} "
+            f"to {_format_value(last)} on {ordered[-1][x_field]}."
+        )
+
+    top = max(rows, key=lambda r: r[y_field])
+    if chart_type == "pie":
+        total = sum(r[y_field] for r in rows)
+        if total:
+            return f"{top[x_field]} accounts for the largest share of {_label(y_field).lower()} ({top[y_field] / total:.0%})."
+    if chart_type == "scatter":
+        return f"The highest {_label(y_field).lower()} ({_format_value(top[y_field])}) occurs at {_label(x_field).lower()} {_format_value(top[x_field])}."
+    return f"{top[x_field]} has the highest {_label(y_field).lower()} ({_format_value(top[y_field])})."
@@ -0,0 +1,139 @@
+"""
+Check the memory budgets of DataManager entries that view shared snapshots.
+
+Runs on synthetic frames, without BigQuery: each scenario registers lazy
+entries whose loader goes through a SnapshotCache, the way BigQuery tables
+are registered in main.py, and checks what DATA_MANAGER_MAX_BYTES and the
+per-user conversation budget (CONVERSATION_USER_MAX_BYTES) see:
+
+    python check_budgets.py
+
+Exits 1 if any check fails.
+"""
+
+import sys
+from pathlib import Path
+
+# Ensure backend is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from benchmark import make_frame
+from conversation_store import ConversationStore
+from data_manager import DataManager, data_manager
+from snapshot_cache import SnapshotCache
+
+ROWS = 20_000
+QUERY = "df.groupby('region')['amount'].sum().reset_index()"
+QUERY_COLUMNS = ["region", "amount"]  # what QUERY makes a lazy entry load
+
+
+def _register(manager: DataManager, cache: SnapshotCache, data_id: str, table: str, frame) -> None:
+    """A lazy entry whose columns come from `cache`, as register_request_data sets it up."""
+    columns = list(frame.columns)
+
+    def _load(wanted: list[str]):
+        return cache.get_or_load(("check", table, "v1"), lambda fetch: frame[fetch], wanted)
+
+    schema = {"columns": columns, "dtypes": {c: str(frame[c].dtype) for c in columns}, "row_count": len(frame)}
+    manager.store_lazy(data_id, schema, _load, version=f"check.{table}@v1", owner=cache.held_bytes)
+
+
+def _expect(label: str, ok: bool, detail: str) -> int:
+    print(f"[{' OK ' if ok else 'FAIL'}] {label}  ({detail})")
+    return 0 if ok else 1
+
+
+def check_oversized_snapshot() -> int:
+    """A frame over the snapshot cap is not cached, so the manager must charge it."""
+    frame = DataManager().prepare_frame(make_frame(ROWS))
+    size = int(frame[QUERY_COLUMNS].memory_usage(deep=True, index=True).sum())
+    cache = SnapshotCache(max_bytes=size // 2)
+    manager = DataManager()
+    manager.max_bytes = size + size // 2  # room for one such entry, not two
+
+    _register(manager, cache, "a", "big_a", frame)
+    manager.query_data("a", QUERY)
+    failures = _expect(
+        "oversized snapshot is charged", manager.stats()["bytes"] >= size,
+        f"snapshot cache {cache.stats()['entries']} entries, manager {manager.stats()['bytes']:,} of {size:,} bytes",
+    )
+
+    _register(manager, cache, "b", "big_b", make_frame(ROWS, seed=1).pipe(DataManager().prepare_frame))
+    manager.query_data("b", QUERY)
+    failures += _expect(
+        "second oversized entry evicts the first", manager._get("a") is None and manager._get("b") is not None,
+        f"evictions {manager.evictions}, manager {manager.stats()['bytes']:,} / {manager.max_bytes:,} bytes",
+    )
+    return failures
+
+
+def check_evicted_snapshot() -> int:
+    """An entry is free while the cache holds its snapshot and charged once the cache drops it."""
+    frame = DataManager().prepare_frame(make_frame(ROWS))
+    size = int(frame[QUERY_COLUMNS].memory_usage(deep=True, index=True).sum())
+    cache = SnapshotCache(max_bytes=size * 4)
+    manager = DataManager()
+
+    _register(manager, cache, "a", "cached", frame)
+    manager.query_data("a", QUERY)
+    failures = _expect(
+        "cached snapshot is not charged twice", manager.stats()["bytes"] == 0,
+        f"snapshot cache {cache.stats()['bytes']:,} bytes, manager {manager.stats()['bytes']:,} bytes",
+    )
+
+    cache.invalidate("check", "cached")
+    failures += _expect(
+        "snapshot dropped by the cache is charged", manager.stats()["bytes"] >= size,
+        f"snapshot cache {cache.stats()['entries']} entries, manager {manager.stats()['bytes']:,} of {size:,} bytes",
+    )
+    return failures
+
+
+def check_conversations() -> int:
+    """Table conversations count their loaded columns; another user's ID leaves a conversation alone."""
+    frame = DataManager().prepare_frame(make_frame(ROWS))
+    loaded = int(frame[QUERY_COLUMNS].memory_usage(deep=True, index=False).sum())
+    cache = SnapshotCache(max_bytes=int(frame.memory_usage(deep=True).sum()) * 4)
+    store = ConversationStore(user_max_bytes=loaded + loaded // 2)  # room for one conversation's columns
+    # The cache holds the full table; each conversation loads two columns of it
+    cache.put(("check", "conv", "v1"), frame)
+    data_manager.result_cache.max_entries = 0  # so every conversation evaluates, and loads, its query
+
+    for n in (1, 2):
+        data_id = f"check_conv_{n}"
+        _register(data_manager, cache, data_id, "conv", frame)
+        data_manager.pin(data_id)
+        store.add(f"c{n}", "owner@x.com", "bq:check.conv", data_id)
+        data_manager.query_data(data_id, QUERY)
+        data_manager.unpin(data_id)
+        store.enforce_budget(f"c{n}", "owner@x.com")
+
+    failures = _expect(
+        "table conversation counts its loaded columns", data_manager.entry_bytes("check_conv_2") == loaded,
+        f"{data_manager.entry_bytes('check_conv_2'):,} of {loaded:,} bytes",
+    )
+    failures += _expect(
+        "per-user budget releases the older conversation", store.stats()["conversations"] == 1 and store.budget_releases == 1,
+        f"{store.stats()['conversations']} conversations, {store.budget_releases} budget releases",
+    )
+
+    stolen = store.acquire("c2", "other@x.com", "bq:check.conv")
+    failures += _expect(
+        "another user's conversation_id is not released", stolen is None and store.stats()["conversations"] == 1
+        and data_manager.has("check_conv_2"),
+        f"acquired {stolen is not None}, {store.stats()['conversations']} conversations",
+    )
+    mine = store.acquire("c2", "owner@x.com", "bq:check.conv")
+    failures += _expect("the owner still reuses it", mine is not None, f"acquired {mine is not None}")
+    if mine is not None:
+        data_manager.unpin(mine.data_id)
+    return failures
+
+
+if __name__ == "__main__":
+    failed = check_oversized_snapshot() + check_evicted_snapshot() + check_conversations()
+    print(f"\n[CHECK] {failed} failures.")
+    sys.exit(1 if failed else 0)
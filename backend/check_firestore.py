@@ -0,0 +1,164 @@
+"""
+Check firestore_config's queries (datamart ranges, usage sums) without a Firestore backend.
+
+Each query is built by the real Firestore client (pointed at a dummy emulator
+host, so no credentials are needed) and its filters are then evaluated over
+in-memory docs instead of being sent:
+
+    python check_firestore.py
+
+Exits 1 if any check fails.
+"""
+
+import os
+import sys
+from pathlib import Path
+
+# Ensure backend is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+# Nothing is sent; the emulator host only lets the client start without credentials
+os.environ["FIRESTORE_EMULATOR_HOST"] = "localhost:1"
+
+from google.cloud.firestore_v1.aggregation import AggregationQuery
+from google.cloud.firestore_v1.base_aggregation import AggregationResult, SumAggregation
+from google.cloud.firestore_v1.query import Query
+from google.cloud.firestore_v1.types import StructuredQuery
+
+import firestore_config as fs
+
+# collection path → {doc id: data}
+FAKE_DOCS: dict[str, dict[str, dict]] = {
+    fs.DATAMARTS_COLLECTION: {
+        "pi.orders": {"allowed_users": ["a@x.com"]},
+        "pis.sales_daily": {"allowed_users": ["a@x.com"]},
+        "pis.stock": {"allowed_users": []},
+        "pis.zz_last_table": {"allowed_users": ["b@x.com"]},
+        "pis_archive.sales_daily": {"allowed_users": ["a@x.com"]},
+        "pisa.sales": {"allowed_users": ["a@x.com"]},
+    },
+    f"{fs.USERS_COLLECTION}/a@x.com/{fs.USAGE_SHARDS_SUBCOLLECTION}": {
+        "2026-01-01_0": {"date": "2026-01-01", "used": 700},
+        "2026-01-01_4": {"date": "2026-01-01", "used": -200},  # a released reservation
+        "2026-01-02_3": {"date": "2026-01-02", "used": 1500},
+        "2026-01-02_9": {"date": "2026-01-02", "used": 25},
+    },
+    f"{fs.USERS_COLLECTION}/b@x.com/{fs.USAGE_SHARDS_SUBCOLLECTION}": {
+        "2026-01-02_1": {"date": "2026-01-02", "used": 99},
+    },
+}
+
+_OPS = {
+    StructuredQuery.FieldFilter.Operator.LESS_THAN: lambda a, b: a < b,
+    StructuredQuery.FieldFilter.Operator.LESS_THAN_OR_EQUAL: lambda a, b: a <= b,
+    StructuredQuery.FieldFilter.Operator.GREATER_THAN: lambda a, b: a > b,
+    StructuredQuery.FieldFilter.Operator.GREATER_THAN_OR_EQUAL: lambda a, b: a >= b,
+    StructuredQuery.FieldFilter.Operator.EQUAL: lambda a, b: a == b,
+}
+
+
+class _FakeSnapshot:
+    def __init__(self, doc_id: str, data: dict):
+        self.id = doc_id
+        self.exists = True
+        self._data = data
+
+    def to_dict(self) -> dict:
+        return dict(self._data)
+
+
+def _field_filters(where) -> list:
+    if "composite_filter" in where:
+        return [f.field_filter for f in where.composite_filter.filters]
+    return [where.field_filter] if "field_filter" in where else []
+
+
+def _fake_stream(query: Query, *args, **kwargs):
+    """Evaluate `query`'s document ID filters and string/integer field filters over FAKE_DOCS."""
+    proto = query._to_protobuf()
+    collection = "/".join(query._parent._path)
+    prefix = f"{query._parent._client._database_string}/documents/{collection}/"
+    filters = _field_filters(proto.where)
+
+    for doc_id, data in sorted(FAKE_DOCS.get(collection, {}).items()):
+        keep = True
+        for f in filters:
+            if f.field.field_path == "__name__":
+                bound = f.value.reference_value
+                if not bound.startswith(prefix):
+                    raise AssertionError(f"document ID bound outside {collection}: {bound}")
+                value, other = doc_id, bound[len(prefix):]
+            else:
+                value = data.get(f.field.field_path)
+                other = f.value.string_value if "string_value" in f.value else f.value.integer_value
+            keep = keep and value is not None and _OPS[f.op](value, other)
+        if keep:
+            yield _FakeSnapshot(doc_id, data)
+
+
+def _fake_aggregate(aggregation: AggregationQuery, *args, **kwargs):
+    """Evaluate sum aggregations over the docs `_fake_stream` matches, counting the queries sent."""
+    global aggregation_queries
+    aggregation_queries += 1
+    docs = list(_fake_stream(aggregation._nested_query))
+    results = []
+    for agg in aggregation._aggregations:
+        if not isinstance(agg, SumAggregation):
+            raise NotImplementedError(f"{type(agg).__name__} is not supported by the fake")
+        results.append(AggregationResult(agg.alias, sum(d.to_dict().get(agg.field_ref, 0) for d in docs)))
+    return [results]
+
+
+aggregation_queries = 0
+
+
+def check_datamarts_for_dataset() -> int:
+    failures = 0
+    for dataset in ("pis", "pi", "pis_archive", "nope"):
+        expected = {
+            key: data["allowed_users"]
+            for key, data in FAKE_DOCS[fs.DATAMARTS_COLLECTION].items()
+            if key.split(".", 1)[0] == dataset
+        }
+        try:
+            actual = fs.get_datamarts_for_dataset(dataset)
+        except Exception as e:
+            actual = f"{type(e).__name__}: {e}"
+        if actual == expected:
+            print(f"[ OK ] get_datamarts_for_dataset({dataset!r}) → {sorted(expected)}")
+        else:
+            failures += 1
+            print(f"[FAIL] get_datamarts_for_dataset({dataset!r})")
+            print(f"       expected: {expected}")
+            print(f"       actual:   {actual}")
+    return failures
+
+
+def check_token_usage() -> int:
+    failures = 0
+    for email, day, expected in (
+        ("a@x.com", "2026-01-01", 500),
+        ("A@x.com", "2026-01-02", 1525),
+        ("b@x.com", "2026-01-01", 0),
+        ("nobody@x.com", "2026-01-02", 0),
+    ):
+        before = aggregation_queries
+        try:
+            actual = fs.get_token_usage(email, day)
+        except Exception as e:
+            actual = f"{type(e).__name__}: {e}"
+        queries = aggregation_queries - before
+        if actual == expected and queries == 1:
+            print(f"[ OK ] get_token_usage({email!r}, {day!r}) → {actual} (1 aggregation query)")
+        else:
+            failures += 1
+            print(f"[FAIL] get_token_usage({email!r}, {day!r}) → {actual}, expected {expected} ({queries} aggregation queries)")
+    return failures
+
+
+if __name__ == "__main__":
+    Query.stream = _fake_stream
+    AggregationQuery.get = _fake_aggregate
+    failed = check_datamarts_for_dataset() + check_token_usage()
+    print(f"\n[CHECK] {failed} failures.")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,188 @@
+"""
+Check that SQL pushdown returns the same results as the in-memory pandas path.
+
+Runs every expression in PUSHDOWN_CORPUS against a real BigQuery table through
+both engines and reports mismatches and timings. Column placeholders are
+filled from the command line so the corpus works against any datamart:
+
+    python check_pushdown.py --dataset pis --table sales_daily \
+        --date posting_date --category region --metric amount
+
+With --offline, no BigQuery access is needed: the compiler's output (DuckDB
+dialect) is executed over a synthetic frame and compared with pandas on the
+same frame, for the corpus plus OFFLINE_CORPUS:
+
+    python check_pushdown.py --offline
+"""
+
+import argparse
+import math
+import sys
+import time
+from pathlib import Path
+
+# Ensure backend is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from data_manager import DataManager
+from sql_pushdown import compile_expression, UnsupportedExpression
+
+# Shapes the agent generates most often ({date}/{category}/{metric} are column placeholders)
+PUSHDOWN_CORPUS = [
+    "df.groupby('{category}')['{metric}'].sum().reset_index()",
+    "df.groupby('{category}')['{metric}'].sum().reset_index().sort_values('{metric}', ascending=False).head(10)",
+    "df.groupby('{category}')['{metric}'].mean().round(2).nlargest(5)",
+    "df.groupby('{category}')['{metric}'].count().reset_index()",
+    "df.groupby('{category}').size().reset_index(name='count')",
+    "df.groupby('{category}', as_index=False)['{metric}'].nunique()",
+    "df.groupby('{category}').agg(total=('{metric}', 'sum'), avg=('{metric}', 'mean')).reset_index()",
+    "df[df['{metric}'] > 0].groupby('{category}')['{metric}'].sum().reset_index()",
+    "df[df['{metric}'] != 0][['{category}', '{metric}']].sort_values('{metric}', ascending=False).head(20)",
+    "df[~(df['{metric}'] > 0)].groupby('{category}')['{metric}'].max().reset_index()",
+    "df[df['{category}'].notna()].groupby('{category}')['{metric}'].min().sort_values().head(10)",
+    "df.groupby(pd.Grouper(key='{date}', freq='D'))['{metric}'].sum().reset_index()",
+    "df.groupby(pd.Grouper(key='{date}', freq='W'))['{metric}'].sum().reset_index()",
+    "df.groupby(pd.Grouper(key='{date}', freq='M'))['{metric}'].mean().reset_index()",
+    "df.groupby(pd.Grouper(key='{date}', freq='MS'))['{metric}'].count().reset_index()",
+    "df[df['{date}'] >= pd.Timestamp('2025-01-01')].groupby(pd.Grouper(key='{date}', freq='W'))['{metric}'].sum().reset_index()",
+    "df[df['{date}'].dt.year == 2025].groupby(df['{date}'].dt.month)['{metric}'].sum().reset_index()",
+    "df.groupby('{category}')['{date}'].max().reset_index()",
+]
+
+# Extra shapes covered by --offline (null handling, isin/between, renames, dt parts)
+OFFLINE_CORPUS = [
+    "df[df['status'] != 'open'].groupby('status')['qty'].sum().reset_index()",
+    "df[df['status'].isna()].groupby('region')['qty'].count().reset_index()",
+    "df[df['region'].isin(['North', 'West'])].groupby('region')['amount'].mean().reset_index()",
+    "df[df['qty'].between(10, 20)].groupby('category')['qty'].sum().nlargest(5).reset_index()",
+    "df.groupby(['region', 'status'])['amount'].sum().reset_index()",
+    "df.groupby('region').agg({'amount': 'max', 'qty': 'min'}).reset_index()",
+    "df.groupby('region')['amount'].sum().reset_index().rename(columns={'amount': 'total'})",
+    "df.groupby(df['posting_date'].dt.quarter)['amount'].sum().reset_index()",
+    "df.groupby(pd.Grouper(key='posting_date', freq='QS'))['qty'].sum().reset_index()",
+    "df[(df['amount'] > 100) | (df['qty'] < 5)][['sku', 'amount']].sort_values('amount').head(15)",
+    "df.groupby('category')['sku'].nunique().sort_values(ascending=False).head(5).reset_index()",
+]
+
+
+def _same(a, b) -> bool:
+    if isinstance(a, float) and isinstance(b, float):
+        return math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-9)
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return math.isclose(float(a), float(b), rel_tol=1e-9, abs_tol=1e-9)
+    return a == b
+
+
+def records_match(left: list[dict], right: list[dict]) -> bool:
+    """Same rows, columns and values, with floats compared to 1e-9 (summation order differs between engines)."""
+    if len(left) != len(right):
+        return False
+    for row_a, row_b in zip(left, right):
+        if [str(k) for k in row_a] != [str(k) for k in row_b]:
+            return False
+        if not all(_same(va, vb) for va, vb in zip(row_a.values(), row_b.values())):
+            return False
+    return True
+
+
+def _compare(operations: list[str], expected_fn, actual_fn) -> int:
+    """Run each operation through pandas (`expected_fn`) and SQL (`actual_fn`); print and count mismatches."""
+    dm = DataManager()
+    failures = 0
+    for operation in operations:
+        start = time.perf_counter()
+        expected = expected_fn(operation)
+        pandas_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        try:
+            result = actual_fn(operation)
+            actual = dm._to_serializable_dict(result)
+        except UnsupportedExpression as e:
+            print(f"[SKIP] {operation}\n       not compiled: {e}")
+            continue
+        except Exception as e:
+            # A bad compile (or a query the engine rejects) is a mismatch, not the end of the run
+            actual = {"error": f"{type(e).__name__}: {e}"}
+        pushdown_ms = (time.perf_counter() - start) * 1000
+
+        if "error" in expected or isinstance(actual, dict) or not records_match(expected["data"], actual):
+            failures += 1
+            print(f"[FAIL] {operation}")
+            print(f"       pandas:   {expected['error'] if 'error' in expected else expected['data'][:3]}")
+            print(f"       pushdown: {actual['error'] if isinstance(actual, dict) else actual[:3]}")
+        else:
+            print(f"[ OK ] {operation}  (pandas {pandas_ms:.0f} ms, pushdown {pushdown_ms:.0f} ms)")
+
+    print(f"\n[CHECK] {len(operations)} expressions, {failures} mismatches.")
+    return failures
+
+
+def _fresh_manager(data_id: str, frame) -> DataManager:
+    """A DataManager holding `frame`, with result memoization off so every query is evaluated."""
+    manager = DataManager()
+    manager.result_cache.max_entries = 0
+    manager.store_frame(data_id, frame, convert_dates=False)
+    return manager
+
+
+def check(dataset: str, table: str, placeholders: dict) -> int:
+    from table_loader import get_table_metadata, load_table, make_pushdown_runner
+
+    metadata = get_table_metadata(dataset, table)
+    frame = load_table(dataset, table, metadata=metadata)
+    runner = make_pushdown_runner(dataset, table, metadata)
+    manager = _fresh_manager("check", frame.copy(deep=False))
+
+    def pushdown(operation: str):
+        compile_expression(operation, "t", metadata["columns"])  # raises UnsupportedExpression
+        result = runner(operation)
+        if result is None:
+            raise UnsupportedExpression("table too large to push down")
+        return result
+
+    operations = [template.format(**placeholders) for template in PUSHDOWN_CORPUS]
+    return _compare(operations, lambda op: manager.query_data("check", op), pushdown)
+
+
+def check_offline(rows: int) -> int:
+    from sql_pushdown import compile_expression as _compile
+    import duckdb_engine
+    from benchmark import make_frame
+
+    frame = DataManager().prepare_frame(make_frame(rows))
+    manager = _fresh_manager("check", frame)
+    stored = manager._get("check")
+    column_types = duckdb_engine.column_types_from_frame(stored)
+
+    def pushdown(operation: str):
+        _compile(operation, "df", column_types, dialect=duckdb_engine.DUCKDB)  # raises UnsupportedExpression
+        return duckdb_engine.run(stored, operation)
+
+    placeholders = {"date": "posting_date", "category": "region", "metric": "amount"}
+    operations = [template.format(**placeholders) for template in PUSHDOWN_CORPUS] + OFFLINE_CORPUS
+    return _compare(operations, lambda op: manager.query_data("check", op), pushdown)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--offline", action="store_true", help="compare on a synthetic frame via DuckDB (no BigQuery)")
+    parser.add_argument("--rows", type=int, default=50_000, help="synthetic frame size for --offline")
+    parser.add_argument("--dataset")
+    parser.add_argument("--table")
+    parser.add_argument("--date", help="A DATE or DATETIME column")
+    parser.add_argument("--category", help="A low-cardinality STRING column")
+    parser.add_argument("--metric", help="A numeric column")
+    args = parser.parse_args()
+
+    if args.offline:
+        failed = check_offline(args.rows)
+    else:
+        missing = [f"--{name}" for name in ("dataset", "table", "date", "category", "metric") if not getattr(args, name)]
+        if missing:
+            parser.error(f"required without --offline: {', '.join(missing)}")
+        failed = check(args.dataset, args.table, {"date": args.date, "category": args.category, "metric": args.metric})
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,155 @@
+"""
+Conversation Store — keeps a conversation's data loaded between follow-ups.
+
+Requests that carry a `conversation_id` reuse the data_id registered by the
+conversation's first request (same data source), so follow-up questions
+skip table registration, column downloads and JSON ingest. The
+frame stays pinned in the DataManager until the conversation is idle for
+CONVERSATION_IDLE_TTL_SECONDS or its user exceeds CONVERSATION_USER_MAX_BYTES
+(least recently used conversations of that user are released first).
+Conversations are keyed by (email, conversation_id): an ID sent by another
+user never reaches, let alone releases, the owner's conversation.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from data_manager import data_manager
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_IDLE_TTL_SECONDS = int(os.getenv("CONVERSATION_IDLE_TTL_SECONDS", str(30 * 60)))
+CONVERSATION_USER_MAX_BYTES = int(os.getenv("CONVERSATION_USER_MAX_BYTES", str(256 * 1024 * 1024)))
+
+ConversationKey = tuple[str, str]  # (email, conversation_id)
+
+
+@dataclass
+class Conversation:
+    conversation_id: str
+    email: str
+    source: str  # identifies the data the conversation is about (table + engine, or pasted data hash)
+    data_id: str
+    last_used: float = field(default_factory=time.monotonic)
+
+    @property
+    def key(self) -> ConversationKey:
+        return (self.email, self.conversation_id)
+
+
+class ConversationStore:
+    """Thread-safe registry of live conversations and the data_ids they pin."""
+
+    def __init__(
+        self,
+        idle_ttl_seconds: int = CONVERSATION_IDLE_TTL_SECONDS,
+        user_max_bytes: int = CONVERSATION_USER_MAX_BYTES,
+    ):
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.user_max_bytes = user_max_bytes
+        self._conversations: OrderedDict[ConversationKey, Conversation] = OrderedDict()  # least recently used first
+        self._lock = threading.Lock()
+        self.reuses = 0
+        self.expired = 0
+        self.budget_releases = 0
+
+    def acquire(self, conversation_id: str, email: str, source: str) -> Conversation | None:
+        """
+        Return `email`'s live conversation `conversation_id` if it is about `source`.
+
+        The conversation's data_id is pinned once more for the calling request;
+        release it with `data_manager.unpin` when the request finishes.
+        """
+        self.sweep()
+        key = (email, conversation_id)
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                return None
+            if conversation.source != source:
+                # The user switched tables — start over
+                self._release(key)
+                return None
+            # The data can be gone if it was cleared outside the store
+            if not data_manager.has(conversation.data_id):
+                self._release(key)
+                return None
+            conversation.last_used = time.monotonic()
+            self._conversations.move_to_end(key)
+            data_manager.pin(conversation.data_id)
+            self.reuses += 1
+            return conversation
+
+    def add(self, conversation_id: str, email: str, source: str, data_id: str) -> Conversation:
+        """Register a conversation and pin its data_id until the conversation is released."""
+        conversation = Conversation(conversation_id, email, source, data_id)
+        with self._lock:
+            if conversation.key in self._conversations:
+                self._release(conversation.key)
+            self._conversations[conversation.key] = conversation
+            data_manager.pin(data_id)
+            return conversation
+
+    def enforce_budget(self, conversation_id: str, email: str):
+        """After a turn has loaded its columns, release the user's older conversations if over budget."""
+        with self._lock:
+            if (email, conversation_id) in self._conversations:
+                self._enforce_user_budget(email, keep=(email, conversation_id))
+
+    def sweep(self):
+        """Release conversations idle for longer than the TTL."""
+        cutoff = time.monotonic() - self.idle_ttl_seconds
+        with self._lock:
+            for key in [k for k, conv in self._conversations.items() if conv.last_used < cutoff]:
+                logger.info(f"[CONVERSATION] Releasing idle conversation '{key[1]}'")
+                self._release(key)
+                self.expired += 1
+
+    def _enforce_user_budget(self, email: str, keep: ConversationKey):
+        """Release the user's least recently used conversations until under budget. Caller holds the lock."""
+        owned = [c for c in self._conversations.values() if c.email == email]
+        total = sum(self._bytes(c) for c in owned)
+        for conversation in owned:
+            if total <= self.user_max_bytes:
+                break
+            if conversation.key == keep:
+                continue
+            total -= self._bytes(conversation)
+            logger.info(f"[CONVERSATION] {email} over {self.user_max_bytes:,} bytes, releasing '{conversation.conversation_id}'")
+            self._release(conversation.key)
+            self.budget_releases += 1
+
+    @staticmethod
+    def _bytes(conversation: Conversation) -> int:
+        # What the conversation loaded — for tables, its columns of the shared snapshot
+        return data_manager.entry_bytes(conversation.data_id)
+
+    def _release(self, key: ConversationKey):
+        """Unpin and clear a conversation's data. Caller holds the lock."""
+        conversation = self._conversations.pop(key, None)
+        if conversation is None:
+            return
+        data_manager.unpin(conversation.data_id)
+        if not data_manager.is_pinned(conversation.data_id):
+            data_manager.clear(conversation.data_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            users = {c.email for c in self._conversations.values()}
+            return {
+                "conversations": len(self._conversations),
+                "users": len(users),
+                "bytes": sum(self._bytes(c) for c in self._conversations.values()),
+                "idle_ttl_seconds": self.idle_ttl_seconds,
+                "user_max_bytes": self.user_max_bytes,
+                "reuses": self.reuses,
+                "expired": self.expired,
+                "budget_releases": self.budget_releases,
+            }
+
+
+# Singleton instance
+conversation_store = ConversationStore()
@@ -1,44 +1,288 @@
 """Data Manager — stores and queries user-provided data via pandas."""
+import ast
+import datetime as _dt
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
 import uuid
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
-from typing import Any
+from typing import Any, Callable
+
+from result_cache import ResultCache
+
+import orjson
+
+try:
+    from pandas.tseries.api import guess_datetime_format as _guess_datetime_format
+except ImportError:  # pandas < 2.2
+    try:
+        from pandas._libs.tslibs.parsing import guess_datetime_format as _guess_datetime_format
+    except ImportError:
+        _guess_datetime_format = None
+
+_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Total deep-memory ceiling for stored frames; LRU unpinned entries are evicted above it
+DATA_MANAGER_MAX_BYTES = int(os.getenv("DATA_MANAGER_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Date detection probes this many non-null values before parsing a whole column
+_DATE_SAMPLE_SIZE = 200
+_BQ_DATE_TYPES = {"DATE", "DATETIME", "TIMESTAMP"}
+
+# Schema summaries injected into the agent prompt stay under this many (estimated) tokens
+SCHEMA_SUMMARY_MAX_TOKENS = int(os.getenv("SCHEMA_SUMMARY_MAX_TOKENS", "1500"))
+_SUMMARY_CACHE_SIZE = 128
+_SUMMARY_TOP_VALUES = 5  # most frequent values listed for low-cardinality text columns
+
+
+# ── Dtype compaction ─────────────────────────────────────────
+
+# Opt-in: share one str object per distinct value in string columns at ingest
+DATA_MANAGER_COMPACT_DTYPES = os.getenv("DATA_MANAGER_COMPACT_DTYPES", "").lower() in ("1", "true", "yes")
+
+
+# ── Column projection ────────────────────────────────────────
+
+# Calls that reduce a frame to the columns they name (so loading only those is safe)
+_NARROWING_METHODS = {"value_counts", "agg", "aggregate", "size", "pivot_table", "pivot", "filter", "get"}
+
+
+def _is_column_selector(node: ast.AST) -> bool:
+    """`'a'` or `['a', 'b']` — a subscript that selects named columns."""
+    if isinstance(node, ast.Constant):
+        return isinstance(node.value, str)
+    if isinstance(node, ast.List):
+        return bool(node.elts) and all(isinstance(e, ast.Constant) and isinstance(e.value, str) for e in node.elts)
+    return False
+
+
+def _narrows(method: str, call: ast.Call) -> bool:
+    """True if `.method(...)` returns only the columns its arguments name."""
+    if method not in _NARROWING_METHODS:
+        return False
+    if method == "size":
+        return True
+    if method in ("agg", "aggregate"):
+        # {'amount': 'sum'} or total=('amount', 'sum'); a bare 'sum' applies to every column
+        return any(isinstance(a, ast.Dict) for a in call.args) or bool(call.keywords)
+    if method in ("pivot_table", "pivot"):
+        return any(k.arg == "values" for k in call.keywords)
+    if method == "filter":
+        items = [k.value for k in call.keywords if k.arg == "items"] or call.args[:1]
+        return bool(items) and _is_column_selector(items[0])
+    if method == "get":
+        return bool(call.args) and _is_column_selector(call.args[0])
+    # value_counts: only with an explicit subset
+    return bool(call.args) or any(k.arg == "subset" for k in call.keywords)
+
+
+def _needs_full_frame(tree: ast.AST, columns: list[str]) -> bool:
+    """
+    True if evaluating `tree` may observe columns it does not name.
+
+    Every use of `df` is followed outwards until the chain selects named
+    columns (`df['a']`, `df[['a', 'b']]`, `df.a`, `.loc[:, [...]]`,
+    `.groupby(...)['a']`, `.agg({...})`, `len(df)`, ...). A chain that ends
+    while it still yields whole rows — `df[mask]`, `df.groupby(k).sum()`,
+    `df.nlargest(2, 'a')`, `df.describe()`, `df.columns`, `df` passed to a
+    function — needs the full table, as do uses this check does not know.
+    """
+    known = set(columns)
+    parents = {child: node for node in ast.walk(tree) for child in ast.iter_child_nodes(node)}
+
+    for name in ast.walk(tree):
+        if not (isinstance(name, ast.Name) and name.id == "df"):
+            continue
+        node, narrowed, via_loc = name, False, False
+        while not narrowed:
+            parent = parents.get(node)
+            if isinstance(parent, ast.Attribute) and parent.value is node:
+                call = parents.get(parent)
+                if isinstance(call, ast.Call) and call.func is parent:
+                    narrowed = _narrows(parent.attr, call)
+                    node, via_loc = call, False
+                else:
+                    narrowed = parent.attr in known
+                    node, via_loc = parent, parent.attr == "loc"
+            elif isinstance(parent, ast.Subscript) and parent.value is node:
+                selector = parent.slice
+                if via_loc and isinstance(selector, ast.Tuple) and len(selector.elts) == 2:
+                    selector = selector.elts[1]
+                elif via_loc:
+                    selector = None  # row selection only
+                narrowed = selector is not None and _is_column_selector(selector)
+                node, via_loc = parent, False
+            elif (
+                isinstance(parent, ast.Call) and node in parent.args
+                and isinstance(parent.func, ast.Name) and parent.func.id == "len"
+            ):
+                narrowed = True
+            else:
+                break
+        if not narrowed:
+            return True
+    return False
 
 
 class DataManager:
     """In-memory session store: data_id → pandas DataFrame."""
 
     def __init__(self):
-        self._store: dict[str, pd.DataFrame] = {}
+        self._store: OrderedDict[str, pd.DataFrame] = OrderedDict()  # least recently used first
+        self._sizes: dict[str, int] = {}  # deep memory bytes per entry
+        self._pins: dict[str, int] = {}  # data_id → number of requests using it
+        self._lock = threading.RLock()
+        self.max_bytes = DATA_MANAGER_MAX_BYTES
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.compact_dtypes = DATA_MANAGER_COMPACT_DTYPES
         self._schemas: dict[str, dict] = {}  # BQ table stats
+        self._loaders: dict[str, Callable[[list[str]], pd.DataFrame]] = {}  # lazy column loaders
+        self._owners: dict[str, Callable[..., int | None]] = {}  # lazy data_id → shared cache holding its frames
+        self._snapshots: dict[str, pd.DataFrame] = {}  # data_id → owner's frame the stored shallow copy views
+        self._loaded_bytes: dict[str, int] = {}  # data_id → deep bytes of the snapshot columns it loaded
+        self._pushdown: dict[str, Callable[[str], pd.DataFrame | None]] = {}  # SQL pushdown runners
+        self._engines: dict[str, Callable[[pd.DataFrame, str], pd.DataFrame | None]] = {}  # in-memory engines
+        self.executor = None  # optional QueryExecutor that evaluates expressions out of process
+        self.result_cache = ResultCache()
+        self._versions: dict[str, str] = {}  # lazy data_id → table version
+        self._content_versions: dict[str, tuple[weakref.ref, str]] = {}  # data_id → (frame, content hash)
+        self._summaries: OrderedDict[tuple, dict] = OrderedDict()  # (version, loaded columns) → column stats
+        self._date_formats: dict[tuple[str, str, str], str | None] = {}  # (dataset, table, column) → format
+
+    def _auto_convert_dates(
+        self,
+        df: pd.DataFrame,
+        table_key: tuple[str, str] | None = None,
+        bq_types: dict[str, str] | None = None,
+    ) -> pd.DataFrame:
+        """Scan string columns and convert to datetime if they match date patterns.
 
-    def _auto_convert_dates(self, df: pd.DataFrame) -> pd.DataFrame:
-        """Scan string columns and convert to datetime if they match date patterns."""
+        Args:
+            table_key: (dataset, table) of the source. When given, the outcome of
+                detection is cached per column so later loads skip it.
+            bq_types: BigQuery column types. DATE/DATETIME/TIMESTAMP columns are
+                converted directly and non-string columns are never probed.
+        """
         import logging
         logger = logging.getLogger(__name__)
-        
+
         for col in df.columns:
             # We mostly care about 'object' (string) columns
-            if df[col].dtype == object:
-                # 1. Check for common date names to be more aggressive
-                is_date_named = any(word in col.lower() for word in ['date', 'time', 'posted', 'created', 'updated'])
-                
-                # 2. Try converting
-                try:
-                    # errors='coerce' turns non-decodable strings into NaT
-                    converted = pd.to_datetime(df[col], errors='coerce')
-                    
-                    # 3. Decision: If at least 50% of non-null values converted successfully, 
-                    # OR it's a date-named column and has at least one valid date.
-                    valid_count = converted.notna().sum()
-                    total_non_null = df[col].notna().sum()
-                    
-                    if total_non_null > 0:
-                        if valid_count / total_non_null > 0.5 or (is_date_named and valid_count > 0):
-                            df[col] = converted
-                            logger.info(f"[DATA MANAGER] Auto-converted column '{col}' to datetime (Valid: {valid_count}/{total_non_null})")
-                except Exception as e:
-                    # If it's a huge mess, just skip
-                    pass
+            if df[col].dtype != object:
+                continue
+
+            bq_type = (bq_types or {}).get(col)
+            if bq_type in _BQ_DATE_TYPES:
+                df[col] = pd.to_datetime(df[col], errors='coerce')
+                continue
+            if bq_type is not None and bq_type != "STRING":
+                continue
+
+            if not df[col].notna().any():
+                # Nothing to learn from an all-null column; don't cache a verdict
+                continue
+
+            cache_key = (*table_key, col) if table_key else None
+            if cache_key in self._date_formats:
+                fmt = self._date_formats[cache_key]
+                if fmt is not None:
+                    df[col] = self._parse_dates(df[col], fmt)
+                continue
+
+            fmt = self._detect_date_format(df[col], col)
+            if fmt is not None:
+                converted = self._parse_dates(df[col], fmt)
+                # The sample passed; confirm on the full column with the same rule
+                valid_count = int(converted.notna().sum())
+                total_non_null = int(df[col].notna().sum())
+                if self._looks_like_dates(col, valid_count, total_non_null):
+                    df[col] = converted
+                    logger.info(f"[DATA MANAGER] Auto-converted column '{col}' to datetime (Valid: {valid_count}/{total_non_null})")
+                else:
+                    fmt = None
+            if cache_key is not None:
+                self._date_formats[cache_key] = fmt
+        return df
+
+    @staticmethod
+    def _looks_like_dates(col: str, valid_count: int, total_non_null: int) -> bool:
+        """Decision: at least 50% of non-null values parse, or a date-named column with any valid date."""
+        # Common date names make the check more aggressive
+        is_date_named = any(word in col.lower() for word in ['date', 'time', 'posted', 'created', 'updated'])
+        if total_non_null == 0:
+            return False
+        return valid_count / total_non_null > 0.5 or (is_date_named and valid_count > 0)
+
+    def _detect_date_format(self, series: pd.Series, col: str) -> str | None:
+        """Test a small, evenly spaced sample of a column for dates.
+
+        Returns the strptime format to parse the column with ("" when the
+        values are date objects or need per-value inference), or None when
+        the column does not look like dates.
+        """
+        non_null = series.dropna()
+        if non_null.empty:
+            return None
+        sample = non_null.iloc[:: max(1, len(non_null) // _DATE_SAMPLE_SIZE)].iloc[:_DATE_SAMPLE_SIZE]
+
+        kind = pd.api.types.infer_dtype(sample, skipna=True)
+        if kind in ("date", "datetime", "datetime64"):
+            return ""
+        if kind != "string":
+            return None
+
+        fmt = _guess_datetime_format(sample.iloc[0]) if _guess_datetime_format else None
+        try:
+            converted = self._parse_dates(sample, fmt or "")
+        except Exception:
+            # If it's a huge mess, just skip
+            return None
+        if not self._looks_like_dates(col, int(converted.notna().sum()), len(sample)):
+            return None
+        return fmt or ""
+
+    @staticmethod
+    def _parse_dates(series: pd.Series, fmt: str) -> pd.Series:
+        """Parse with a known format (fast path) or let pandas infer it ("" format)."""
+        # errors='coerce' turns non-decodable strings into NaT
+        if fmt:
+            return pd.to_datetime(series, format=fmt, errors='coerce')
+        return pd.to_datetime(series, errors='coerce')
+
+    def _compact_dtypes(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Shrink a frame's memory without changing query results.
+
+        Rows parsed from JSON hold a separate str object per cell, so a
+        column of five regions keeps a million copies of five strings. Each
+        distinct value is stored once and shared; dtypes and values are
+        unchanged. (Narrower ints overflow silently in agent arithmetic, and
+        categorical or Arrow strings change `groupby`/`value_counts` output,
+        so neither is used.)
+        """
+        for col in df.columns:
+            series = df[col]
+            if series.dtype != object or pd.api.types.infer_dtype(series, skipna=True) != "string":
+                continue
+            present = series.notna().to_numpy()
+            codes, uniques = pd.factorize(series[present])
+            values = series.to_numpy(copy=True)
+            values[present] = np.asarray(uniques, dtype=object).take(codes)
+            df[col] = pd.Series(values, index=series.index, name=col, dtype=object)
+        return df
+
+    def _ingest(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Ingest-time pass shared by every store path: optional dtype compaction."""
+        if self.compact_dtypes:
+            df = self._compact_dtypes(df)
         return df
 
     def store_data(self, json_data: list[dict[str, Any]]) -> str:
@@ -46,14 +290,41 @@ class DataManager:
         data_id = str(uuid.uuid4())[:8]
         df = pd.DataFrame(json_data)
         df = self._auto_convert_dates(df)
-        self._store[data_id] = df
+        self._put(data_id, self._ingest(df))
         return data_id
 
     def store_data_with_id(self, data_id: str, json_data: list[dict[str, Any]]):
         """Store JSON data under a specific data_id (used by fetch_columns tool)."""
         df = pd.DataFrame(json_data)
         df = self._auto_convert_dates(df)
-        self._store[data_id] = df
+        self._put(data_id, self._ingest(df))
+
+    def store_frame(self, data_id: str, frame, convert_dates: bool = True):
+        """Store a DataFrame or pyarrow Table under a specific data_id.
+
+        Columnar counterpart of `store_data_with_id`: the frame is kept as-is
+        (Arrow tables are converted column-wise), skipping the list-of-dicts
+        round trip. Pass `convert_dates=False` for frames that already went
+        through `prepare_frame` (e.g. shared snapshots).
+        """
+        if convert_dates:
+            frame = self.prepare_frame(frame)
+        self._put(data_id, frame)
+
+    def prepare_frame(
+        self,
+        frame,
+        table_key: tuple[str, str] | None = None,
+        bq_types: dict[str, str] | None = None,
+    ) -> pd.DataFrame:
+        """Convert a pyarrow Table to pandas if needed, auto-convert dates and compact dtypes.
+
+        `table_key` and `bq_types` are forwarded to `_auto_convert_dates` so
+        BigQuery tables reuse cached detection results and schema types.
+        """
+        if not isinstance(frame, pd.DataFrame):
+            frame = frame.to_pandas()
+        return self._ingest(self._auto_convert_dates(frame, table_key, bq_types))
 
     def store_schema(self, data_id: str, stats: dict):
         """Store BQ table stats as a schema-only entry.
@@ -63,13 +334,123 @@ class DataManager:
         """
         self._schemas[data_id] = stats
 
+    def store_lazy(
+        self,
+        data_id: str,
+        schema: dict,
+        loader: Callable[[list[str]], pd.DataFrame],
+        version: str | None = None,
+        owner: Callable[..., int | None] | None = None,
+    ):
+        """Register a data_id whose columns are fetched on demand.
+
+        `schema` (columns, dtypes, row_count) is served by `get_schema` without
+        loading any rows. `loader(columns)` must return a frame containing at
+        least `columns`; `query_data` calls it with the columns an operation
+        references, widening the stored frame when a later operation needs
+        columns that were not loaded yet.
+
+        `version` identifies the table contents (e.g. `dataset.table@modified`)
+        so identical queries against an unchanged table hit the result cache.
+
+        Pass `owner` when the loader returns frames held by a shared cache
+        (e.g. `snapshot_cache.held_bytes`): `owner(frame, columns=None)` gives
+        the deep bytes of `frame`'s columns while the cache holds it, else
+        None. The entry then stores a shallow copy and is charged against
+        `max_bytes` only while the owner no longer holds (and charges) it.
+        """
+        self._schemas[data_id] = schema
+        self._loaders[data_id] = loader
+        if owner is not None:
+            self._owners[data_id] = owner
+        if version:
+            self._versions[data_id] = version
+
+    def set_pushdown(self, data_id: str, runner: Callable[[str], pd.DataFrame | None]):
+        """Route `query_data` for this data_id through a SQL pushdown runner first.
+
+        `runner(operation)` returns the result frame, or None when it cannot
+        translate the expression; `query_data` then falls back to pandas.
+        """
+        self._pushdown[data_id] = runner
+
+    def set_frame_engine(self, data_id: str, engine: Callable[[pd.DataFrame, str], pd.DataFrame | None]):
+        """Evaluate `query_data` for this data_id with an alternative in-memory engine.
+
+        `engine(df, operation)` runs against the stored frame and returns the
+        result frame, or None when it cannot handle the expression; `query_data`
+        then evaluates it with pandas.
+        """
+        self._engines[data_id] = engine
+
+    def _referenced_columns(self, operation: str, columns: list[str]) -> list[str]:
+        """
+        Return the columns an operation needs: the known columns it mentions
+        (as literals, attributes or in query strings), or every column when the
+        result may include columns it does not name (see `_needs_full_frame`).
+        """
+        try:
+            tree = ast.parse(operation.strip(), mode="eval")
+        except SyntaxError:
+            return list(columns)
+        if _needs_full_frame(tree, columns):
+            return list(columns)
+
+        known = set(columns)
+        found = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Constant) and isinstance(node.value, str):
+                if node.value in known:
+                    found.add(node.value)
+                else:
+                    # e.g. df.query("amount > 5") — look for column names inside the string
+                    found.update(w for w in re.findall(r"\w+", node.value) if w in known)
+            elif isinstance(node, ast.Attribute) and node.attr in known:
+                found.add(node.attr)
+        return [c for c in columns if c in found]
+
+    def _ensure_columns(self, data_id: str, operation: str) -> pd.DataFrame | None:
+        """Return the stored frame, lazily loading the columns `operation` needs."""
+        df = self._get(data_id)
+        loader = self._loaders.get(data_id)
+        if loader is None:
+            return df
+
+        all_columns = self._schemas[data_id]["columns"]
+        # Whole-frame operations (df.head(), df[mask], df.groupby(k).sum()) need the full table
+        needed = self._referenced_columns(operation, all_columns) or all_columns
+        loaded = list(df.columns) if df is not None else []
+        if df is None or not set(needed).issubset(loaded):
+            columns = list(dict.fromkeys([*loaded, *needed]))
+            df = loader(columns)
+            owner = self._owners.get(data_id)
+            if owner is None:
+                self._put(data_id, df)
+                return df
+            # A shallow copy keeps anything `df` gains in user code out of the shared frame
+            snapshot, df = df, df.copy(deep=False)
+            size, loaded_bytes = owner(snapshot), owner(snapshot, columns)
+            if size is None or loaded_bytes is None:
+                usage = snapshot.memory_usage(deep=True, index=True)
+                size, loaded_bytes = int(usage.sum()), int(usage[usage.index.intersection(columns)].sum())
+            with self._lock:
+                self._snapshots[data_id] = snapshot
+                self._loaded_bytes[data_id] = loaded_bytes
+                self._put(data_id, df, size)
+        return df
+
     def get_schema(self, data_id: str) -> dict:
         """Return column names, dtypes, row count, and sample rows (or BQ stats)."""
         # If BQ stats are stored, return them (no raw data)
         if data_id in self._schemas:
-            return self._schemas[data_id]
+            schema = self._schemas[data_id]
+            df = self._get(data_id)
+            if data_id in self._loaders and df is not None:
+                # Lazy entry with some columns already loaded — include a peek at them
+                return {**schema, "sample_rows": self._to_serializable_dict(df.head(3))}
+            return schema
 
-        df = self._store.get(data_id)
+        df = self._get(data_id)
         if df is None:
             return {"error": f"No data found for id '{data_id}'"}
 
@@ -80,51 +461,177 @@ class DataManager:
             "sample_rows": self._to_serializable_dict(df.head(3)),
         }
 
+    def schema_summary(self, data_id: str, max_tokens: int = SCHEMA_SUMMARY_MAX_TOKENS) -> dict:
+        """
+        Return a compact schema for prompt injection: `get_schema` plus per-column
+        cardinality, min/max and frequent values, trimmed to `max_tokens`.
+
+        Column statistics are computed once per data version and cached. For
+        lazy BigQuery entries they cover the columns loaded so far; the others
+        are listed with their type only.
+        """
+        schema = self.get_schema(data_id)
+        if "error" in schema:
+            return schema
+
+        df = self._get(data_id)
+        stats = {}
+        if df is not None:
+            version = self._data_version(data_id)
+            key = (version, tuple(df.columns)) if version else None
+            with self._lock:
+                stats = self._summaries.get(key) if key else None
+                if stats is not None:
+                    self._summaries.move_to_end(key)
+            if stats is None:
+                stats = {col: self._column_stats(df[col]) for col in df.columns}
+                if key:
+                    with self._lock:
+                        self._summaries[key] = stats
+                        while len(self._summaries) > _SUMMARY_CACHE_SIZE:
+                            self._summaries.popitem(last=False)
+
+        summary = {
+            "row_count": schema.get("row_count"),
+            "columns": {
+                col: {"dtype": schema.get("dtypes", {}).get(col, "unknown"), **stats.get(col, {})}
+                for col in schema.get("columns", [])
+            },
+            "sample_rows": schema.get("sample_rows", []),
+        }
+        return self._fit_summary(summary, max_tokens)
+
+    def _column_stats(self, series: pd.Series) -> dict:
+        """Distinct count, min/max (numeric and dates) and top values (low-cardinality text)."""
+        stats: dict[str, Any] = {"nulls": int(series.isna().sum())}
+        try:
+            distinct = int(series.nunique(dropna=True))
+        except TypeError:  # unhashable cells (lists, dicts)
+            return stats
+        stats["distinct"] = distinct
+
+        if pd.api.types.is_bool_dtype(series):
+            return stats
+        if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_datetime64_any_dtype(series):
+            non_null = series.dropna()
+            if len(non_null):
+                bounds = self._serializable_column(pd.Series([non_null.min(), non_null.max()], dtype=series.dtype))
+                stats["min"], stats["max"] = bounds
+        elif distinct <= 50:
+            top = series.value_counts(dropna=True).head(_SUMMARY_TOP_VALUES)
+            stats["top_values"] = [str(v) for v in top.index]
+        return stats
+
+    @staticmethod
+    def _fit_summary(summary: dict, max_tokens: int) -> dict:
+        """Drop detail (sample rows, top values, stats, then columns) until the summary fits the budget."""
+        def tokens(obj) -> int:
+            # ~4 characters per token for JSON-ish text
+            return len(json.dumps(obj, default=str)) // 4
+
+        if tokens(summary) <= max_tokens:
+            return summary
+        summary = {**summary, "sample_rows": []}
+        if tokens(summary) <= max_tokens:
+            return summary
+
+        columns = {col: {k: v for k, v in info.items() if k != "top_values"} for col, info in summary["columns"].items()}
+        summary = {**summary, "columns": columns}
+        if tokens(summary) <= max_tokens:
+            return summary
+
+        columns = {col: {"dtype": info["dtype"]} for col, info in columns.items()}
+        summary = {**summary, "columns": columns}
+        names = list(columns)
+        while names and tokens(summary) > max_tokens:
+            names.pop()
+            summary = {
+                **summary,
+                "columns": {col: columns[col] for col in names},
+                "columns_omitted": len(columns) - len(names),
+            }
+        return summary
+
     def _to_serializable_dict(self, df: pd.DataFrame) -> list[dict]:
-        """Helper to convert DataFrame to dict while handling non-serializable dates and timestamps."""
+        """Convert a DataFrame to JSON-safe records.
+
+        Works column-at-a-time: datetimes are formatted with one vectorized
+        call per column, NaN/Inf/NaT/NA become None through boolean masks, and
+        `ndarray.tolist()` produces native Python values. Only the final
+        record assembly iterates rows.
+        """
         if df.empty:
             return []
-        
-        # Create a temporary copy for serialization
-        temp_df = df.copy()
-        
-        # Convert all datetime/date/timestamp columns to ISO format strings
-        for col in temp_df.columns:
-            # 1. Handle explicit datetime64 columns
-            if pd.api.types.is_datetime64_any_dtype(temp_df[col]):
-                temp_df[col] = temp_df[col].dt.strftime('%Y-%m-%d %H:%M:%S').replace('NaT', None)
-            
-            # 2. Handle 'object' columns that might contain date/datetime objects (even if mixed with None/NaN)
-            elif pd.api.types.is_object_dtype(temp_df[col]):
-                # Convert to datetime (errors='ignore' handles non-date strings)
-                # Then check if it actually resulted in datetime objects
-                converted = pd.to_datetime(temp_df[col], errors='coerce')
-                if not converted.isna().all():
-                    # If this column has valid dates, convert them to strings
-                    # We only apply this if the column seems meant to be dates
-                    temp_df[col] = converted.dt.strftime('%Y-%m-%d %H:%M:%S').where(converted.notna(), temp_df[col])
-                    # If it was purely dates, it will now be strings. 
-                    # If it was mixed, the date parts are now ISO strings.
-
-            # 3. Fallback for any remaining non-serializable objects (like datetime.date)
-            # Use apply with a lambda to handle row-by-row
-        # Finally, convert to list of dicts
-        records = temp_df.to_dict(orient="records")
-        
-        # FINAL SANITIZATION: JSON standard does NOT support NaN, Inf, or -Inf.
-        # We must replace them with None (which becomes null in JSON) to avoid
-        # '400 INVALID_ARGUMENT' errors from the GenAI API.
-        import math
-        for row in records:
-            for key, val in row.items():
-                # 1. Handle NumPy/Python NaNs and Infs
-                if isinstance(val, float) and (math.isnan(val) or math.isinf(val)):
-                    row[key] = None
-                # 2. Handle pandas NaT (Not a Time) which might remain in some edge cases
-                elif pd.isna(val):
-                    row[key] = None
-        
-        return records
+
+        names = list(df.columns)
+        values = [self._serializable_column(df.iloc[:, i]) for i in range(len(names))]
+        return [dict(zip(names, row)) for row in zip(*values)]
+
+    def _serializable_column(self, series: pd.Series) -> list:
+        """Return a column as a list of JSON-safe Python values (None for missing)."""
+        dtype = series.dtype
+
+        if isinstance(dtype, pd.CategoricalDtype):
+            # Materialize to the categories' own dtype, then serialize that
+            return self._serializable_column(pd.Series(np.asarray(series)))
+
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            return self._format_datetimes(series)
+
+        if pd.api.types.is_timedelta64_dtype(dtype):
+            return self._masked(series.astype(str).to_numpy(dtype=object), series.isna().to_numpy())
+
+        if isinstance(dtype, np.dtype) and dtype.kind == "f":
+            arr = series.to_numpy()
+            invalid = ~np.isfinite(arr)
+            if invalid.any():
+                return self._masked(arr.astype(object), invalid)
+            return arr.tolist()
+
+        if isinstance(dtype, np.dtype) and dtype.kind in "iub":
+            return series.to_numpy().tolist()
+
+        if dtype == object:
+            kind = pd.api.types.infer_dtype(series, skipna=True)
+            if kind in ("date", "datetime", "datetime64"):
+                return self._format_datetimes(pd.to_datetime(series, errors="coerce"))
+            if kind in ("floating", "decimal", "mixed-integer-float"):
+                return self._serializable_column(pd.to_numeric(series, errors="coerce").astype(float))
+            if kind == "mixed":
+                # Rare: date objects mixed with other values — format just the dates
+                # (and drop inf, which JSON cannot carry, from any floats among them)
+                series = series.map(
+                    lambda v: v.strftime(_DATETIME_FORMAT) if isinstance(v, (_dt.date, _dt.datetime))
+                    else None if isinstance(v, float) and not math.isfinite(v)
+                    else v
+                )
+
+        # Nullable extension dtypes (Int64, boolean, string, Arrow) and plain objects
+        arr = series.astype(object).to_numpy()
+        missing = series.isna().to_numpy()
+        if pd.api.types.is_float_dtype(dtype):
+            missing |= ~np.isfinite(series.to_numpy(dtype=float, na_value=np.nan))
+        return self._masked(arr, missing)
+
+    def _format_datetimes(self, series: pd.Series) -> list:
+        """Format a datetime64 column as 'YYYY-MM-DD HH:MM:SS' strings in one vectorized pass."""
+        if getattr(series.dt, "tz", None) is not None:
+            # Keep wall-clock time, as strftime on a tz-aware column would
+            series = series.dt.tz_localize(None)
+        raw = series.to_numpy(dtype="datetime64[s]")
+        text = np.char.replace(np.datetime_as_string(raw, unit="s"), "T", " ").astype(object)
+        return self._masked(text, np.isnat(raw))
+
+    @staticmethod
+    def _masked(arr: np.ndarray, missing: np.ndarray) -> list:
+        if missing.any():
+            arr = arr.copy()
+            arr[missing] = None
+        return arr.tolist()
+
+    def to_json_bytes(self, payload: Any) -> bytes:
+        """Encode a query result or API response as JSON bytes (orjson; NaN/inf become null)."""
+        return orjson.dumps(payload, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
 
     def query_data(self, data_id: str, operation: str) -> dict:
         """
@@ -138,24 +645,108 @@ class DataManager:
           - "df.describe()"
           - "df[['name', 'value']].head(10)"
 
-        Returns the result as a list of dicts (records).
+        Returns the result as a list of dicts (records). Successful results are
+        memoized per (data version, engine, loaded columns, normalized operation).
         """
-        df = self._store.get(data_id)
+        key = self.result_cache.key(
+            self._data_version(data_id), operation,
+            engine=self._engine_name(data_id),
+            columns=self._columns_for(data_id, operation),
+        )
+        if key is not None:
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                return cached
+
+        start = time.perf_counter()
+        payload = self._run_query(data_id, operation)
+        if key is not None and "error" not in payload:
+            self.result_cache.put(key, payload, time.perf_counter() - start)
+        return payload
+
+    def _engine_name(self, data_id: str) -> str:
+        """Label of the engine that answers `query_data` for this data_id (part of the cache key)."""
+        if data_id in self._pushdown:
+            return "pushdown"
+        engine = self._engines.get(data_id)
+        if engine is not None:
+            return f"{getattr(engine, '__module__', '')}.{getattr(engine, '__qualname__', type(engine).__name__)}"
+        return "pandas"
+
+    def _columns_for(self, data_id: str, operation: str) -> tuple[str, ...]:
+        """Columns `operation` will be evaluated against: those loaded plus any it makes `_ensure_columns` load."""
+        df = self._get(data_id)
+        columns = [str(c) for c in df.columns] if df is not None else []
+        if data_id in self._loaders:
+            all_columns = self._schemas[data_id]["columns"]
+            needed = self._referenced_columns(operation, all_columns) or all_columns
+            columns = list(dict.fromkeys([*columns, *map(str, needed)]))
+        return tuple(sorted(columns))
+
+    def _data_version(self, data_id: str) -> str | None:
+        """Return the table version of a lazy entry, or a content hash of a stored frame."""
+        version = self._versions.get(data_id)
+        if version is not None:
+            return version
+
+        df = self._get(data_id)
+        if df is None:
+            return None
+        known = self._content_versions.get(data_id)
+        if known is not None and known[0]() is df:
+            return known[1]
+
+        try:
+            digest = hashlib.sha1(repr([(str(c), str(t)) for c, t in df.dtypes.items()]).encode("utf-8"))
+            digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+        except TypeError:
+            # Unhashable cell values (lists, dicts) — this frame is not cached
+            return None
+        version = f"content:{digest.hexdigest()}"
+        self._content_versions[data_id] = (weakref.ref(df), version)
+        return version
+
+    def _run_query(self, data_id: str, operation: str) -> dict:
+        runner = self._pushdown.get(data_id)
+        if runner is not None:
+            try:
+                result = runner(operation)
+                if result is not None:
+                    return {"data": self._to_serializable_dict(result), "row_count": len(result)}
+            except Exception as e:
+                import logging
+                logging.getLogger(__name__).warning(f"[PUSHDOWN] Failed, falling back to pandas: {e}")
+
+        try:
+            df = self._ensure_columns(data_id, operation)
+        except Exception as e:
+            return {"error": f"Failed to load columns: {str(e)}"}
         if df is None:
             return {"error": f"No data found for id '{data_id}'"}
 
+        engine = self._engines.get(data_id)
+        if engine is not None:
+            try:
+                result = engine(df, operation)
+                if result is not None:
+                    return {"data": self._to_serializable_dict(result), "row_count": len(result)}
+            except Exception as e:
+                import logging
+                logging.getLogger(__name__).warning(f"[ENGINE] Failed, falling back to pandas: {e}")
+
+        if self.executor is not None:
+            payload = self.executor.evaluate(data_id, df, operation, self, version=self._data_version(data_id))
+            # Publishing may have written a new shared file
+            with self._lock:
+                self._evict(keep=data_id)
+            return payload
+        return self.evaluate_payload(df, operation)
+
+    def evaluate_payload(self, df: pd.DataFrame, operation: str) -> dict:
+        """Evaluate `operation` against `df` and convert the result to a query_data payload."""
         try:
-            import datetime as _dt
             # Execute the pandas operation
-            # Provide a rich eval context so LLM-generated date expressions work
-            eval_context = {
-                "df": df,
-                "pd": pd,
-                "datetime": _dt,
-                "date": _dt.date,
-                "timedelta": _dt.timedelta,
-            }
-            result = eval(operation, eval_context)
+            result = self._evaluate(df, operation)
             # Convert result to records
             if isinstance(result, pd.DataFrame):
                 return {"data": self._to_serializable_dict(result), "row_count": len(result)}
@@ -168,9 +759,156 @@ class DataManager:
         except Exception as e:
             return {"error": f"Query failed: {str(e)}"}
 
+    @staticmethod
+    def _eval_context(df: pd.DataFrame) -> dict:
+        # Provide a rich eval context so LLM-generated date expressions work
+        return {
+            "df": df,
+            "pd": pd,
+            "datetime": _dt,
+            "date": _dt.date,
+            "timedelta": _dt.timedelta,
+        }
+
+    def _evaluate(self, df: pd.DataFrame, operation: str) -> Any:
+        """Evaluate a pandas expression against `df`."""
+        return eval(operation, self._eval_context(df))
+
+    # ── Memory accounting ────────────────────────────────────
+
+    def _put(self, data_id: str, df: pd.DataFrame, size: int | None = None):
+        """Store a frame, record its deep memory size and evict LRU entries over the ceiling."""
+        if size is None:
+            size = int(df.memory_usage(deep=True, index=True).sum())
+        with self._lock:
+            self._store[data_id] = df
+            self._store.move_to_end(data_id)
+            self._sizes[data_id] = size
+            self._evict(keep=data_id)
+
+    def _get(self, data_id: str) -> pd.DataFrame | None:
+        """Return a stored frame and mark it recently used."""
+        with self._lock:
+            df = self._store.get(data_id)
+            if df is not None:
+                self._store.move_to_end(data_id)
+            return df
+
+    def _charged(self, data_id: str) -> int:
+        """
+        Bytes an entry counts against `max_bytes`: its size, or 0 while its
+        frame is a snapshot its owner still holds (the owner charges it once,
+        however many entries view it). Caller holds the lock.
+        """
+        snapshot = self._snapshots.get(data_id)
+        if snapshot is not None and self._owners[data_id](snapshot) is not None:
+            return 0
+        return self._sizes.get(data_id, 0)
+
+    def _published_bytes(self) -> int:
+        """Bytes of the executor's published frame files, which live in RAM as well."""
+        return self.executor.published_bytes() if self.executor is not None else 0
+
+    def _evict(self, keep: str):
+        """
+        Drop least-recently-used, unpinned frames until the charged frames plus
+        the executor's published files fit in `max_bytes`. Caller holds the lock.
+        """
+        import logging
+        charged = {data_id: self._charged(data_id) for data_id in self._store}
+        total = sum(charged.values()) + self._published_bytes()
+        for data_id in list(self._store):
+            if total <= self.max_bytes:
+                break
+            if data_id == keep or self._pins.get(data_id):
+                continue
+            # Entries charged nothing and without a published file free nothing
+            if not charged[data_id] and not (self.executor is not None and self.executor.publishes(data_id)):
+                continue
+            self._store.pop(data_id)
+            self._sizes.pop(data_id, None)
+            self._snapshots.pop(data_id, None)
+            self._loaded_bytes.pop(data_id, None)
+            freed = charged[data_id]
+            if self.executor is not None:
+                freed += self.executor.release(data_id)
+            total -= freed
+            self.evictions += 1
+            self.evicted_bytes += freed
+            logging.getLogger(__name__).warning(f"[DATA MANAGER] Evicted '{data_id}' ({freed:,} bytes) to stay under {self.max_bytes:,} bytes")
+
+    def pin(self, data_id: str):
+        """Protect a data_id from eviction while a request is using it (re-entrant)."""
+        with self._lock:
+            self._pins[data_id] = self._pins.get(data_id, 0) + 1
+
+    def unpin(self, data_id: str):
+        with self._lock:
+            remaining = self._pins.get(data_id, 0) - 1
+            if remaining > 0:
+                self._pins[data_id] = remaining
+            else:
+                self._pins.pop(data_id, None)
+
+    @contextmanager
+    def pinned(self, data_id: str):
+        """`with data_manager.pinned(data_id): ...` — pin for the duration of the block."""
+        self.pin(data_id)
+        try:
+            yield
+        finally:
+            self.unpin(data_id)
+
+    def is_pinned(self, data_id: str) -> bool:
+        with self._lock:
+            return bool(self._pins.get(data_id))
+
+    def has(self, data_id: str) -> bool:
+        """True if data_id is stored or registered for lazy loading."""
+        with self._lock:
+            return data_id in self._store or data_id in self._schemas
+
+    def entry_bytes(self, data_id: str) -> int:
+        """
+        Deep memory size of what a data_id has loaded, charged or not (0 if
+        nothing): the columns it fetched when it views a shared snapshot
+        (which may hold more), else its whole frame.
+        """
+        with self._lock:
+            if data_id in self._loaded_bytes:
+                return self._loaded_bytes[data_id]
+            return self._sizes.get(data_id, 0)
+
+    def stats(self) -> dict:
+        """Return current memory usage, entry count and eviction statistics."""
+        with self._lock:
+            return {
+                "entries": len(self._store),
+                "bytes": sum(self._charged(data_id) for data_id in self._store) + self._published_bytes(),
+                "published_bytes": self._published_bytes(),
+                "max_bytes": self.max_bytes,
+                "pinned": len(self._pins),
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+                "result_cache": self.result_cache.stats(),
+            }
+
     def clear(self, data_id: str):
         """Remove stored data."""
-        self._store.pop(data_id, None)
+        with self._lock:
+            self._store.pop(data_id, None)
+            self._sizes.pop(data_id, None)
+            self._snapshots.pop(data_id, None)
+            self._loaded_bytes.pop(data_id, None)
+        self._schemas.pop(data_id, None)
+        self._loaders.pop(data_id, None)
+        self._owners.pop(data_id, None)
+        self._pushdown.pop(data_id, None)
+        self._engines.pop(data_id, None)
+        self._versions.pop(data_id, None)
+        self._content_versions.pop(data_id, None)
+        if self.executor is not None:
+            self.executor.release(data_id)
 
 
 # Singleton instance
@@ -0,0 +1,118 @@
+"""
+DuckDB Engine — runs agent pandas expressions on stored frames with DuckDB.
+
+An alternative to evaluating `query_data` expressions with pandas: the
+expression is compiled with `sql_pushdown` (DuckDB dialect) and executed by
+an in-process, vectorized, multi-threaded DuckDB connection directly over
+the stored DataFrame (no copy). Expressions the compiler does not support
+return None so `DataManager.query_data` falls back to pandas.
+"""
+import logging
+import os
+import threading
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+from sql_pushdown import Dialect, compile_expression, UnsupportedExpression
+
+logger = logging.getLogger(__name__)
+
+DUCKDB_THREADS = int(os.getenv("DUCKDB_THREADS", str(os.cpu_count() or 1)))
+
+# Name the stored frame is registered under inside DuckDB
+_FRAME_NAME = "df"
+
+
+class DuckDBDialect(Dialect):
+    name = "duckdb"
+
+    def quote(self, ident: str) -> str:
+        return '"' + ident.replace('"', '""') + '"'
+
+    def param(self, name: str) -> str:
+        return f"${name}"
+
+    def timestamp_literal(self, ts: pd.Timestamp) -> str:
+        return f"TIMESTAMP '{ts.strftime('%Y-%m-%d %H:%M:%S.%f')}'"
+
+    def as_timestamp(self, col_sql: str, col_type: str) -> str:
+        return f"CAST({col_sql} AS TIMESTAMP)"
+
+    def bucket(self, col_sql: str, col_type: str, freq: str) -> str:
+        expr = {
+            "H": f"date_trunc('hour', {col_sql})",
+            "D": f"date_trunc('day', {col_sql})",
+            "W": f"date_trunc('week', {col_sql}) + INTERVAL 6 DAY",
+            "M": f"last_day({col_sql})",
+            "MS": f"date_trunc('month', {col_sql})",
+            "Q": f"date_trunc('quarter', {col_sql}) + INTERVAL 3 MONTH - INTERVAL 1 DAY",
+            "QS": f"date_trunc('quarter', {col_sql})",
+            "Y": f"date_trunc('year', {col_sql}) + INTERVAL 1 YEAR - INTERVAL 1 DAY",
+            "YS": f"date_trunc('year', {col_sql})",
+        }[freq]
+        return f"CAST({expr} AS TIMESTAMP)"
+
+    def sum(self, col_sql: str, col_type: str) -> str:
+        # SUM(BIGINT) is HUGEINT in DuckDB; keep pandas' int64 result type
+        if col_type in ("INT64", "INTEGER"):
+            return f"COALESCE(CAST(SUM({col_sql}) AS BIGINT), 0)"
+        return super().sum(col_sql, col_type)
+
+
+DUCKDB = DuckDBDialect()
+
+_local = threading.local()
+
+
+def _connection():
+    """One DuckDB connection per thread (connections are not thread-safe)."""
+    con = getattr(_local, "con", None)
+    if con is None:
+        con = duckdb.connect()
+        con.execute(f"SET threads TO {DUCKDB_THREADS}")
+        _local.con = con
+    return con
+
+
+def column_types_from_frame(df: pd.DataFrame) -> dict[str, str]:
+    """Map pandas dtypes to the (BigQuery-named) column types the compiler understands."""
+    types = {}
+    for col, dtype in df.dtypes.items():
+        if not isinstance(col, str):
+            continue
+        if isinstance(dtype, pd.CategoricalDtype):
+            dtype = dtype.categories.dtype
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            types[col] = "TIMESTAMP" if getattr(dtype, "tz", None) is not None else "DATETIME"
+        elif pd.api.types.is_bool_dtype(dtype):
+            types[col] = "BOOL"
+        elif pd.api.types.is_integer_dtype(dtype):
+            types[col] = "INT64"
+        elif pd.api.types.is_float_dtype(dtype):
+            types[col] = "FLOAT64"
+        elif pd.api.types.is_string_dtype(dtype) and (
+            dtype != np.dtype(object) or pd.api.types.infer_dtype(df[col], skipna=True) in ("string", "empty")
+        ):
+            types[col] = "STRING"
+        else:
+            types[col] = "OTHER"
+    return types
+
+
+def run(df: pd.DataFrame, operation: str) -> pd.DataFrame | None:
+    """Execute `operation` against `df` in DuckDB; None if it cannot be compiled."""
+    try:
+        compiled = compile_expression(operation, _FRAME_NAME, column_types_from_frame(df), dialect=DUCKDB)
+    except UnsupportedExpression as e:
+        logger.info(f"[DUCKDB] Falling back to pandas ({e}): {operation}")
+        return None
+
+    con = _connection()
+    con.register(_FRAME_NAME, df)
+    try:
+        frame = con.execute(compiled.sql, compiled.params).df()
+    finally:
+        con.unregister(_FRAME_NAME)
+    return compiled.postprocess(frame)
@@ -6,14 +6,24 @@ in token_quota.json. Uses Application Default Credentials (ADC) — no service
 account key file is required when running on Cloud Run in the same project.
 
 Collections:
-  - prompt_to_viz_config: global settings (default_daily_limit, admins, allowed_datasets)
+  - prompt_to_viz_config: global settings (default_daily_limit, admins, allowed_datasets,
+    datamart_index — whether the per-user index below has been built)
   - prompt_to_viz_users: per-user docs (name, email, daily_limit, department, used_today, usage_date)
+      └── usage_shards: sharded daily token counters ({date}_{n}: date, used, expire_at)
   - prompt_to_viz_datamarts: per-table access lists (allowed_users)
+  - prompt_to_viz_user_datamarts: per-user inverted index of the above (tables),
+    kept in step by set_datamart / delete_datamart / remove_user_from_datamarts
+    and only read once rebuild_datamart_index.py --fix has built it
 """
 
 import os
+import random
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
 from dotenv import load_dotenv
 from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
 import logging
 
 logger = logging.getLogger(__name__)
@@ -46,6 +56,121 @@ logger.info(f"[FIRESTORE] Initialized client for project: {PROJECT_ID}")
 CONFIG_COLLECTION = "prompt_to_viz_config"
 USERS_COLLECTION = "prompt_to_viz_users"
 DATAMARTS_COLLECTION = "prompt_to_viz_datamarts"
+USER_DATAMARTS_COLLECTION = "prompt_to_viz_user_datamarts"
+
+# ──────────────────────────────────────────────
+# Config doc cache
+# ──────────────────────────────────────────────
+
+# prompt_to_viz_config docs (settings, admins, allowed_datasets) are read on
+# every request but change rarely. Cached copies expire after
+# CONFIG_CACHE_TTL_SECONDS; with CONFIG_CACHE_LISTENERS on, a snapshot
+# listener per doc also pushes changes made by other instances as they happen,
+# and docs it has delivered stay cached without expiring.
+CONFIG_CACHE_TTL_SECONDS = float(os.getenv("CONFIG_CACHE_TTL_SECONDS", "60"))
+CONFIG_CACHE_LISTENERS = os.getenv("CONFIG_CACHE_LISTENERS", "true").lower() in ("1", "true", "yes")
+
+
+class ConfigDocCache:
+    """Thread-safe TTL cache of prompt_to_viz_config docs, refreshed by snapshot listeners."""
+
+    def __init__(self, ttl_seconds: float = CONFIG_CACHE_TTL_SECONDS, listeners: bool = CONFIG_CACHE_LISTENERS):
+        self.ttl_seconds = ttl_seconds
+        self.listeners = listeners
+        # doc name → (fetched at, doc data or None if the doc does not exist)
+        self._docs: dict[str, tuple[float, dict | None]] = {}
+        # doc name → bumped by every listener update and invalidation, so a
+        # read that started earlier does not overwrite what they stored
+        self._generations: dict[str, int] = {}
+        self._listened: set[str] = set()  # docs a listener has delivered (kept up to date without a TTL)
+        self._watches: dict = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.listener_updates = 0
+
+    def get(self, name: str) -> dict | None:
+        """Return a copy of the doc's data (None if it does not exist), reading Firestore on a miss."""
+        with self._lock:
+            entry = self._docs.get(name)
+            if entry is not None and (name in self._listened or time.monotonic() - entry[0] <= self.ttl_seconds):
+                self.hits += 1
+                return dict(entry[1]) if entry[1] is not None else None
+            self.misses += 1
+            generation = self._generations.get(name, 0)
+
+        doc = _db.collection(CONFIG_COLLECTION).document(name).get()
+        data = doc.to_dict() if doc.exists else None
+        with self._lock:
+            if self._generations.get(name, 0) == generation:
+                self._docs[name] = (time.monotonic(), data)
+            elif name in self._docs:
+                # A listener delivered a newer snapshot while we were reading — keep and return it
+                data = self._docs[name][1]
+        self._watch(name)
+        return dict(data) if data is not None else None
+
+    def invalidate(self, name: str):
+        """Drop a cached doc so the next read goes to Firestore (call after writing it)."""
+        with self._lock:
+            self._generations[name] = self._generations.get(name, 0) + 1
+            if self._docs.pop(name, None) is not None:
+                self.invalidations += 1
+
+    def _watch(self, name: str):
+        if not self.listeners:
+            return
+        with self._lock:
+            if name in self._watches:
+                return
+            self._watches[name] = None  # reserve, so concurrent misses start one listener
+        try:
+            watch = _db.collection(CONFIG_COLLECTION).document(name).on_snapshot(
+                lambda docs, changes, read_time: self._on_snapshot(name, docs)
+            )
+        except Exception as e:
+            logger.warning(f"[FIRESTORE] Config listener for '{name}' failed, relying on TTL: {e}")
+            return
+        with self._lock:
+            self._watches[name] = watch
+
+    def _on_snapshot(self, name: str, docs: list):
+        data = docs[0].to_dict() if docs and docs[0].exists else None
+        with self._lock:
+            self._docs[name] = (time.monotonic(), data)
+            self._generations[name] = self._generations.get(name, 0) + 1
+            self._listened.add(name)
+            self.listener_updates += 1
+
+    def close(self):
+        """Stop all snapshot listeners."""
+        with self._lock:
+            watches, self._watches = list(self._watches.values()), {}
+            self._listened.clear()  # entries expire by TTL again
+        for watch in watches:
+            if watch is not None:
+                watch.unsubscribe()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "ttl_seconds": self.ttl_seconds,
+                "listeners": sorted(name for name, watch in self._watches.items() if watch is not None),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "listener_updates": self.listener_updates,
+                # seconds since each cached doc was last read or pushed by its listener
+                "staleness_seconds": {name: round(now - fetched, 3) for name, (fetched, _) in self._docs.items()},
+            }
+
+
+config_cache = ConfigDocCache()
+
 
 # ──────────────────────────────────────────────
 # Settings helpers
@@ -54,15 +179,16 @@ DATAMARTS_COLLECTION = "prompt_to_viz_datamarts"
 
 def get_settings() -> dict:
     """Get global settings (default_daily_limit, etc.)."""
-    doc = _db.collection(CONFIG_COLLECTION).document("settings").get()
-    if doc.exists:
-        return doc.to_dict()
+    settings = config_cache.get("settings")
+    if settings is not None:
+        return settings
     return {"default_daily_limit": 100_000}
 
 
 def update_settings(data: dict) -> None:
     """Update global settings (merge)."""
     _db.collection(CONFIG_COLLECTION).document("settings").set(data, merge=True)
+    config_cache.invalidate("settings")
 
 
 # ──────────────────────────────────────────────
@@ -72,15 +198,16 @@ def update_settings(data: dict) -> None:
 
 def get_admins() -> list[str]:
     """Get list of admin emails."""
-    doc = _db.collection(CONFIG_COLLECTION).document("admins").get()
-    if doc.exists:
-        return doc.to_dict().get("emails", [])
+    admins = config_cache.get("admins")
+    if admins is not None:
+        return admins.get("emails", [])
     return []
 
 
 def set_admins(emails: list[str]) -> None:
     """Overwrite the admin list."""
     _db.collection(CONFIG_COLLECTION).document("admins").set({"emails": emails})
+    config_cache.invalidate("admins")
 
 
 # ──────────────────────────────────────────────
@@ -128,6 +255,20 @@ def get_all_datamarts() -> dict[str, list[str]]:
     return {doc.id: doc.to_dict().get("allowed_users", []) for doc in docs}
 
 
+def get_datamarts_for_dataset(dataset: str) -> dict[str, list[str]]:
+    """Get every datamart of one dataset in a single query. Returns {dataset.table: [allowed_emails]}."""
+    collection = _db.collection(DATAMARTS_COLLECTION)
+    # Keys are "<dataset>.<table>"; "\uf8ff" sorts after every character of a table name,
+    # so this ID range is exactly the dataset's tables (bounds must be valid IDs — no "/")
+    docs = (
+        collection
+        .where(FieldPath.document_id(), ">=", collection.document(f"{dataset}."))
+        .where(FieldPath.document_id(), "<", collection.document(f"{dataset}.\uf8ff"))
+        .stream()
+    )
+    return {doc.id: doc.to_dict().get("allowed_users", []) for doc in docs}
+
+
 def get_datamart(key: str) -> list[str] | None:
     """Get allowed users for a specific datamart key (dataset.table)."""
     doc = _db.collection(DATAMARTS_COLLECTION).document(key).get()
@@ -137,20 +278,131 @@ def get_datamart(key: str) -> list[str] | None:
 
 
 def set_datamart(key: str, allowed_users: list[str]) -> None:
-    """Create or update a datamart access list."""
-    _db.collection(DATAMARTS_COLLECTION).document(key).set(
-        {"allowed_users": allowed_users}
-    )
+    """Create or update a datamart access list, updating the per-user index in the same transaction."""
+    ref = _db.collection(DATAMARTS_COLLECTION).document(key)
+    transaction = _db.transaction()
+
+    @firestore.transactional
+    def _set(txn, doc_ref):
+        doc = doc_ref.get(transaction=txn)
+        old_users = {u.lower() for u in doc.to_dict().get("allowed_users", [])} if doc.exists else set()
+        new_users = {u.lower() for u in allowed_users}
+
+        txn.set(doc_ref, {"allowed_users": allowed_users})
+        for email in new_users - old_users:
+            txn.set(_user_index_ref(email), {"tables": firestore.ArrayUnion([key])}, merge=True)
+        for email in old_users - new_users:
+            txn.set(_user_index_ref(email), {"tables": firestore.ArrayRemove([key])}, merge=True)
+
+    _set(transaction, ref)
 
 
 def delete_datamart(key: str) -> bool:
-    """Delete a datamart access doc. Returns True if it existed."""
+    """Delete a datamart access doc and its per-user index entries. Returns True if it existed."""
     ref = _db.collection(DATAMARTS_COLLECTION).document(key)
-    doc = ref.get()
-    if doc.exists:
-        ref.delete()
+    transaction = _db.transaction()
+
+    @firestore.transactional
+    def _delete(txn, doc_ref):
+        doc = doc_ref.get(transaction=txn)
+        if not doc.exists:
+            return False
+        txn.delete(doc_ref)
+        for email in {u.lower() for u in doc.to_dict().get("allowed_users", [])}:
+            txn.set(_user_index_ref(email), {"tables": firestore.ArrayRemove([key])}, merge=True)
         return True
-    return False
+
+    return _delete(transaction, ref)
+
+
+# ──────────────────────────────────────────────
+# Per-user datamart index helpers
+# ──────────────────────────────────────────────
+
+
+def _user_index_ref(email: str):
+    return _db.collection(USER_DATAMARTS_COLLECTION).document(email.lower())
+
+
+def datamart_index_built() -> bool:
+    """True once rebuild_datamart_index.py --fix has written every user's index doc."""
+    return bool((config_cache.get("datamart_index") or {}).get("built"))
+
+
+def mark_datamart_index_built() -> None:
+    """Record that the index is complete, so ACL checks start reading it."""
+    _db.collection(CONFIG_COLLECTION).document("datamart_index").set(
+        {"built": True, "built_at": firestore.SERVER_TIMESTAMP}
+    )
+    config_cache.invalidate("datamart_index")
+
+
+def get_user_datamarts(email: str) -> list[str] | None:
+    """
+    Get the datamart keys (dataset.table) a user is listed on.
+
+    Returns None if the index has not been built yet, or if the user has no
+    index doc (never granted anything). Before the build, grants and revokes
+    already create index docs holding only the tables they touched, so those
+    docs are not trusted until the rebuild tool has rewritten them.
+    """
+    if not datamart_index_built():
+        return None
+    doc = _user_index_ref(email).get()
+    if doc.exists:
+        return doc.to_dict().get("tables", [])
+    return None
+
+
+def get_all_user_datamarts() -> dict[str, list[str]]:
+    """Get the whole per-user index. Returns {email: [dataset.table]}."""
+    docs = _db.collection(USER_DATAMARTS_COLLECTION).stream()
+    return {doc.id: doc.to_dict().get("tables", []) for doc in docs}
+
+
+def rebuild_user_datamarts(email: str, listed_as: list[str] | None = None) -> list[str]:
+    """
+    Rewrite one user's index doc from the access lists, in one transaction
+    (used by the rebuild tool). Returns the user's datamart keys.
+
+    `listed_as` are the spellings of the email found in access lists (they
+    are not always lower-case); the doc is deleted when nothing lists the user.
+    """
+    email = email.lower()
+    spellings = sorted({email, *(listed_as or [])})[:30]  # array_contains_any takes up to 30 values
+    query = _db.collection(DATAMARTS_COLLECTION).where("allowed_users", "array_contains_any", spellings)
+    transaction = _db.transaction()
+
+    @firestore.transactional
+    def _rebuild(txn):
+        tables = sorted(doc.id for doc in query.stream(transaction=txn))
+        if tables:
+            txn.set(_user_index_ref(email), {"tables": tables})
+        else:
+            txn.delete(_user_index_ref(email))
+        return tables
+
+    return _rebuild(transaction)
+
+
+def remove_user_from_datamarts(email: str) -> list[str]:
+    """
+    Remove a user from every datamart access list and drop their index doc,
+    in one transaction. Returns the datamart keys the user was removed from.
+    """
+    email = email.lower()
+    query = _db.collection(DATAMARTS_COLLECTION).where("allowed_users", "array_contains", email)
+    transaction = _db.transaction()
+
+    @firestore.transactional
+    def _remove(txn):
+        docs = list(query.stream(transaction=txn))
+        for doc in docs:
+            txn.update(doc.reference, {"allowed_users": firestore.ArrayRemove([email])})
+        txn.delete(_user_index_ref(email))
+        return [doc.id for doc in docs]
+
+    return _remove(transaction)
 
 
 # ──────────────────────────────────────────────
@@ -161,17 +413,13 @@ def delete_datamart(key: str) -> bool:
 def get_allowed_datasets() -> list[str]:
     """Get the list of allowed BigQuery dataset names."""
     try:
-        doc = _db.collection(CONFIG_COLLECTION).document("allowed_datasets").get()
-        if doc.exists:
-            data = doc.to_dict()
-            datasets = data.get("datasets", [])
-            logger.info(f"[FIRESTORE] get_allowed_datasets: doc exists, raw data={data}, datasets={datasets}")
-            return datasets
-        else:
-            logger.info("[FIRESTORE] get_allowed_datasets: doc does NOT exist, using fallback")
-            return ["pis", "igr", "kingpack"]
+        data = config_cache.get("allowed_datasets")
+        if data is not None:
+            return data.get("datasets", [])
+        logger.debug("[FIRESTORE] get_allowed_datasets: doc does NOT exist, using fallback")
+        return ["pis", "igr", "kingpack"]
     except Exception as e:
-        logger.info(f"[FIRESTORE] get_allowed_datasets ERROR: {e}")
+        logger.warning(f"[FIRESTORE] get_allowed_datasets ERROR: {e}")
         # Fallback so the app doesn't crash
         return ["pis", "igr", "kingpack"]
 
@@ -181,51 +429,66 @@ def set_allowed_datasets(datasets: list[str]) -> None:
     _db.collection(CONFIG_COLLECTION).document("allowed_datasets").set(
         {"datasets": datasets}
     )
+    config_cache.invalidate("allowed_datasets")
 
 
 # ──────────────────────────────────────────────
-# Transactional token consumption
+# Sharded token usage counters
 # ──────────────────────────────────────────────
 
+# A user's daily usage is the sum of USAGE_SHARDS counter docs under
+# prompt_to_viz_users/{email}/usage_shards/{date}_{n}. Each consumption is a
+# blind increment of one random shard, so concurrent requests of the same user
+# (on any instance) neither contend on a transaction nor retry, while every
+# instance still reads the same total. The total is read as one sum
+# aggregation over the day's shards, billed as a single document read.
+# Shards carry `expire_at`; configure a Firestore TTL policy on
+# usage_shards.expire_at to delete old days.
+USAGE_SHARDS = int(os.getenv("USAGE_SHARDS", "10"))
+USAGE_SHARDS_SUBCOLLECTION = "usage_shards"
+USAGE_SHARD_RETENTION_DAYS = int(os.getenv("USAGE_SHARD_RETENTION_DAYS", "7"))
 
-def consume_tokens_transactional(email: str, amount: int) -> dict:
-    """
-    Atomically consume tokens for a user using a Firestore transaction.
 
-    Returns the updated user data dict.
-    Raises ValueError if user not found or quota exceeded.
-    """
-    from datetime import date
+def _usage_shards(email: str):
+    return _db.collection(USERS_COLLECTION).document(email.lower()).collection(USAGE_SHARDS_SUBCOLLECTION)
 
-    ref = _db.collection(USERS_COLLECTION).document(email.lower())
-    transaction = _db.transaction()
-
-    @firestore.transactional
-    def _consume(txn, doc_ref):
-        doc = doc_ref.get(transaction=txn)
-        if not doc.exists:
-            raise ValueError(f"User {email} is not registered for token quota.")
 
-        data = doc.to_dict()
-        today = date.today().isoformat()
+def _usage_shard_refs(email: str, day: str) -> list:
+    shards = _usage_shards(email)
+    return [shards.document(f"{day}_{n}") for n in range(USAGE_SHARDS)]
 
-        # Reset if new day
-        if data.get("usage_date") != today:
-            data["usage_date"] = today
-            data["used_today"] = 0
 
-        settings = get_settings()
-        limit = data.get("daily_limit", settings.get("default_daily_limit", 100_000))
-        current_used = data.get("used_today", 0)
+def get_token_usage(email: str, day: str) -> int:
+    """Sum of a user's usage shards for `day` (ISO date): one aggregation query, billed as one read."""
+    query = _usage_shards(email).where(filter=firestore.FieldFilter("date", "==", day)).sum("used", alias="used")
+    results = query.get()
+    return int(results[0][0].value or 0) if results else 0
 
-        if current_used >= limit:
-            raise ValueError(
-                f"Daily token quota exceeded. Used: {current_used:,} / Limit: {limit:,}. "
-                f"Quota resets tomorrow."
-            )
 
-        data["used_today"] = current_used + amount
-        txn.set(doc_ref, data)
-        return data
+def get_token_usage_many(emails: list[str], day: str) -> dict[str, int]:
+    """
+    Sum of each user's usage shards for `day`, in one batched read. Returns {email: tokens}.
 
-    return _consume(transaction, ref)
+    For admin listings: every shard ID is read (USAGE_SHARDS per user), which
+    costs more reads than `get_token_usage` but a single round trip.
+    """
+    totals = {email.lower(): 0 for email in emails}
+    refs = [ref for email in totals for ref in _usage_shard_refs(email, day)]
+    if not refs:
+        return totals
+    for doc in _db.get_all(refs):
+        if doc.exists:
+            # .../prompt_to_viz_users/{email}/usage_shards/{shard}
+            totals[doc.reference.parent.parent.id] += doc.to_dict().get("used", 0)
+    return totals
+
+
+def add_token_usage(email: str, amount: int, day: str) -> None:
+    """Add `amount` tokens to one random usage shard of `day` (no transaction, no read)."""
+    ref = random.choice(_usage_shard_refs(email, day))
+    expire_at = datetime.combine(date.fromisoformat(day), datetime.min.time(), tzinfo=timezone.utc)
+    ref.set({
+        "date": day,
+        "used": firestore.Increment(amount),
+        "expire_at": expire_at + timedelta(days=USAGE_SHARD_RETENTION_DAYS),
+    }, merge=True)
@@ -0,0 +1,210 @@
+"""
+History Compactor — bounds the conversation history sent to the model.
+
+The last HISTORY_VERBATIM_TURNS turns (user + assistant message pairs) are
+kept verbatim, except that chart JSON loses its `data` array (the agent
+re-queries instead). Older assistant messages that carry chart JSON are
+replaced by a one-line summary (chart type, title, axes, row count and the
+query expression when present). Plain-text messages — the web client sends
+a chart's insight, not its JSON — are kept as they are. Above
+HISTORY_MAX_TOKENS, verbatim charts are summarized too, then the oldest
+messages are dropped and, as a last resort, long plain-text messages are
+shortened; JSON is never cut mid-document.
+
+Reused ADK conversation sessions replay their own events instead of a
+client-sent history; `compact_session_contents` runs before each model call,
+replaces the records of `query_data` responses from earlier turns with their
+row count and drops the oldest earlier turns above HISTORY_MAX_TOKENS.
+
+Token counts are estimated at ~4 characters per token, the same estimate
+used for schema summaries.
+"""
+import json
+import os
+from typing import Any
+
+HISTORY_VERBATIM_TURNS = int(os.getenv("HISTORY_VERBATIM_TURNS", "2"))
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "2000"))
+
+# Keys under which clients may send the expression that produced a chart
+_EXPRESSION_KEYS = ("query", "operation", "expression")
+
+
+def estimate_tokens(history: list[dict]) -> int:
+    return sum(len(str(msg.get("content", ""))) for msg in history) // 4
+
+
+def _as_chart(content: Any) -> dict | None:
+    """Return the chart payload in a message's content, or None for plain text."""
+    if isinstance(content, dict):
+        return content if "chart_config" in content or "chart_type" in content else None
+    if not isinstance(content, str) or "{" not in content:
+        return None
+    text = content.strip()
+    try:
+        parsed = json.loads(text[text.find("{"):text.rfind("}") + 1])
+    except ValueError:
+        return None
+    return parsed if isinstance(parsed, dict) and ("chart_config" in parsed or "chart_type" in parsed) else None
+
+
+def summarize_chart(chart: dict, message: dict | None = None) -> str:
+    """One-line summary of a chart payload: type, title, axes, rows and expression."""
+    config = chart.get("chart_config") or {}
+    parts = [f"[{chart.get('chart_type', 'chart')} chart"]
+    if config.get("title"):
+        parts.append(f" '{config['title']}'")
+    if config.get("x_field") or config.get("y_field"):
+        parts.append(f" of {config.get('y_field', '')} by {config.get('x_field', '')}")
+    if isinstance(config.get("data"), list):
+        parts.append(f", {len(config['data'])} rows")
+    expression = next((src[k] for src in (message or {}, chart) for k in _EXPRESSION_KEYS if src.get(k)), None)
+    if expression:
+        parts.append(f"; query: {expression}")
+    parts.append("]")
+    if chart.get("insight"):
+        parts.append(f" {chart['insight']}")
+    return "".join(parts)
+
+
+def _without_records(chart: dict) -> dict:
+    """The chart payload with `chart_config.data` replaced by its row count."""
+    config = chart.get("chart_config")
+    if not isinstance(config, dict) or not isinstance(config.get("data"), list):
+        return chart
+    return {**chart, "chart_config": {**config, "data": f"[{len(config['data'])} rows omitted]"}}
+
+
+def compact_history(
+    history: list[dict] | None,
+    verbatim_turns: int = HISTORY_VERBATIM_TURNS,
+    max_tokens: int = HISTORY_MAX_TOKENS,
+) -> tuple[list[dict], int]:
+    """Return (compacted history, estimated tokens saved)."""
+    if not history:
+        return [], 0
+
+    before = estimate_tokens(history)
+    keep_from = max(len(history) - 2 * verbatim_turns, 0)
+
+    compacted = []
+    verbatim_charts = []  # (index, chart) of charts kept as JSON
+    for i, msg in enumerate(history):
+        content = msg.get("content")
+        chart = _as_chart(content)
+        if chart is not None and i < keep_from:
+            content = summarize_chart(chart, msg)
+        elif chart is not None:
+            content = json.dumps(_without_records(chart), default=str)
+            verbatim_charts.append((i, chart))
+        compacted.append({"role": msg.get("role"), "content": content})
+
+    # Over budget: summarize the verbatim charts as well, oldest first
+    for i, chart in verbatim_charts:
+        if estimate_tokens(compacted) <= max_tokens:
+            break
+        compacted[i]["content"] = summarize_chart(chart, history[i])
+
+    # Then drop the oldest messages, keeping the verbatim tail
+    dropped = 0
+    while estimate_tokens(compacted) > max_tokens and len(compacted) > 2 * verbatim_turns:
+        compacted.pop(0)
+        dropped += 1
+    if dropped:
+        compacted.insert(0, {"role": "user", "content": f"[{dropped} earlier messages omitted]"})
+
+    # Still over budget: shorten long plain-text messages, longest first (JSON is left whole)
+    while estimate_tokens(compacted) > max_tokens:
+        texts = [m for m in compacted if isinstance(m["content"], str) and len(m["content"]) > 200 and _as_json(m["content"]) is None]
+        if not texts:
+            break
+        longest = max(texts, key=lambda m: len(m["content"]))
+        longest["content"] = longest["content"][: len(longest["content"]) // 2] + " …[truncated]"
+
+    return compacted, max(before - estimate_tokens(compacted), 0)
+
+
+def _as_json(text: str) -> Any:
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+# ──────────────────────────────────────────────
+# ADK session contents
+# ──────────────────────────────────────────────
+
+def _starts_turn(content) -> bool:
+    """A user message typed by the user (function responses are also sent as role 'user')."""
+    parts = content.parts or []
+    return content.role == "user" and any(p.text for p in parts) and not any(p.function_response for p in parts)
+
+
+def _content_tokens(content) -> int:
+    size = 0
+    for part in content.parts or []:
+        if part.text:
+            size += len(part.text)
+        elif part.function_call is not None:
+            size += len(json.dumps(part.function_call.args or {}, default=str))
+        elif part.function_response is not None:
+            size += len(json.dumps(part.function_response.response or {}, default=str))
+    return size // 4
+
+
+def compact_session_contents(contents: list, max_tokens: int = HISTORY_MAX_TOKENS) -> tuple[list, int]:
+    """
+    Return (contents, estimated tokens saved) for one model call of a reused session.
+
+    Earlier turns' query_data records are omitted (`strip_earlier_results`).
+    If the earlier turns still exceed `max_tokens`, whole turns are dropped,
+    oldest first, so every function call keeps its response. The current
+    turn is never touched.
+    """
+    before = sum(_content_tokens(c) for c in contents)
+    contents, _ = strip_earlier_results(contents)
+
+    starts = [i for i, c in enumerate(contents) if _starts_turn(c)]
+    current = starts[-1] if starts else 0
+    earlier = sum(_content_tokens(c) for c in contents[:current])
+    cut, dropped = 0, 0
+    for start in starts[1:]:
+        if earlier <= max_tokens:
+            break
+        earlier -= sum(_content_tokens(c) for c in contents[cut:start])
+        cut, dropped = start, dropped + 1
+    if dropped:
+        first = contents[cut]
+        note = type(first.parts[0])(text=f"[{dropped} earlier turns omitted]")
+        contents = [first.model_copy(update={"parts": [note, *first.parts]}), *contents[cut + 1:]]
+    return contents, max(before - sum(_content_tokens(c) for c in contents), 0)
+
+
+def strip_earlier_results(contents: list) -> tuple[list, int]:
+    """
+    Return (contents, estimated tokens saved) with earlier turns' query_data records omitted.
+
+    Contents are genai `Content` objects as assembled for a model call from
+    the session's events. Responses before the current turn's user message
+    keep their row_count, result_id and error; their `data` is replaced.
+    Changed contents are copies, so the stored session events are untouched.
+    """
+    current = max((i for i, c in enumerate(contents) if _starts_turn(c)), default=0)
+    saved = 0
+    stripped = list(contents)
+    for i, content in enumerate(contents[:current]):
+        parts, changed = [], False
+        for part in content.parts or []:
+            response = part.function_response
+            if response is not None and response.name == "query_data" and isinstance((response.response or {}).get("data"), list):
+                records = response.response["data"]
+                summary = {k: v for k, v in response.response.items() if k != "data"}
+                summary["data"] = f"[{len(records)} rows omitted — call query_data again to use them]"
+                saved += (len(json.dumps(records, default=str)) - len(summary["data"])) // 4
+                part = part.model_copy(update={"function_response": response.model_copy(update={"response": summary})})
+                changed = True
+            parts.append(part)
+        if changed:
+            stripped[i] = content.model_copy(update={"parts": parts})
+    return stripped, max(saved, 0)
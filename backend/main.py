@@ -5,27 +5,40 @@ Exposes /api/visualize endpoint that accepts a prompt + JSON data or BigQuery ta
 runs the Google ADK visualization agent via InMemoryRunner,
 and returns chart config + insight.
 """
+import asyncio
+import hashlib
 import json
 import os
 import re
 import secrets
+import time
 import uuid
 from datetime import datetime
+from typing import Any, AsyncIterator
 
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Depends, Request
+from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
 
 from google.adk.runners import InMemoryRunner
+from agent_sessions import AgentSessionRegistry
 
 from google import genai
 from google.genai import types
 
 from agent import root_agent
+from chart_picker import pick_chart
+from history_compactor import compact_history
+import duckdb_engine
 from data_manager import data_manager
 from bq_client import bq
-from firestore_config import get_allowed_datasets
+from snapshot_cache import snapshot_cache
+from conversation_store import conversation_store
+from query_executor import query_executor
+from table_loader import get_table_metadata, load_table, schema_from_metadata, make_pushdown_runner
+from firestore_config import get_allowed_datasets, config_cache
 from auth import (
     build_lark_auth_url,
     exchange_code_for_token,
@@ -53,10 +66,10 @@ from models import (
     UpdateDatamartAccessRequest,
 )
 from token_quota import (
-    get_quota_info, consume_tokens, is_registered,
+    get_quota_info, consume_tokens, is_registered, reserve_tokens, release_tokens, TokenReservation,
     is_admin, get_all_quota_settings, update_user_quota, remove_user_quota,
     set_admin_role, get_all_datamarts, sync_datamarts, update_datamart_access, 
-    has_datamart_access
+    has_datamart_access, accessible_tables, UserContext, get_user_context
 )
 from lark_contacts import fetch_all_org_users, fetch_org_hierarchy
 
@@ -81,6 +94,26 @@ app = FastAPI(
     version="1.0.0",
 )
 
+# Evaluate agent pandas expressions in the worker pool instead of in-process
+data_manager.executor = query_executor
+
+
+@app.on_event("startup")
+def start_query_executor():
+    # Spawn and warm the workers now, so no query waits for a process to start
+    query_executor.start()
+
+
+@app.on_event("shutdown")
+def shutdown_query_executor():
+    query_executor.shutdown()
+
+
+@app.on_event("shutdown")
+def shutdown_config_cache():
+    config_cache.close()
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -99,10 +132,26 @@ runner = InMemoryRunner(
     app_name=APP_NAME
 )
 
+# Per-request sessions are deleted after use; conversation sessions are reused and GC'd
+agent_sessions = AgentSessionRegistry(runner.session_service, APP_NAME)
+
 
 # Initialize GenAI client for token counting
 client = genai.Client()
 
+# Pipelines accepted in VisualizeRequest.mode:
+#   agent      — open-ended ADK agent loop (default)
+#   fast       — one query-generation call, local execution, one formatting call
+#   fast_local — one query-generation call, local execution, heuristic chart picker
+PIPELINE_MODES = ["agent", "fast", "fast_local"]
+
+# Put a compact schema summary in the agent's first message (saves the get_data_schema turn).
+# VisualizeRequest.inject_schema overrides this per request.
+SCHEMA_PREINJECTION = os.getenv("SCHEMA_PREINJECTION", "true").lower() in ("1", "true", "yes")
+
+# Engines accepted in VisualizeRequest.engine ("bigquery" only applies to table mode)
+QUERY_ENGINES = ["pandas", "bigquery", "duckdb"]
+
 
 QUERY_GEN_PROMPT = """\
 You are a senior data analyst. Given a table schema and a user question, produce a single-line pandas expression that answers the question.
@@ -121,6 +170,9 @@ Rules:
 Schema:
 {schema}
 
+Conversation history:
+{history}
+
 User question: {question}
 
 Output (single-line pandas expression only):
@@ -141,7 +193,6 @@ Return ONLY a valid JSON object (no markdown fences, no extra text):
     "chart_config": {{
         "x_field": "<the x-axis column name>",
         "y_field": "<the y-axis column name>",
-        "data": <paste the exact query results list here>,
         "title": "<descriptive title>",
         "x_label": "<x axis label>",
         "y_label": "<y axis label>"
@@ -158,16 +209,15 @@ Chart type selection rules (IMPORTANT):
 
 Other rules:
 - x_field and y_field must be actual column names from the query results
-- data must be the EXACT query results provided above — do NOT change any values
+- Do NOT copy the query results into your answer — the server attaches them to the chart
 """
 
+# Expression attempts in fast mode (the second one sees the first one's error)
+FAST_QUERY_ATTEMPTS = 2
 
-async def run_agent_pipeline(prompt: str, data_id: str, history: list[dict] = None) -> tuple[str, TokenUsage]:
-    """
-    Stateful pipeline using Google ADK Agent.
-    """
-    os.environ["GOOGLE_GENAI_USE_VERTEXAI"] = "TRUE"
 
+async def build_agent_message(prompt: str, data_id: str, history: list[dict] | None, inject_schema: bool) -> str:
+    """Compose the agent's user message: data_id, optional schema summary, history transcript and the request."""
     # Reconstruct history transcript to embed in the prompt for stateless context awareness
     history_context = ""
     if history:
@@ -175,9 +225,17 @@ async def run_agent_pipeline(prompt: str, data_id: str, history: list[dict] = No
             role = "User" if msg.get("role") == "user" else "Assistant"
             history_context += f"{role}: {msg.get('content')}\n\n"
 
-    # Compound input for the agent
-    user_input = f"""data_id: {data_id}
+    schema_context = ""
+    if inject_schema:
+        summary = await asyncio.to_thread(data_manager.schema_summary, data_id)
+        schema_context = f"""
+### DATA SCHEMA (already inspected — do not call get_data_schema unless a column you need is missing)
+{json.dumps(summary, default=str)}
+"""
 
+    # Compound input for the agent
+    return f"""data_id: {data_id}
+{schema_context}
 ### NOTE ON DATA TYPES
 - All date/time columns have ALREADY been converted to pandas datetime objects.
 - Use them directly: `df[df['posting_date'] > ...]` is valid. 
@@ -192,36 +250,55 @@ async def run_agent_pipeline(prompt: str, data_id: str, history: list[dict] = No
 ### CURRENT USER REQUEST
 {prompt}
 """
-    
-    try:
-        # Create a unique session for this request
-        # We use the runner's internal session_service to avoid extra imports
-        sid = f"session_{uuid.uuid4().hex[:8]}"
-        uid = "user_default"
-        
-        # Await session creation (InMemoryRunner's service is async)
-        await runner.session_service.create_session(user_id=uid, session_id=sid, app_name=APP_NAME)
 
-        
+
+async def agent_event_stream(
+    prompt: str,
+    data_id: str,
+    history: list[dict] = None,
+    inject_schema: bool = SCHEMA_PREINJECTION,
+    user_id: str = "user_default",
+    conversation_id: str | None = None,
+) -> AsyncIterator[dict]:
+    """
+    Run the Google ADK agent and yield pipeline stage events as they happen.
+
+    Yields `{"event": "tool_call", ...}` for every tool invocation,
+    `{"event": "tool_result", ...}` for every tool response (with the records
+    of `query_data` results) and finally
+    `{"event": "agent_response", "raw": <final text>, "token_usage": TokenUsage,
+    "results": {result_id: records}}`, where `results` holds every successful
+    `query_data` result in call order for server-side injection.
+    With `inject_schema`, a token-budgeted schema summary is included in the
+    first message so the agent can skip `get_data_schema`.
+    With `conversation_id`, the conversation's ADK session is reused and
+    `history`/schema are only sent on its first turn.
+    Errors are raised to the caller.
+    """
+    os.environ["GOOGLE_GENAI_USE_VERTEXAI"] = "TRUE"
+
+    async with agent_sessions.session(user_id, conversation_id) as (sid, fresh):
+        # A reused conversation session already holds the earlier turns (and the schema)
+        user_input = await build_agent_message(prompt, data_id, history if fresh else None, inject_schema and fresh)
+
         # Run the agent using keyword-only arguments as per signature
-        from google.genai import types
-        
-        events = runner.run(
-            user_id=uid,
+        events = runner.run_async(
+            user_id=user_id,
             session_id=sid,
             new_message=types.Content(role="user", parts=[types.Part(text=user_input)])
         )
 
-
-        
         raw_json = ""
         last_text = ""
+        results: dict[str, list[dict]] = {}
         prompt_tokens = 0
         completion_tokens = 0
-        
-        for event in events:
+        model_turns = 0
+    
+        async for event in events:
             # Capture token usage if present
             if hasattr(event, "usage_metadata") and event.usage_metadata:
+                model_turns += 1
                 usage = event.usage_metadata
                 prompt_tokens = usage.prompt_token_count or prompt_tokens
                 completion_tokens = usage.candidates_token_count or completion_tokens
@@ -239,7 +316,13 @@ async def run_agent_pipeline(prompt: str, data_id: str, history: list[dict] = No
                         logger.info(f"  [PART {i} TEXT] {part.text[:200]}...")
                     if part.function_call:
                         logger.info(f"  [PART {i} TOOL CALL] {part.function_call.name}({part.function_call.args})")
-            
+                        yield {"event": "tool_call", "name": part.function_call.name, "args": dict(part.function_call.args or {})}
+                    if part.function_response:
+                        response = part.function_response.response or {}
+                        if part.function_response.name == "query_data" and response.get("result_id"):
+                            results[response["result_id"]] = response["data"]
+                        yield {"event": "tool_result", "name": part.function_response.name, "response": response}
+        
             # Check for errors
             if hasattr(event, 'errors') and event.errors:
                 logger.error(f"[ADK ERROR EVENT] {event.errors}")
@@ -252,38 +335,186 @@ async def run_agent_pipeline(prompt: str, data_id: str, history: list[dict] = No
                          last_text = part.text # Fallback tracker
                          if getattr(event, 'is_final_response', lambda: False)(): # Safely call is_final_response
                             raw_json = part.text
-        
-        if not raw_json:
-            if last_text:
-                logger.warning("[ADK WARNING] No final response detected in event stream, using last generated text as fallback.")
-                raw_json = last_text
-            else:
-                logger.error("[ADK ERROR] No final response detected in event stream, and no fallback text available.")
-                raise ValueError("No text response from agent. Check backend logs for event stream.")
 
+    if not raw_json:
+        if last_text:
+            logger.warning("[ADK WARNING] No final response detected in event stream, using last generated text as fallback.")
+            raw_json = last_text
+        else:
+            logger.error("[ADK ERROR] No final response detected in event stream, and no fallback text available.")
+            raise ValueError("No text response from agent. Check backend logs for event stream.")
+
+    token_usage = TokenUsage(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+        agent_turns=max(model_turns, 1)
+    )
+    # A reused session was not sent `history` — its own events were compacted by the agent callback
+    yield {"event": "agent_response", "raw": raw_json, "token_usage": token_usage, "results": results, "history_sent": fresh}
 
-        
-        token_usage = TokenUsage(
-            prompt_tokens=prompt_tokens,
-            completion_tokens=completion_tokens,
-            total_tokens=prompt_tokens + completion_tokens,
-            agent_turns=1
+
+def _strip_expression(text: str) -> str:
+    """Remove fences, quotes and a leading `python`/`Output:` the model may add around an expression."""
+    cleaned = re.sub(r"^```(?:python)?\s*|\s*```$", "", (text or "").strip())
+    cleaned = re.sub(r"^(?:Output|Expression)\s*:\s*", "", cleaned.strip(), flags=re.IGNORECASE)
+    cleaned = cleaned.strip().strip("`")
+    if len(cleaned) > 1 and cleaned[0] == cleaned[-1] and cleaned[0] in "\"'":
+        cleaned = cleaned[1:-1]
+    return " ".join(line.strip() for line in cleaned.splitlines() if line.strip())
+
+
+async def fast_event_stream(
+    prompt: str, data_id: str, history: list[dict] = None, local_chart: bool = False
+) -> AsyncIterator[dict]:
+    """
+    Deterministic two-call pipeline built on QUERY_GEN_PROMPT and CHART_FORMAT_PROMPT.
+
+    One model call writes the pandas expression, which is executed locally
+    (retrying once with the error when it fails); the chart is then formatted
+    by a second, small model call — or by `pick_chart` when `local_chart` is
+    set. Yields the same events as `agent_event_stream`.
+    """
+    model = root_agent.model
+    config = types.GenerateContentConfig(temperature=0)
+    prompt_tokens = 0
+    completion_tokens = 0
+    model_calls = 0
+
+    async def generate(contents: str, **overrides) -> str:
+        nonlocal prompt_tokens, completion_tokens, model_calls
+        response = await client.aio.models.generate_content(
+            model=model,
+            contents=contents,
+            config=config.model_copy(update=overrides) if overrides else config,
         )
-        
-        return raw_json, token_usage
-        
+        model_calls += 1
+        if response.usage_metadata:
+            prompt_tokens += response.usage_metadata.prompt_token_count or 0
+            completion_tokens += response.usage_metadata.candidates_token_count or 0
+        return response.text or ""
+
+    history_context = "\n".join(
+        f"{'User' if msg.get('role') == 'user' else 'Assistant'}: {msg.get('content')}" for msg in history or []
+    )
+    schema = await asyncio.to_thread(data_manager.schema_summary, data_id)
+    query_prompt = QUERY_GEN_PROMPT.format(
+        today=datetime.now().strftime('%Y-%m-%d'),
+        schema=json.dumps(schema, default=str),
+        history=history_context or "No previous history.",
+        question=prompt,
+    )
+
+    result: dict = {}
+    attempt_prompt = query_prompt
+    for attempt in range(FAST_QUERY_ATTEMPTS):
+        operation = _strip_expression(await generate(attempt_prompt))
+        logger.info(f"[FAST] Attempt {attempt + 1} expression: {operation}")
+        yield {"event": "tool_call", "name": "query_data", "args": {"data_id": data_id, "operation": operation}}
+
+        result = await asyncio.to_thread(data_manager.query_data, data_id, operation)
+        if isinstance(result.get("data"), list):
+            result = {**result, "result_id": f"r_{uuid.uuid4().hex[:6]}"}
+        yield {"event": "tool_result", "name": "query_data", "response": result}
+        if "error" not in result:
+            break
+        attempt_prompt = (
+            f"{query_prompt}\nYour previous expression:\n{operation}\n"
+            f"failed with: {result['error']}\nReturn a corrected expression.\n"
+        )
+
+    results = {result["result_id"]: result["data"]} if result.get("result_id") else {}
+    if "error" in result:
+        raw_json = json.dumps({"rejected": True, "reject_reason": f"Could not query the data: {result['error']}"})
+    elif not results:
+        raw_json = json.dumps({"rejected": True, "reject_reason": "The query did not return tabular data to chart."})
+    elif local_chart:
+        raw_json = json.dumps(pick_chart(results[result["result_id"]], prompt))
+    else:
+        raw_json = await generate(
+            CHART_FORMAT_PROMPT.format(question=prompt, results=json.dumps(result["data"], default=str)),
+            response_mime_type="application/json",
+        )
+
+    token_usage = TokenUsage(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+        agent_turns=model_calls,
+    )
+    yield {"event": "agent_response", "raw": raw_json, "token_usage": token_usage, "results": results}
+
+
+async def pipeline_event_stream(
+    prompt: str,
+    data_id: str,
+    history: list[dict] = None,
+    mode: str = "agent",
+    inject_schema: bool | None = None,
+    user_id: str = "user_default",
+    conversation_id: str | None = None,
+) -> AsyncIterator[dict]:
+    """Yield the events of the pipeline selected by `mode` (see PIPELINE_MODES), with compacted history."""
+    history, history_tokens_saved = compact_history(history)
+
+    if mode == "fast":
+        stages = fast_event_stream(prompt, data_id, history)
+    elif mode == "fast_local":
+        stages = fast_event_stream(prompt, data_id, history, local_chart=True)
+    else:
+        stages = agent_event_stream(
+            prompt, data_id, history,
+            SCHEMA_PREINJECTION if inject_schema is None else inject_schema,
+            user_id, conversation_id,
+        )
+
+    async for stage in stages:
+        if stage["event"] == "agent_response" and history_tokens_saved and stage.get("history_sent", True):
+            logger.info(f"[HISTORY] Compacted history, ~{history_tokens_saved} tokens saved")
+            stage["token_usage"].history_tokens_saved = history_tokens_saved
+        yield stage
+
+
+async def run_agent_pipeline(
+    prompt: str,
+    data_id: str,
+    history: list[dict] = None,
+    mode: str = "agent",
+    inject_schema: bool | None = None,
+    user_id: str = "user_default",
+    conversation_id: str | None = None,
+) -> tuple[str, TokenUsage, dict[str, list[dict]]]:
+    """
+    Stateful pipeline using Google ADK Agent (or the fast pipeline, see PIPELINE_MODES).
+
+    Returns the raw final response, token usage and the captured
+    `query_data` results (result_id → records).
+    """
+    try:
+        async for stage in pipeline_event_stream(prompt, data_id, history, mode, inject_schema, user_id, conversation_id):
+            if stage["event"] == "agent_response":
+                return stage["raw"], stage["token_usage"], stage["results"]
+        raise ValueError("Agent finished without a response.")
+
     except Exception as e:
         logger.error(f"[AGENT ERROR] {e}")
         return json.dumps({
             "rejected": True,
             "reject_reason": f"Agent error: {str(e)}"
-        }), TokenUsage()
+        }), TokenUsage(), {}
 
 
 
 
-def parse_agent_response(raw: str) -> VisualizeResponse:
-    """Parse the agent's raw JSON response into a structured VisualizeResponse."""
+def parse_agent_response(raw: str, results: dict[str, list[dict]] | None = None) -> VisualizeResponse:
+    """Parse the agent's raw JSON response into a structured VisualizeResponse.
+
+    When `results` (result_id → records captured from `query_data` in this
+    turn) is given, the chart data is injected from the result the agent
+    references via `chart_config.result_id` instead of trusting records
+    echoed by the model. A response without a result_id gets the turn's last
+    result; one citing a result_id this turn did not produce is rejected.
+    """
     import re
 
     cleaned = raw.strip()
@@ -320,6 +551,15 @@ def parse_agent_response(raw: str) -> VisualizeResponse:
     # Validate that the agent actually queried data (not just a stub response)
     chart_config_data = data.get("chart_config", {})
     chart_data = chart_config_data.get("data", [])
+    if results:
+        result_id = chart_config_data.get("result_id") or data.get("result_id")
+        if result_id and result_id not in results:
+            logger.warning(f"[INJECT] Unknown result_id '{result_id}' (this turn produced {list(results)})")
+            return VisualizeResponse(
+                rejected=True,
+                reject_reason="The AI agent referenced a query result it did not produce. Please try again.",
+            )
+        chart_data = results[result_id or list(results)[-1]]
     
     if not chart_config_data or not chart_data:
         logger.warning(f"[VALIDATION] Agent returned response without chart data. Keys present: {list(data.keys())}")
@@ -424,15 +664,22 @@ async def health_check():
 # Protected Endpoints (require Lark SSO)
 # ──────────────────────────────────────────────
 
+async def user_context(user: dict = Depends(get_current_user)) -> UserContext:
+    """
+    Dependency: the signed-in user's Firestore state (user doc, settings,
+    admins, datamart index), read once per request in parallel.
+    """
+    return await asyncio.to_thread(get_user_context, user.get("email", ""))
+
+
 @app.get("/api/quota")
-async def get_user_quota(user: dict = Depends(get_current_user)):
+def get_user_quota(ctx: UserContext = Depends(user_context)):
     """Get the current user's token quota info."""
-    email = user.get("email", "")
-    info = get_quota_info(email)
+    info = get_quota_info(ctx.email, ctx)
     return QuotaInfo(**info)
 
 @app.get("/api/tables", response_model=TableListResponse)
-async def list_tables(dataset: str = "", user: dict = Depends(get_current_user)):
+def list_tables(dataset: str = "", ctx: UserContext = Depends(user_context)):
     """List available BigQuery tables for the given dataset (company)."""
     # Force reload
     allowed = get_allowed_datasets()
@@ -440,13 +687,9 @@ async def list_tables(dataset: str = "", user: dict = Depends(get_current_user))
         raise HTTPException(status_code=400, detail=f"Invalid dataset. Allowed: {allowed}")
     try:
         tables_data = bq.list_tables(dataset)
-        email = user.get("email", "")
-        # Filter tables by ACL
-        tables = [
-            TableInfo(name=t["name"]) 
-            for t in tables_data 
-            if has_datamart_access(email, dataset, t["name"])
-        ]
+        # Filter tables by ACL, answered from the request's user context
+        allowed_tables = accessible_tables(ctx.email, dataset, [t["name"] for t in tables_data], ctx)
+        tables = [TableInfo(name=name) for name in allowed_tables]
         return TableListResponse(dataset=dataset, tables=tables)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to list tables: {str(e)}")
@@ -461,7 +704,7 @@ async def count_tokens(request: VisualizeRequest, user: dict = Depends(get_curre
         text_to_count = f"{request.prompt}\n{json.dumps(request.data)}"
 
     try:
-        response = client.models.count_tokens(
+        response = await client.aio.models.count_tokens(
             model="gemini-2.0-flash",
             contents=text_to_count
         )
@@ -471,26 +714,17 @@ async def count_tokens(request: VisualizeRequest, user: dict = Depends(get_curre
         raise HTTPException(status_code=500, detail=f"Token counting failed: {str(e)}")
 
 
-@app.post("/api/visualize", response_model=VisualizeResponse)
-async def visualize(request: VisualizeRequest, user: dict = Depends(get_current_user)):
-    """
-    Generate a visualization from a user prompt and data.
-
-    Supports two modes:
-    1. JSON mode: request.data contains the JSON array
-    2. BigQuery mode: request.table_name specifies the BQ table
-    """
-    email = user.get("email", "")
-
+async def check_visualize_request(request: VisualizeRequest, ctx: UserContext) -> str:
+    """Validate registration, quota and request fields. Returns the query engine to use."""
     # Check if user is registered for quota
-    if not is_registered(email):
+    if not is_registered(ctx.email, ctx):
         raise HTTPException(
             status_code=403,
             detail="You are not registered to use this service. Please contact the Data Team for access.",
         )
 
     # Check if user has tokens remaining
-    quota_info = get_quota_info(email)
+    quota_info = get_quota_info(ctx.email, ctx)
     if quota_info["remaining"] <= 0:
         raise HTTPException(
             status_code=429,
@@ -500,27 +734,61 @@ async def visualize(request: VisualizeRequest, user: dict = Depends(get_current_
     if not request.prompt.strip():
         raise HTTPException(status_code=400, detail="Prompt cannot be empty")
 
-    table_name = ""
-    data_id = ""
+    if (request.mode or "agent") not in PIPELINE_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid mode. Allowed: {PIPELINE_MODES}")
+
+    engine = request.engine or "pandas"
+    if engine not in QUERY_ENGINES:
+        raise HTTPException(status_code=400, detail=f"Invalid engine. Allowed: {QUERY_ENGINES}")
+    return engine
 
+
+async def reserve_request_tokens(ctx: UserContext) -> TokenReservation:
+    """Hold part of the user's quota for this request. Return it with `release_tokens` unless it is consumed."""
+    reservation = await asyncio.to_thread(reserve_tokens, ctx.email, ctx)
+    if reservation is None:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests in progress. Wait for your current requests to finish.",
+        )
+    return reservation
+
+
+async def register_request_data(request: VisualizeRequest, ctx: UserContext, engine: str) -> tuple[str, int]:
+    """Register the request's data with the DataManager. Returns (data_id, row_count)."""
     if request.table_name:
-        # BigQuery mode — pre-fetch ALL columns into a DataFrame
+        # BigQuery mode — columns are loaded into a DataFrame on demand
         # This way the agent treats it identically to JSON paste mode
         table_name = request.table_name
-        allowed = get_allowed_datasets()
-        dataset = request.dataset or (allowed[0] if allowed else "pis")
+        dataset = await asyncio.to_thread(request_dataset, request)
         
         # Enforce ACL
-        if not has_datamart_access(email, dataset, table_name):
+        if not has_datamart_access(ctx.email, dataset, table_name, ctx):
             raise HTTPException(status_code=403, detail=f"You do not have access to datamart {dataset}.{table_name}")
 
         # Use a UUID so concurrent users requesting the same table don't share/overwrite data
         data_id = f"bq_{dataset}_{table_name}_{uuid.uuid4().hex[:8]}"
 
         try:
-            rows = bq.fetch_all_rows(table_name, dataset)
-            data_manager.store_data_with_id(data_id, rows)
-            logger.info(f"[BQ] Loaded {len(rows)} rows from {dataset}.{table_name}")
+            # Phase 1: only the schema (table metadata, no rows). Columns are
+            # fetched by query_data once the agent's expression names them.
+            metadata = await asyncio.to_thread(get_table_metadata, dataset, table_name)
+
+            def _load_columns(columns: list[str], _ds=dataset, _tbl=table_name, _meta=metadata):
+                # The shared snapshot itself; data_manager stores a shallow copy
+                # so anything the agent does to `df` stays local to this request.
+                return load_table(_ds, _tbl, columns, _meta)
+
+            schema = schema_from_metadata(metadata)
+            data_manager.store_lazy(
+                data_id, schema, _load_columns,
+                version=f"{dataset}.{table_name}@{metadata['version']}",
+                owner=snapshot_cache.held_bytes,
+            )
+            if engine == "bigquery":
+                data_manager.set_pushdown(data_id, make_pushdown_runner(dataset, table_name, metadata))
+            logger.info(f"[BQ] Registered {dataset}.{table_name} ({len(metadata['columns'])} columns, {metadata['num_rows']} rows)")
+            row_count = schema["row_count"]
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to load table data: {str(e)}")
 
@@ -528,39 +796,214 @@ async def visualize(request: VisualizeRequest, user: dict = Depends(get_current_
         # JSON paste mode
         if not isinstance(request.data, list) or len(request.data) == 0:
             raise HTTPException(status_code=400, detail="Data must be a non-empty JSON array")
-        data_id = data_manager.store_data(request.data)
+        data_id = await asyncio.to_thread(data_manager.store_data, request.data)
+        row_count = len(request.data)
 
     else:
         raise HTTPException(status_code=400, detail="Either 'data' or 'table_name' must be provided")
 
+    if engine == "duckdb":
+        data_manager.set_frame_engine(data_id, duckdb_engine.run)
+    return data_id, row_count
+
+
+def request_dataset(request: VisualizeRequest) -> str:
+    """The BigQuery dataset a table request reads: `request.dataset`, else the first allowed one."""
+    if request.dataset:
+        return request.dataset
+    allowed = get_allowed_datasets()
+    return allowed[0] if allowed else "pis"
+
+
+def conversation_source(request: VisualizeRequest, engine: str) -> str:
+    """Identify the data a conversation is about, so a changed table or dataset starts a new one."""
+    if request.table_name:
+        return f"bq:{request_dataset(request)}.{request.table_name}:{engine}"
+    digest = hashlib.sha1(json.dumps(request.data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return f"json:{digest}:{engine}"
+
+
+async def acquire_request_data(
+    request: VisualizeRequest, ctx: UserContext, engine: str
+) -> tuple[str, int]:
+    """
+    Return a data_id pinned for this request and its row count.
+
+    Requests with a `conversation_id` reuse the data the conversation already
+    loaded; otherwise the data is registered (and, for a new conversation,
+    retained by the conversation store). Release with `release_request_data`.
+    """
+    email = ctx.email
+    source = None
+    if request.conversation_id:
+        source = await asyncio.to_thread(conversation_source, request, engine)
+        conversation = conversation_store.acquire(request.conversation_id, email, source)
+        if conversation is not None:
+            if request.table_name:
+                # Same default as register_request_data, so the ACL check never sees an empty dataset
+                dataset = await asyncio.to_thread(request_dataset, request)
+                if not has_datamart_access(email, dataset, request.table_name, ctx):
+                    release_request_data(conversation.data_id)
+                    raise HTTPException(status_code=403, detail=f"You do not have access to datamart {dataset}.{request.table_name}")
+            logger.info(f"[CONVERSATION] Reusing '{conversation.data_id}' for conversation '{request.conversation_id}'")
+            row_count = data_manager.get_schema(conversation.data_id).get("row_count", 0)
+            return conversation.data_id, row_count
+
+    data_id, row_count = await register_request_data(request, ctx, engine)
+    # Keep this request's frame safe from LRU eviction until it finishes
+    data_manager.pin(data_id)
+    if source:
+        conversation_store.add(request.conversation_id, email, source, data_id)
+    return data_id, row_count
+
+
+def release_request_data(data_id: str):
+    """Unpin a request's data; clear it unless a conversation still holds it."""
+    data_manager.unpin(data_id)
+    if not data_manager.is_pinned(data_id):
+        data_manager.clear(data_id)
+
+
+async def finish_visualize_response(
+    raw_response: str,
+    token_usage: TokenUsage,
+    ctx: UserContext,
+    results: dict[str, list[dict]] | None = None,
+    reservation: TokenReservation | None = None,
+) -> VisualizeResponse:
+    """Parse the agent output (injecting captured query results) and charge the tokens it used to the user's quota."""
+    if not raw_response:
+        return VisualizeResponse(
+            rejected=True,
+            reject_reason="The AI agent did not return a response. Please try again.",
+            token_usage=token_usage,
+        )
+
+    response = parse_agent_response(raw_response, results)
+    response.token_usage = token_usage
+
+    # Deduct tokens from quota
     try:
-        raw_response, token_usage = await run_agent_pipeline(request.prompt, data_id, request.history)
+        updated_quota = await asyncio.to_thread(consume_tokens, ctx.email, token_usage.total_tokens, ctx, reservation)
+        response.quota = QuotaInfo(**updated_quota)
+    except ValueError as qe:
+        logger.error(f"[QUOTA] Warning: {qe}")
+
+    return response
 
-        if not raw_response:
-            return VisualizeResponse(
-                rejected=True,
-                reject_reason="The AI agent did not return a response. Please try again.",
-                token_usage=token_usage,
-            )
 
-        response = parse_agent_response(raw_response)
-        response.token_usage = token_usage
+@app.post("/api/visualize", response_model=VisualizeResponse)
+async def visualize(request: VisualizeRequest, ctx: UserContext = Depends(user_context)):
+    """
+    Generate a visualization from a user prompt and data.
 
-        # Deduct tokens from quota
+    Supports two modes:
+    1. JSON mode: request.data contains the JSON array
+    2. BigQuery mode: request.table_name specifies the BQ table
+    """
+    email = ctx.email
+    engine = await check_visualize_request(request, ctx)
+    reservation = await reserve_request_tokens(ctx)
+    try:
+        data_id, _ = await acquire_request_data(request, ctx, engine)
         try:
-            updated_quota = consume_tokens(email, token_usage.total_tokens)
-            response.quota = QuotaInfo(**updated_quota)
-        except ValueError as qe:
-            logger.error(f"[QUOTA] Warning: {qe}")
+            raw_response, token_usage, results = await run_agent_pipeline(
+                request.prompt, data_id, request.history, request.mode or "agent", request.inject_schema,
+                email or "user_default", request.conversation_id,
+            )
+            if request.conversation_id:
+                conversation_store.enforce_budget(request.conversation_id, email)
+            response = await finish_visualize_response(raw_response, token_usage, ctx, results, reservation)
+            return json_response(response)
 
-        return response
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Agent error: {str(e)}")
 
+        finally:
+            release_request_data(data_id)
+    finally:
+        # Returns the reserved tokens if the request ended before they were settled
+        await asyncio.to_thread(release_tokens, reservation)
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Agent error: {str(e)}")
 
-    finally:
-        data_manager.clear(data_id)
+def json_response(model: BaseModel) -> Response:
+    """
+    Encode a response model with the DataManager's orjson encoder.
+
+    Chart responses carry up to MAX_ROWS injected records; this skips
+    FastAPI's jsonable_encoder walk and stdlib json encoding of them.
+    """
+    return Response(content=data_manager.to_json_bytes(model.model_dump()), media_type="application/json")
+
+
+def sse_event(event: str, payload: Any) -> bytes:
+    """Format one server-sent event."""
+    return b"event: " + event.encode("utf-8") + b"\ndata: " + data_manager.to_json_bytes(payload) + b"\n\n"
+
+
+@app.post("/api/visualize/stream")
+async def visualize_stream(request: VisualizeRequest, ctx: UserContext = Depends(user_context)):
+    """
+    Streaming variant of /api/visualize (Server-Sent Events).
+
+    Emits stage events as they happen:
+      data_loaded  — {row_count, load_ms}
+      tool_call    — {name, args}
+      query_result — {data, row_count} as soon as query_data returns (or {error})
+      chart        — the VisualizeResponse without token usage
+      token_usage  — {token_usage, quota}
+      error        — {detail}
+      done         — {}
+    Validation, quota and ACL failures are returned as plain HTTP errors
+    before the stream starts.
+    """
+    email = ctx.email
+    engine = await check_visualize_request(request, ctx)
+    reservation = await reserve_request_tokens(ctx)
+    start = time.perf_counter()
+    try:
+        data_id, row_count = await acquire_request_data(request, ctx, engine)
+    except BaseException:
+        await asyncio.to_thread(release_tokens, reservation)
+        raise
+    load_ms = round((time.perf_counter() - start) * 1000)
+
+    async def events():
+        try:
+            yield sse_event("data_loaded", {"row_count": row_count, "load_ms": load_ms})
+            stages = pipeline_event_stream(
+                request.prompt, data_id, request.history, request.mode or "agent", request.inject_schema,
+                email or "user_default", request.conversation_id,
+            )
+            async for stage in stages:
+                if stage["event"] == "tool_call":
+                    yield sse_event("tool_call", {"name": stage["name"], "args": stage["args"]})
+                elif stage["event"] == "tool_result" and stage["name"] == "query_data":
+                    yield sse_event("query_result", stage["response"])
+                elif stage["event"] == "agent_response":
+                    if request.conversation_id:
+                        conversation_store.enforce_budget(request.conversation_id, email)
+                    response = await finish_visualize_response(
+                        stage["raw"], stage["token_usage"], ctx, stage["results"], reservation
+                    )
+                    yield sse_event("chart", response.model_dump(exclude={"token_usage", "quota"}))
+                    yield sse_event("token_usage", {
+                        "token_usage": response.token_usage.model_dump() if response.token_usage else None,
+                        "quota": response.quota.model_dump() if response.quota else None,
+                    })
+            yield sse_event("done", {})
+        except Exception as e:
+            logger.error(f"[AGENT ERROR] {e}")
+            yield sse_event("error", {"detail": f"Agent error: {str(e)}"})
+        finally:
+            release_request_data(data_id)
+            await asyncio.to_thread(release_tokens, reservation)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 if __name__ == "__main__":
@@ -585,7 +1028,7 @@ def require_admin(user: dict) -> None:
 @app.get("/api/admin/org-users")
 async def admin_get_org_users(user: dict = Depends(get_current_user)):
     """Fetch all users from the Lark organization."""
-    require_admin(user)
+    await asyncio.to_thread(require_admin, user)
     try:
         users = await fetch_all_org_users()
         return {"users": [OrgUser(**u) for u in users]}
@@ -597,7 +1040,7 @@ async def admin_get_org_users(user: dict = Depends(get_current_user)):
 @app.get("/api/admin/org-hierarchy")
 async def admin_get_org_hierarchy(user: dict = Depends(get_current_user)):
     """Fetch structured departments and users from Lark."""
-    require_admin(user)
+    await asyncio.to_thread(require_admin, user)
     try:
         hierarchy = await fetch_org_hierarchy()
         return {"departments": hierarchy}
@@ -607,7 +1050,7 @@ async def admin_get_org_hierarchy(user: dict = Depends(get_current_user)):
 
 
 @app.get("/api/admin/quota-settings")
-async def admin_get_quota_settings(user: dict = Depends(get_current_user)):
+def admin_get_quota_settings(user: dict = Depends(get_current_user)):
     """Get all registered users with their quota settings and usage."""
     require_admin(user)
     entries = get_all_quota_settings()
@@ -615,7 +1058,7 @@ async def admin_get_quota_settings(user: dict = Depends(get_current_user)):
 
 
 @app.post("/api/admin/update-user")
-async def admin_update_user(
+def admin_update_user(
     request: UpdateUserRequest, user: dict = Depends(get_current_user)
 ):
     """Add or update a user's quota settings."""
@@ -625,7 +1068,7 @@ async def admin_update_user(
 
 
 @app.post("/api/admin/remove-user")
-async def admin_remove_user(
+def admin_remove_user(
     request: RemoveUserRequest, user: dict = Depends(get_current_user)
 ):
     """Remove a user's access."""
@@ -636,7 +1079,7 @@ async def admin_remove_user(
     return {"status": "ok", "removed": request.email}
 
 @app.post("/api/admin/set-admin")
-async def admin_set_admin(
+def admin_set_admin(
     request: SetAdminRequest, user: dict = Depends(get_current_user)
 ):
     """Update a user's admin role."""
@@ -650,10 +1093,24 @@ async def admin_set_admin(
     return {"status": "ok", "email": request.email, "is_admin": request.is_admin}
 
 
+@app.get("/api/admin/cache-stats")
+async def admin_cache_stats(user: dict = Depends(get_current_user)):
+    """Return hit/miss counters and memory usage of the snapshot cache, data store, query workers and config cache."""
+    await asyncio.to_thread(require_admin, user)
+    return {
+        "snapshot_cache": snapshot_cache.stats(),
+        "data_manager": data_manager.stats(),
+        "query_executor": query_executor.stats(),
+        "conversations": conversation_store.stats(),
+        "agent_sessions": agent_sessions.stats(),
+        "config_cache": config_cache.stats(),
+    }
+
+
 # ── Datamart ACL Endpoints ──────────────────────────────────────────
 
 @app.get("/api/admin/datamarts")
-async def admin_get_datamarts(user: dict = Depends(get_current_user)):
+def admin_get_datamarts(user: dict = Depends(get_current_user)):
     """Fetch all configured datamarts and their access list."""
     require_admin(user)
     datamarts = get_all_datamarts()
@@ -669,7 +1126,7 @@ async def admin_get_datamarts(user: dict = Depends(get_current_user)):
 
 
 @app.post("/api/admin/sync-datamarts")
-async def admin_sync_datamarts(user: dict = Depends(get_current_user)):
+def admin_sync_datamarts(user: dict = Depends(get_current_user)):
     """Sync list of tables from BigQuery datasets and append to config."""
     require_admin(user)
     available = []
@@ -695,7 +1152,7 @@ async def admin_sync_datamarts(user: dict = Depends(get_current_user)):
 
 
 @app.post("/api/admin/update-datamart-access")
-async def admin_update_datamart_access(
+def admin_update_datamart_access(
     request: UpdateDatamartAccessRequest, user: dict = Depends(get_current_user)
 ):
     """Update user access list for a specific datamart."""
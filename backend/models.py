@@ -10,6 +10,10 @@ class VisualizeRequest(BaseModel):
     table_name: Optional[str] = Field(None, description="BigQuery table name (for dropdown mode)")
     dataset: Optional[str] = Field(None, description="BigQuery dataset name (company)")
     history: Optional[list[dict[str, Any]]] = Field(None, description="Conversation history (role and content)")
+    engine: Optional[str] = Field(None, description="Query engine: 'pandas' (default), 'duckdb', or 'bigquery' (SQL pushdown, BigQuery mode only)")
+    mode: Optional[str] = Field(None, description="Pipeline: 'agent' (default), 'fast' (two model calls) or 'fast_local' (one model call + heuristic chart)")
+    inject_schema: Optional[bool] = Field(None, description="Include a schema summary in the agent prompt (default: SCHEMA_PREINJECTION)")
+    conversation_id: Optional[str] = Field(None, description="Client-generated conversation id; follow-ups reuse the data loaded for it")
 
 
 
@@ -30,6 +34,7 @@ class TokenUsage(BaseModel):
     completion_tokens: int = Field(0, description="Number of output/completion tokens")
     total_tokens: int = Field(0, description="Total tokens used")
     agent_turns: int = Field(0, description="Number of agent turns (tool calls + final response)")
+    history_tokens_saved: int = Field(0, description="Estimated prompt tokens saved by history compaction")
 
 
 class CountTokensResponse(BaseModel):
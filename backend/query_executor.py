@@ -0,0 +1,347 @@
+"""
+Query Executor — evaluates agent pandas expressions in a bounded process pool.
+
+`DataManager.query_data` hands the final pandas evaluation step to this
+executor so a heavy or runaway expression cannot stall the API server:
+
+  - Stored frames are published as Arrow IPC files in shared memory
+    (/dev/shm when available), once per table version and column set, so
+    requests on the same snapshot share one file. Workers memory-map them
+    instead of receiving a pickled copy with every query, and numeric
+    columns stay zero-copy views of the mapping. The files are RAM (on
+    Cloud Run, /tmp is too), so the DataManager counts them against
+    DATA_MANAGER_MAX_BYTES and evicting an entry deletes its file.
+  - Each worker is its own single-process executor, spawned and warmed up
+    (interpreter started, pandas imported) by a background thread: at
+    server startup, and again whenever a worker is killed. Queries never
+    spawn a worker and wait at most QUERY_TIMEOUT_SECONDS for a free one,
+    so a burst cannot tie up the threads that call `evaluate`.
+  - A query's timeout starts once a warm worker has been acquired. A query
+    that exceeds it kills only the worker running it; queries on the other
+    workers and the server process are never affected.
+  - Each worker caps its own address space, so an expression that explodes
+    memory fails with MemoryError inside the worker.
+
+Frames that cannot be expressed in Arrow (mixed-type object columns) are
+evaluated in the calling thread instead. Set QUERY_WORKERS=0 to disable the
+pool entirely.
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+
+try:
+    import resource
+except ImportError:  # not available on Windows — memory cap is skipped
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+QUERY_WORKERS = int(os.getenv("QUERY_WORKERS", "2"))
+QUERY_TIMEOUT_SECONDS = float(os.getenv("QUERY_TIMEOUT_SECONDS", "30"))
+QUERY_WORKER_MAX_BYTES = int(os.getenv("QUERY_WORKER_MAX_BYTES", str(4 * 1024 * 1024 * 1024)))
+# How long a new worker may take to spawn and import pandas before it is given up
+QUERY_WORKER_START_TIMEOUT_SECONDS = float(os.getenv("QUERY_WORKER_START_TIMEOUT_SECONDS", "120"))
+QUERY_SHARED_DIR = os.getenv(
+    "QUERY_SHARED_DIR",
+    "/dev/shm/prompt_to_viz_frames" if os.path.isdir("/dev/shm")
+    else os.path.join(tempfile.gettempdir(), "prompt_to_viz_frames"),
+)
+
+# Frames each worker keeps open between queries
+_WORKER_FRAME_CACHE_SIZE = 4
+
+
+# ──────────────────────────────────────────────
+# Worker side (runs in the pool processes)
+# ──────────────────────────────────────────────
+
+_worker_frames: OrderedDict[str, pd.DataFrame] = OrderedDict()
+_worker_manager = None
+
+
+def _init_worker(max_bytes: int):
+    global _worker_manager
+    if max_bytes and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+    from data_manager import DataManager
+    _worker_manager = DataManager()
+
+
+def _ready() -> bool:
+    """No-op task: returns once the worker has started and run its initializer."""
+    return True
+
+
+def _open_frame(path: str) -> pd.DataFrame:
+    frame = _worker_frames.get(path)
+    if frame is not None:
+        _worker_frames.move_to_end(path)
+        return frame
+
+    # The mapping stays open for as long as the frame references it: numeric
+    # columns without nulls are read-only views of the shared file, not copies
+    source = pa.memory_map(path, "r")
+    frame = pa.ipc.open_file(source).read_all().to_pandas(split_blocks=True)
+    _worker_frames[path] = frame
+    while len(_worker_frames) > _WORKER_FRAME_CACHE_SIZE:
+        _worker_frames.popitem(last=False)
+    return frame
+
+
+def _evaluate_in_worker(path: str, operation: str) -> dict:
+    try:
+        frame = _open_frame(path)
+    except Exception as e:
+        return {"error": f"Failed to open shared frame: {str(e)}"}
+    return _worker_manager.evaluate_payload(frame, operation)
+
+
+# ──────────────────────────────────────────────
+# Server side
+# ──────────────────────────────────────────────
+
+class QueryExecutor:
+    """Worker processes for `query_data` evaluation with timeouts and memory caps."""
+
+    def __init__(
+        self,
+        workers: int = QUERY_WORKERS,
+        timeout: float = QUERY_TIMEOUT_SECONDS,
+        worker_max_bytes: int = QUERY_WORKER_MAX_BYTES,
+        shared_dir: str = QUERY_SHARED_DIR,
+    ):
+        self.workers = workers
+        self.timeout = timeout
+        self.worker_max_bytes = worker_max_bytes
+        self.shared_dir = Path(shared_dir)
+        # Warm workers ready for a query; None is a slot whose worker failed to start
+        self._idle: queue.SimpleQueue[ProcessPoolExecutor | None] = queue.SimpleQueue()
+        self._live: set[ProcessPoolExecutor] = set()
+        self._workers_lock = threading.Lock()
+        self._started = False
+        self._closed = False
+        # (version, columns) → (weakref to the frame written, IPC file path, file bytes)
+        self._published: dict[tuple, tuple[weakref.ref, Path, int]] = {}
+        self._owners: dict[str, tuple] = {}  # data_id → key of the file it reads
+        self._publish_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.queries = 0
+        self.timeouts = 0
+        self.crashes = 0
+        self.inline = 0
+        self.busy = 0
+        self.spawns = 0
+
+    def _count(self, counter: str):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    # ── Worker lifecycle ─────────────────────────────────────
+
+    def start(self):
+        """Spawn and warm every worker in the background (idempotent; `evaluate` calls it too)."""
+        with self._workers_lock:
+            if self._started or self._closed:
+                return
+            self._started = True
+        for _ in range(self.workers):
+            self._replace_worker()
+
+    def _replace_worker(self):
+        """Fill one slot with a warm worker from a background thread, off every query's path."""
+        if self._closed:
+            return
+        threading.Thread(target=self._warm_worker, name="query-worker-start", daemon=True).start()
+
+    def _warm_worker(self):
+        worker = ProcessPoolExecutor(
+            max_workers=1,
+            # spawn, not fork: the server holds threads and gRPC channels
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.worker_max_bytes,),
+        )
+        with self._workers_lock:
+            self._live.add(worker)
+        try:
+            worker.submit(_ready).result(timeout=QUERY_WORKER_START_TIMEOUT_SECONDS)
+        except Exception as e:
+            logger.warning(f"[EXECUTOR] Worker failed to start, evaluating inline until it does: {e}")
+            self._kill_worker(worker)
+            worker = None
+        self._count("spawns")
+        with self._workers_lock:
+            if self._closed and worker is not None:
+                self._live.discard(worker)
+                worker.shutdown(wait=False, cancel_futures=True)
+                return
+        self._idle.put(worker)
+
+    def _kill_worker(self, worker: ProcessPoolExecutor):
+        """Kill the one process behind `worker` (the caller replaces its slot)."""
+        with self._workers_lock:
+            self._live.discard(worker)
+        for process in list((worker._processes or {}).values()):
+            process.kill()
+        worker.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        with self._workers_lock:
+            self._closed = True
+            workers, self._live = self._live, set()
+        for worker in workers:
+            worker.shutdown(wait=False, cancel_futures=True)
+        with self._publish_lock:
+            for _, path, _ in self._published.values():
+                path.unlink(missing_ok=True)
+            self._published.clear()
+            self._owners.clear()
+
+    # ── Shared frames ────────────────────────────────────────
+
+    def _publish(self, data_id: str, df: pd.DataFrame, version: str | None) -> Path | None:
+        """Write `df` to shared memory once per version and column set; None if Arrow cannot hold it.
+
+        Frames without a version are keyed by data_id and rewritten only
+        when the stored frame object changes.
+        """
+        key = (version, tuple(str(c) for c in df.columns)) if version else (f"frame:{data_id}", ())
+        with self._publish_lock:
+            published = self._published.get(key)
+            if published is not None and (version or published[0]() is df):
+                self._claim(data_id, key)
+                return published[1]
+
+            self.shared_dir.mkdir(parents=True, exist_ok=True)
+            path = self.shared_dir / f"{uuid.uuid4().hex}.arrow"
+            try:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                with pa.OSFile(str(path), "wb") as sink:
+                    with pa.ipc.new_file(sink, table.schema) as writer:
+                        writer.write_table(table)
+            except Exception as e:
+                logger.info(f"[EXECUTOR] '{data_id}' cannot be shared via Arrow, evaluating inline: {e}")
+                path.unlink(missing_ok=True)
+                return None
+
+            if published is not None:
+                published[1].unlink(missing_ok=True)
+            self._published[key] = (weakref.ref(df), path, path.stat().st_size)
+            self._claim(data_id, key)
+            return path
+
+    def _claim(self, data_id: str, key: tuple):
+        """Point `data_id` at the file for `key`, dropping its previous file if now unused. Caller holds the lock."""
+        previous = self._owners.get(data_id)
+        self._owners[data_id] = key
+        if previous is not None and previous != key:
+            self._drop_unowned(previous)
+
+    def _drop_unowned(self, key: tuple) -> int:
+        """Delete the file for `key` unless another data_id still reads it; return bytes freed. Caller holds the lock."""
+        if key in self._owners.values():
+            return 0
+        published = self._published.pop(key, None)
+        if published is None:
+            return 0
+        published[1].unlink(missing_ok=True)
+        return published[2]
+
+    def release(self, data_id: str) -> int:
+        """Stop sharing a frame once it leaves the DataManager (the file goes with its last reader); return bytes freed."""
+        with self._publish_lock:
+            key = self._owners.pop(data_id, None)
+            return self._drop_unowned(key) if key is not None else 0
+
+    def publishes(self, data_id: str) -> bool:
+        """True if a published file is kept for `data_id`."""
+        with self._publish_lock:
+            return data_id in self._owners
+
+    def published_bytes(self) -> int:
+        """Total size of the published files — RAM when the shared dir is /dev/shm (or /tmp on Cloud Run)."""
+        with self._publish_lock:
+            return sum(size for _, _, size in self._published.values())
+
+    # ── Evaluation ───────────────────────────────────────────
+
+    def evaluate(self, data_id: str, df: pd.DataFrame, operation: str, manager, version: str | None = None) -> dict:
+        """Evaluate `operation` against `df` in a worker and return the query_data payload.
+
+        `version` identifies the frame's contents (see `DataManager._data_version`);
+        requests on the same version and columns share one published file.
+        """
+        self._count("queries")
+        path = self._publish(data_id, df, version) if self.workers > 0 else None
+        if path is None:
+            self._count("inline")
+            return manager.evaluate_payload(df, operation)
+
+        # Wait (bounded) for a warm worker; the query's timeout starts once it has one
+        self.start()
+        try:
+            worker = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            self._count("busy")
+            return {"error": f"All query workers stayed busy for {self.timeout:g} seconds. Try again shortly."}
+        if worker is None:
+            # The slot's worker failed to start: evaluate here and retry the slot in the background
+            self._replace_worker()
+            self._count("inline")
+            return manager.evaluate_payload(df, operation)
+
+        try:
+            future = worker.submit(_evaluate_in_worker, str(path), operation)
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            self._count("timeouts")
+            logger.warning(f"[EXECUTOR] Query on '{data_id}' exceeded {self.timeout:g}s, killing its worker: {operation}")
+            self._kill_worker(worker)
+            worker = None
+            return {"error": f"Query timed out after {self.timeout:g} seconds. Simplify the expression or aggregate the data first."}
+        except BrokenProcessPool:
+            self._count("crashes")
+            logger.warning(f"[EXECUTOR] Worker died while evaluating on '{data_id}': {operation}")
+            self._kill_worker(worker)
+            worker = None
+            return {"error": "Query failed: the worker running it was terminated (it may have exceeded the memory limit)."}
+        finally:
+            if worker is None:
+                self._replace_worker()
+            else:
+                self._idle.put(worker)
+
+    def stats(self) -> dict:
+        with self._publish_lock:
+            shared = len(self._published)
+            shared_bytes = sum(size for _, _, size in self._published.values())
+        with self._stats_lock:
+            counters = {
+                "queries": self.queries, "inline": self.inline, "busy": self.busy,
+                "timeouts": self.timeouts, "crashes": self.crashes, "spawns": self.spawns,
+            }
+        return {
+            "workers": self.workers,
+            "timeout_seconds": self.timeout,
+            "worker_max_bytes": self.worker_max_bytes,
+            "shared_frames": shared,
+            "shared_bytes": shared_bytes,
+            **counters,
+        }
+
+
+# Singleton instance
+query_executor = QueryExecutor()
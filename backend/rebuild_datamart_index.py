@@ -0,0 +1,103 @@
+"""
+Rebuild or check the per-user datamart index (prompt_to_viz_user_datamarts)
+against the datamart access lists (prompt_to_viz_datamarts).
+
+The access lists are the source of truth. ACL checks ignore the index until
+a --fix run has completed (it then sets prompt_to_viz_config/datamart_index),
+because grants made before the build leave index docs listing only the tables
+they touched. Run --fix once after deploying the index, and any time the two
+may have drifted (e.g. after editing datamart docs by hand in the console):
+    python rebuild_datamart_index.py          # report differences only (default)
+    python rebuild_datamart_index.py --fix    # rewrite mismatched index docs, then mark the index built
+
+Each user's doc is rewritten in its own transaction from a fresh query of the
+access lists, so grants made while the tool runs are not lost.
+
+Exits with status 1 when --check finds differences.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+# Ensure backend is importable
+sys.path.insert(0, str(Path(__file__).parent))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from firestore_config import (
+    get_all_datamarts,
+    get_all_user_datamarts,
+    rebuild_user_datamarts,
+    datamart_index_built,
+    mark_datamart_index_built,
+)
+
+
+def expected_index(datamarts: dict[str, list[str]]) -> dict[str, list[str]]:
+    """Invert {dataset.table: [emails]} into {email: [dataset.table]}."""
+    index: dict[str, set[str]] = {}
+    for key, allowed_users in datamarts.items():
+        for email in allowed_users:
+            index.setdefault(email.lower(), set()).add(key)
+    return {email: sorted(keys) for email, keys in index.items()}
+
+
+def email_spellings(datamarts: dict[str, list[str]]) -> dict[str, list[str]]:
+    """{lower-case email: [spellings used in access lists]}."""
+    spellings: dict[str, set[str]] = {}
+    for allowed_users in datamarts.values():
+        for email in allowed_users:
+            spellings.setdefault(email.lower(), set()).add(email)
+    return {email: sorted(names) for email, names in spellings.items()}
+
+
+def rebuild(fix: bool) -> int:
+    """Compare the stored index with the access lists. Returns the number of mismatched users."""
+    datamarts = get_all_datamarts()
+    expected = expected_index(datamarts)
+    stored = get_all_user_datamarts()
+    spellings = email_spellings(datamarts)
+    print(f"[INDEX] {len(datamarts)} datamarts, {len(expected)} users with access, {len(stored)} index docs")
+    built = datamart_index_built()
+    print(f"[INDEX] Index {'is' if built else 'is NOT'} marked built (ACL checks {'read' if built else 'ignore'} it)")
+
+    mismatched = 0
+    for email in sorted(set(expected) | set(stored)):
+        want = set(expected.get(email, []))
+        have = set(stored.get(email, []))
+        if email in stored and want == have:
+            continue
+        # An empty index doc and no index doc both mean "no access"
+        if not want and not have:
+            continue
+
+        mismatched += 1
+        missing, extra = sorted(want - have), sorted(have - want)
+        print(f"[INDEX] ✗ {email}: missing={missing} extra={extra}" if email in stored else f"[INDEX] ✗ {email}: no index doc")
+
+        if fix:
+            tables = rebuild_user_datamarts(email, spellings.get(email))
+            print(f"[INDEX]   fixed ({len(tables)} tables)")
+
+    if fix and not built:
+        mark_datamart_index_built()
+        print("[INDEX] Marked the index built — ACL checks now read it.")
+
+    if mismatched:
+        print(f"\n[INDEX] {'Fixed' if fix else 'Found'} {mismatched} mismatched users.")
+    else:
+        print("\n[INDEX] ✅ Index is consistent.")
+    return mismatched
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--check", action="store_true", help="report differences without writing (default)")
+    mode.add_argument("--fix", action="store_true", help="rewrite index docs that differ from the access lists")
+    args = parser.parse_args()
+
+    mismatched = rebuild(fix=args.fix)
+    sys.exit(1 if mismatched and not args.fix else 0)
@@ -0,0 +1,113 @@
+"""
+Result Cache — memoized `query_data` payloads.
+
+Agents re-issue the same expression on follow-ups and retries, and popular
+questions repeat across users. Results are keyed by
+(data version, engine, loaded columns, normalized expression), where the
+data version is the BigQuery table's last-modified stamp or a content hash
+of a pasted dataset, so a hit is only possible while the underlying data is
+unchanged and the same engine evaluates it against the same columns.
+
+Expressions are normalized through the Python AST (whitespace, quote style
+and redundant parentheses do not matter). Expressions whose result depends on
+the clock (`pd.Timestamp.now()`, `date.today()`, `'today'`) or on randomness
+(`.sample()`) are never cached.
+"""
+import ast
+import os
+import threading
+import time
+from collections import OrderedDict
+
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1024"))
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", "600"))
+
+# Attribute calls and string literals that make an expression non-deterministic
+_VOLATILE_ATTRS = {"now", "today", "utcnow", "sample", "random"}
+_VOLATILE_STRINGS = {"now", "today"}
+
+ResultKey = tuple[str, str, tuple[str, ...], str]  # (data version, engine, loaded columns, normalized operation)
+
+
+def normalize_operation(operation: str) -> str | None:
+    """Return a canonical form of `operation`, or None if it must not be cached."""
+    try:
+        tree = ast.parse(operation.strip(), mode="eval")
+    except SyntaxError:
+        return None
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and node.attr in _VOLATILE_ATTRS:
+            return None
+        if isinstance(node, ast.Constant) and isinstance(node.value, str) and node.value.strip().lower() in _VOLATILE_STRINGS:
+            return None
+    return ast.unparse(tree)
+
+
+class ResultCache:
+    """Thread-safe LRU + TTL cache of serialized `query_data` payloads."""
+
+    def __init__(self, max_entries: int = RESULT_CACHE_MAX_ENTRIES, ttl_seconds: int = RESULT_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # key → (stored at, compute seconds, payload)
+        self._entries: OrderedDict[ResultKey, tuple[float, float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def key(
+        self,
+        version: str | None,
+        operation: str,
+        engine: str = "pandas",
+        columns: tuple[str, ...] = (),
+    ) -> ResultKey | None:
+        """Build the cache key, or None when the result is not cacheable."""
+        if not version or self.max_entries <= 0:
+            return None
+        normalized = normalize_operation(operation)
+        return (version, engine, columns, normalized) if normalized is not None else None
+
+    def get(self, key: ResultKey) -> dict | None:
+        """Return a cached payload (a shallow copy — treat `data` as read-only), or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry[1]
+            return dict(entry[2])
+
+    def put(self, key: ResultKey, payload: dict, seconds: float):
+        """Cache a successful payload that took `seconds` to compute."""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), seconds, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, version: str):
+        """Drop every cached result computed against `version`."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == version]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "saved_seconds": round(self.saved_seconds, 3),
+            }
@@ -0,0 +1,330 @@
+"""
+Snapshot Cache — process-wide, versioned cache of fetched BigQuery tables.
+
+One immutable DataFrame is kept per table version, keyed by
+(dataset, table, table.modified). Concurrent requests for the same table
+share the cached frame read-only instead of each downloading their own copy.
+Entries are evicted least-recently-used once the byte budget is exceeded.
+
+Below the in-memory tier sits an optional disk tier: snapshots are spilled
+as Arrow IPC files and reopened with memory mapping, so a restarted
+instance can serve warm tables without downloading them again. The tier is
+off unless SNAPSHOT_DISK_DIR points at a persistent mount (e.g. a Cloud Run
+volume backed by Cloud Storage or Filestore) — on Cloud Run /tmp and
+/dev/shm are in-memory filesystems that are lost on restart, so spilling
+there only costs RAM and is refused.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_CACHE_MAX_BYTES = int(os.getenv("SNAPSHOT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Disk tier — disabled unless SNAPSHOT_DISK_DIR is set to a persistent mount
+SNAPSHOT_DISK_DIR = os.getenv("SNAPSHOT_DISK_DIR", "")
+SNAPSHOT_DISK_MAX_BYTES = int(os.getenv("SNAPSHOT_DISK_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+SNAPSHOT_DISK_TTL_SECONDS = int(os.getenv("SNAPSHOT_DISK_TTL_SECONDS", str(24 * 3600)))
+
+SnapshotKey = tuple[str, str, str]  # (dataset, table, version)
+
+# In-memory filesystems: a disk tier here neither saves RAM nor survives restarts
+_MEMORY_BACKED_DIRS = ("/tmp", "/dev/shm")
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def _covers(frame: pd.DataFrame, columns: list[str]) -> bool:
+    return set(columns).issubset(frame.columns)
+
+
+class DiskSnapshotTier:
+    """Arrow IPC spill files for table snapshots, bounded by bytes and age.
+
+    Files are named `<table digest>-<version digest>.arrow`, so they survive
+    restarts and a newer table version replaces older files of the same table.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl_seconds: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _table_prefix(self, key: SnapshotKey) -> str:
+        return _digest(f"{key[0]}.{key[1]}")
+
+    def _path(self, key: SnapshotKey) -> Path:
+        return self.directory / f"{self._table_prefix(key)}-{_digest(key[2])}.arrow"
+
+    def load(self, key: SnapshotKey) -> pd.DataFrame | None:
+        """Reopen a spilled snapshot via memory mapping, or return None."""
+        path = self._path(key)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        if time.time() - stat.st_mtime > self.ttl_seconds:
+            path.unlink(missing_ok=True)
+            self.misses += 1
+            return None
+
+        try:
+            source = pa.memory_map(str(path), "r")
+            table = pa.ipc.open_file(source).read_all()
+            # One block per column: numeric columns without nulls stay zero-copy
+            # views of the mapped file (read-only, like every shared snapshot);
+            # strings, nullable and date columns are still materialized.
+            frame = table.to_pandas(split_blocks=True)
+        except Exception as e:
+            logger.warning(f"[SNAPSHOT DISK] Failed to read {path.name}, discarding: {e}")
+            path.unlink(missing_ok=True)
+            self.misses += 1
+            return None
+
+        # Touch the file so quota eviction treats it as recently used
+        os.utime(path, (time.time(), stat.st_mtime))
+        self.hits += 1
+        return frame
+
+    def save(self, key: SnapshotKey, frame: pd.DataFrame):
+        """Spill a snapshot to disk, replacing older versions of the same table."""
+        path = self._path(key)
+        tmp_path = path.with_suffix(".tmp")
+        try:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            with pa.OSFile(str(tmp_path), "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            # Mixed-type object columns cannot always be expressed in Arrow
+            logger.warning(f"[SNAPSHOT DISK] Could not spill {key[0]}.{key[1]}: {e}")
+            tmp_path.unlink(missing_ok=True)
+            return
+
+        with self._lock:
+            self.writes += 1
+            for old in self.directory.glob(f"{self._table_prefix(key)}-*.arrow"):
+                if old != path:
+                    old.unlink(missing_ok=True)
+            self._enforce_quota()
+
+    def _enforce_quota(self):
+        """Delete expired files, then least-recently-used files until under quota."""
+        now = time.time()
+        files = []
+        for f in self.directory.glob("*.arrow"):
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.ttl_seconds:
+                f.unlink(missing_ok=True)
+            else:
+                files.append((stat.st_atime, stat.st_size, f))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, f in sorted(files):
+            if total <= self.max_bytes:
+                break
+            f.unlink(missing_ok=True)
+            total -= size
+            logger.info(f"[SNAPSHOT DISK] Evicted {f.name}")
+
+    def stats(self) -> dict:
+        files = list(self.directory.glob("*.arrow"))
+        return {
+            "directory": str(self.directory),
+            "files": len(files),
+            "bytes": sum(f.stat().st_size for f in files if f.exists()),
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+        }
+
+
+class SnapshotCache:
+    """Thread-safe LRU cache of table snapshots bounded by total bytes."""
+
+    def __init__(
+        self,
+        max_bytes: int = SNAPSHOT_CACHE_MAX_BYTES,
+        disk: DiskSnapshotTier | None = None,
+    ):
+        self.max_bytes = max_bytes
+        self.disk = disk
+        self._entries: OrderedDict[SnapshotKey, pd.DataFrame] = OrderedDict()
+        self._sizes: dict[SnapshotKey, int] = {}
+        self._column_sizes: dict[SnapshotKey, pd.Series] = {}  # deep bytes per column
+        self._lock = threading.Lock()
+        # Per-key locks so concurrent misses on the same table load it once
+        self._load_locks: dict[SnapshotKey, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: SnapshotKey) -> pd.DataFrame | None:
+        """Return the cached frame for `key` (marking it recently used), or None."""
+        with self._lock:
+            frame = self._entries.get(key)
+            if frame is not None:
+                self._entries.move_to_end(key)
+            return frame
+
+    def get_or_load(
+        self,
+        key: SnapshotKey,
+        loader: Callable[[list[str]], pd.DataFrame],
+        columns: list[str],
+    ) -> pd.DataFrame:
+        """
+        Return a snapshot for `key` containing at least `columns`.
+
+        Snapshots may hold only a subset of a table's columns. When the cached
+        frame does not cover `columns`, `loader(fetch_columns)` is called with
+        the union of the requested and already-cached columns (so the rows of
+        the widened frame stay aligned) and the entry is replaced.
+
+        The returned frame is shared between requests and must be treated as
+        read-only — callers that hand it to user code should store a shallow
+        copy (`frame.copy(deep=False)`) so column additions never leak back.
+        """
+        frame = self.get(key)
+        if frame is not None and _covers(frame, columns):
+            with self._lock:
+                self.hits += 1
+            return frame
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        try:
+            with load_lock:
+                # Another request may have finished loading while we waited
+                frame = self.get(key)
+                if frame is not None and _covers(frame, columns):
+                    with self._lock:
+                        self.hits += 1
+                    return frame
+
+                with self._lock:
+                    self.misses += 1
+                wanted = list(dict.fromkeys([*columns, *(frame.columns if frame is not None else [])]))
+
+                frame = self.disk.load(key) if self.disk else None
+                if frame is None or not _covers(frame, wanted):
+                    frame = loader(wanted)
+                    if self.disk:
+                        self.disk.save(key, frame)
+                self.put(key, frame)
+                return frame
+        finally:
+            with self._lock:
+                self._load_locks.pop(key, None)
+
+    def put(self, key: SnapshotKey, frame: pd.DataFrame):
+        """Insert a snapshot, dropping older versions of the same table."""
+        column_sizes = frame.memory_usage(deep=True)
+        size = int(column_sizes.sum())
+        with self._lock:
+            dataset, table, _ = key
+            for old_key in [k for k in self._entries if k[:2] == (dataset, table) and k != key]:
+                self._remove(old_key)
+
+            if size > self.max_bytes:
+                logger.info(f"[SNAPSHOT] {dataset}.{table} ({size:,} bytes) exceeds cache budget, not cached")
+                return
+
+            self._entries[key] = frame
+            self._sizes[key] = size
+            self._column_sizes[key] = column_sizes
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def held_bytes(self, frame: pd.DataFrame, columns: list[str] | None = None) -> int | None:
+        """
+        Deep bytes of `columns` (default: all) of `frame` while this cache holds
+        it, or None once it does not (never cached, evicted or replaced).
+        """
+        with self._lock:
+            for key, cached in self._entries.items():
+                if cached is frame:
+                    sizes = self._column_sizes[key]
+                    if columns is None:
+                        return self._sizes[key]
+                    return int(sizes[sizes.index.intersection(columns)].sum())
+            return None
+
+    def invalidate(self, dataset: str, table: str):
+        """Drop every cached version of a table."""
+        with self._lock:
+            for key in [k for k in self._entries if k[:2] == (dataset, table)]:
+                self._remove(key)
+
+    def _remove(self, key: SnapshotKey):
+        self._entries.pop(key, None)
+        self._sizes.pop(key, None)
+        self._column_sizes.pop(key, None)
+
+    def _evict(self):
+        """Evict least-recently-used snapshots until under budget. Caller holds the lock."""
+        while self._entries and sum(self._sizes.values()) > self.max_bytes:
+            key, _ = self._entries.popitem(last=False)
+            self._sizes.pop(key, None)
+            self._column_sizes.pop(key, None)
+            self.evictions += 1
+            logger.info(f"[SNAPSHOT] Evicted {key[0]}.{key[1]} (version {key[2]})")
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and current memory usage."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "entries": len(self._entries),
+                "bytes": sum(self._sizes.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+        stats["disk"] = self.disk.stats() if self.disk else None
+        return stats
+
+
+def _build_disk_tier() -> DiskSnapshotTier | None:
+    if not SNAPSHOT_DISK_DIR:
+        return None
+    resolved = os.path.realpath(SNAPSHOT_DISK_DIR)
+    if os.getenv("K_SERVICE") and any(resolved == d or resolved.startswith(d + "/") for d in _MEMORY_BACKED_DIRS):
+        logger.warning(f"[SNAPSHOT DISK] Disabled, {SNAPSHOT_DISK_DIR} is in-memory on Cloud Run — mount a persistent volume")
+        return None
+    try:
+        return DiskSnapshotTier(SNAPSHOT_DISK_DIR, SNAPSHOT_DISK_MAX_BYTES, SNAPSHOT_DISK_TTL_SECONDS)
+    except OSError as e:
+        logger.warning(f"[SNAPSHOT DISK] Disabled, cannot use {SNAPSHOT_DISK_DIR}: {e}")
+        return None
+
+
+# Singleton instance
+snapshot_cache = SnapshotCache(disk=_build_disk_tier())
@@ -0,0 +1,728 @@
+"""
+SQL Pushdown — compiles common agent pandas expressions into SQL.
+
+The agent's `query_data` expressions are mostly small filter → groupby →
+aggregate → sort → head chains. For those shapes the work can run inside
+the warehouse and only the (≤ 30 row) answer comes back. `compile_expression`
+parses the expression with `ast` and either returns a `CompiledQuery` or
+raises `UnsupportedExpression`, in which case callers fall back to the
+in-memory `DataManager.query_data` path.
+
+Supported shapes:
+  - filters: `df[mask]` with comparisons, `&`, `|`, `~`, `.isin()`,
+    `.between()`, `.isna()` / `.notna()` and `.dt.year|quarter|month|day|hour`
+  - `df.groupby(keys)` on columns, `.dt` parts or `pd.Grouper(key=..., freq=...)`
+    followed by sum / mean / count / size / nunique / min / max or `.agg(...)`
+  - `.reset_index()`, `.sort_values()`, `.sort_index()`, `.head()`,
+    `.nlargest()`, `.nsmallest()`, `.rename(columns=...)`, `.round()`
+
+Semantics follow pandas, not SQL: comparisons are null-safe (NaN compares
+False, `!=` compares True), groupby drops null keys and sorts by key, and
+`pd.Grouper` buckets are labelled like pandas and gap-filled locally.
+"""
+import ast
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+import pandas as pd
+
+
+class UnsupportedExpression(Exception):
+    """The expression uses a shape the compiler does not translate."""
+
+
+# Column types understood by the compiler (BigQuery standard SQL names)
+DATE_TYPES = {"DATE", "DATETIME"}
+NUMERIC_TYPES = {"INTEGER", "INT64", "FLOAT", "FLOAT64", "NUMERIC", "BIGNUMERIC"}
+
+_COMPARE_OPS = {
+    ast.Eq: "=",
+    ast.NotEq: "!=",
+    ast.Lt: "<",
+    ast.LtE: "<=",
+    ast.Gt: ">",
+    ast.GtE: ">=",
+}
+_FLIPPED_OPS = {"<": ">", "<=": ">=", ">": "<", ">=": "<=", "=": "=", "!=": "!="}
+
+_AGG_FUNCS = {"sum", "mean", "count", "size", "nunique", "min", "max"}
+_DT_PARTS = {"year": "YEAR", "quarter": "QUARTER", "month": "MONTH", "day": "DAY", "hour": "HOUR"}
+
+# pd.Grouper freq → canonical bucket name (pandas aliases across versions)
+_GROUPER_FREQS = {
+    "D": "D",
+    "h": "H", "H": "H",
+    "W": "W", "W-SUN": "W",
+    "M": "M", "ME": "M",
+    "MS": "MS",
+    "Q": "Q", "QE": "Q", "Q-DEC": "Q",
+    "QS": "QS", "QS-JAN": "QS",
+    "Y": "Y", "YE": "Y", "A": "Y", "A-DEC": "Y", "Y-DEC": "Y",
+    "YS": "YS", "AS": "YS", "AS-JAN": "YS", "YS-JAN": "YS",
+}
+# Canonical bucket → pandas freq used to rebuild the full bucket range
+_PANDAS_FREQS = {"D": "D", "H": "h", "W": "W-SUN", "M": "ME", "MS": "MS", "Q": "QE-DEC", "QS": "QS-JAN", "Y": "YE-DEC", "YS": "YS-JAN"}
+# Value used by pandas for buckets that contain no rows
+_EMPTY_BUCKET_FILL = {"sum": 0, "count": 0, "size": 0, "nunique": 0}
+
+
+class Dialect:
+    """SQL flavour differences between engines."""
+
+    name = "base"
+
+    def quote(self, ident: str) -> str:
+        raise NotImplementedError
+
+    def param(self, name: str) -> str:
+        raise NotImplementedError
+
+    def timestamp_literal(self, ts: pd.Timestamp) -> str:
+        raise NotImplementedError
+
+    def as_timestamp(self, col_sql: str, col_type: str) -> str:
+        raise NotImplementedError
+
+    def bucket(self, col_sql: str, col_type: str, freq: str) -> str:
+        raise NotImplementedError
+
+    def extract(self, part: str, col_sql: str) -> str:
+        return f"EXTRACT({part} FROM {col_sql})"
+
+    def sum(self, col_sql: str, col_type: str) -> str:
+        # pandas sums an empty / all-null group to 0
+        return f"COALESCE(SUM({col_sql}), 0)"
+
+
+class BigQueryDialect(Dialect):
+    name = "bigquery"
+
+    def quote(self, ident: str) -> str:
+        return f"`{ident}`"
+
+    def param(self, name: str) -> str:
+        return f"@{name}"
+
+    def timestamp_literal(self, ts: pd.Timestamp) -> str:
+        return f"DATETIME '{ts.strftime('%Y-%m-%d %H:%M:%S.%f')}'"
+
+    def as_timestamp(self, col_sql: str, col_type: str) -> str:
+        return f"DATETIME({col_sql})" if col_type == "DATE" else col_sql
+
+    def bucket(self, col_sql: str, col_type: str, freq: str) -> str:
+        if freq == "H":
+            if col_type == "DATE":
+                return f"DATETIME({col_sql})"
+            return f"DATETIME_TRUNC({col_sql}, HOUR)"
+        day = f"DATE({col_sql})"
+        expr = {
+            "D": day,
+            "W": f"DATE_ADD(DATE_TRUNC({day}, WEEK(MONDAY)), INTERVAL 6 DAY)",
+            "M": f"LAST_DAY({day}, MONTH)",
+            "MS": f"DATE_TRUNC({day}, MONTH)",
+            "Q": f"LAST_DAY({day}, QUARTER)",
+            "QS": f"DATE_TRUNC({day}, QUARTER)",
+            "Y": f"LAST_DAY({day}, YEAR)",
+            "YS": f"DATE_TRUNC({day}, YEAR)",
+        }[freq]
+        return f"DATETIME({expr})"
+
+
+BIGQUERY = BigQueryDialect()
+
+
+@dataclass
+class CompiledQuery:
+    """SQL text, its parameters, and a pandas post-processing step for the result."""
+    sql: str
+    params: dict[str, Any]
+    postprocess: Callable[[pd.DataFrame], pd.DataFrame]
+
+
+@dataclass
+class _Agg:
+    func: str
+    column: str | None  # None for size()
+    name: Any  # output column name (may be 0 for an unnamed size())
+
+
+@dataclass
+class _State:
+    """What the expression has done to `df` so far, outermost call last."""
+    stage: str = "rows"  # rows → groupby → aggregated
+    filters: list[str] = field(default_factory=list)
+    columns: list[str] | None = None  # row-stage projection
+    keys: list[tuple[str, str]] = field(default_factory=list)  # (sql, output name)
+    grouper: tuple[str, str] | None = None  # (output name, canonical freq)
+    as_index: bool = True
+    selection: list[str] | None = None
+    selection_is_series: bool = False
+    aggs: list[_Agg] = field(default_factory=list)
+    is_series: bool = False
+    order: list[tuple[Any, bool]] = field(default_factory=list)  # (output name, ascending)
+    limit: int | None = None
+    rename: dict[Any, Any] = field(default_factory=dict)
+    round_digits: int | None = None
+    referenced: set[str] = field(default_factory=set)
+
+
+class _Compiler:
+    def __init__(self, column_types: dict[str, str], dialect: Dialect):
+        self.column_types = column_types
+        self.dialect = dialect
+        self.params: dict[str, Any] = {}
+
+    # ── helpers ──────────────────────────────────────────────
+
+    def _fail(self, reason: str):
+        raise UnsupportedExpression(reason)
+
+    def _const(self, node: ast.AST) -> Any:
+        try:
+            return ast.literal_eval(node)
+        except (ValueError, SyntaxError):
+            self._fail(f"not a literal: {ast.unparse(node)}")
+
+    def _str_list(self, node: ast.AST) -> list[str]:
+        value = self._const(node)
+        if isinstance(value, str):
+            return [value]
+        if isinstance(value, (list, tuple)) and all(isinstance(v, str) for v in value):
+            return list(value)
+        self._fail("expected a column name or list of column names")
+
+    def _column(self, name: Any, state: _State) -> str:
+        if name not in self.column_types:
+            self._fail(f"unknown column {name!r}")
+        state.referenced.add(name)
+        return name
+
+    def _column_ref(self, node: ast.AST, state: _State) -> str | None:
+        """Return the column name for `df['col']` / `df.col`, else None."""
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == "df":
+            key = self._const(node.slice)
+            if isinstance(key, str):
+                return self._column(key, state)
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "df":
+            if node.attr in self.column_types:
+                return self._column(node.attr, state)
+        return None
+
+    def _dt_part(self, node: ast.AST, state: _State) -> tuple[str, str] | None:
+        """Return (sql, column) for `df['col'].dt.<part>`, else None."""
+        if (
+            isinstance(node, ast.Attribute)
+            and node.attr in _DT_PARTS
+            and isinstance(node.value, ast.Attribute)
+            and node.value.attr == "dt"
+        ):
+            col = self._column_ref(node.value.value, state)
+            if col is None or self.column_types[col] not in DATE_TYPES:
+                self._fail("unsupported .dt accessor")
+            return self.dialect.extract(_DT_PARTS[node.attr], self.dialect.quote(col)), col
+        return None
+
+    def _add_param(self, value: Any) -> str:
+        name = f"p{len(self.params)}"
+        self.params[name] = value
+        return self.dialect.param(name)
+
+    def _timestamp(self, node: ast.AST) -> pd.Timestamp | None:
+        """Parse `pd.Timestamp("...")`, `pd.to_datetime("...")` or a bare date string."""
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            if (
+                isinstance(node.func.value, ast.Name)
+                and node.func.value.id == "pd"
+                and node.func.attr in ("Timestamp", "to_datetime")
+                and len(node.args) == 1
+                and not node.keywords
+            ):
+                value = self._const(node.args[0])
+                if isinstance(value, str):
+                    return self._parse_timestamp(value)
+            return None
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            return self._parse_timestamp(node.value)
+        return None
+
+    def _parse_timestamp(self, value: str) -> pd.Timestamp:
+        try:
+            ts = pd.Timestamp(value)
+        except (ValueError, TypeError):
+            self._fail(f"not a timestamp: {value!r}")
+        if ts is pd.NaT or ts.tzinfo is not None:
+            self._fail("timezone-aware or empty timestamp")
+        return ts
+
+    def _value(self, node: ast.AST, col_type: str | None) -> str:
+        """Render the non-column side of a comparison."""
+        if col_type in DATE_TYPES:
+            ts = self._timestamp(node)
+            if ts is None:
+                self._fail("date column compared with a non-timestamp")
+            return self.dialect.timestamp_literal(ts)
+        if isinstance(node, ast.Call):
+            self._fail(f"unsupported call in filter: {ast.unparse(node)}")
+        value = self._const(node)
+        if isinstance(value, bool):
+            return "TRUE" if value else "FALSE"
+        if isinstance(value, (int, float)):
+            if col_type not in NUMERIC_TYPES:
+                self._fail("number compared with a non-numeric column")
+            return repr(value)
+        if isinstance(value, str):
+            if col_type in NUMERIC_TYPES:
+                self._fail("string compared with a numeric column")
+            return self._add_param(value)
+        self._fail(f"unsupported literal {value!r}")
+
+    def _operand(self, node: ast.AST, state: _State) -> tuple[str, str | None] | None:
+        """Return (sql, column type) when `node` is a column or `.dt` part, else None."""
+        col = self._column_ref(node, state)
+        if col is not None:
+            col_type = self.column_types[col]
+            if col_type == "TIMESTAMP":
+                # Loaded as tz-aware in pandas; naive comparisons fail there too
+                self._fail("TIMESTAMP columns are not pushed down")
+            sql = self.dialect.quote(col)
+            if col_type in DATE_TYPES:
+                sql = self.dialect.as_timestamp(sql, col_type)
+            return sql, col_type
+        part = self._dt_part(node, state)
+        if part is not None:
+            return part[0], "INT64"
+        return None
+
+    # ── filters ──────────────────────────────────────────────
+
+    def mask(self, node: ast.AST, state: _State) -> str:
+        """Compile a boolean mask into a null-safe SQL predicate."""
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+            op = "AND" if isinstance(node.op, ast.BitAnd) else "OR"
+            return f"({self.mask(node.left, state)} {op} {self.mask(node.right, state)})"
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Invert):
+            return f"(NOT {self.mask(node.operand, state)})"
+
+        if isinstance(node, ast.Compare):
+            if len(node.ops) != 1 or type(node.ops[0]) not in _COMPARE_OPS:
+                self._fail("chained or unsupported comparison")
+            op = _COMPARE_OPS[type(node.ops[0])]
+            left = self._operand(node.left, state)
+            right = self._operand(node.comparators[0], state)
+            if left and right:
+                lhs, rhs = left[0], right[0]
+            elif left:
+                lhs, rhs = left[0], self._value(node.comparators[0], left[1])
+            elif right:
+                lhs, rhs = right[0], self._value(node.left, right[1])
+                op = _FLIPPED_OPS[op]
+            else:
+                self._fail("comparison without a column")
+            # pandas: NaN != x is True, every other comparison with NaN is False
+            default = "TRUE" if op == "!=" else "FALSE"
+            return f"COALESCE({lhs} {op} {rhs}, {default})"
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            method = node.func.attr
+            target = self._operand(node.func.value, state)
+            if target is None:
+                self._fail(f"unsupported mask method target: {ast.unparse(node)}")
+            sql, col_type = target
+            if node.keywords:
+                self._fail(f"keyword arguments to .{method}()")
+            if method in ("isna", "isnull") and not node.args:
+                return f"({sql} IS NULL)"
+            if method in ("notna", "notnull") and not node.args:
+                return f"({sql} IS NOT NULL)"
+            if method == "isin" and len(node.args) == 1:
+                if not isinstance(node.args[0], (ast.List, ast.Tuple, ast.Set)) or not node.args[0].elts:
+                    self._fail("isin() needs a non-empty literal list")
+                values = ", ".join(self._value(v, col_type) for v in node.args[0].elts)
+                return f"COALESCE({sql} IN ({values}), FALSE)"
+            if method == "between" and len(node.args) == 2:
+                low = self._value(node.args[0], col_type)
+                high = self._value(node.args[1], col_type)
+                return f"COALESCE({sql} BETWEEN {low} AND {high}, FALSE)"
+
+        self._fail(f"unsupported mask: {ast.unparse(node)}")
+
+    # ── groupby keys and aggregations ────────────────────────
+
+    def group_key(self, node: ast.AST, state: _State):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            col = self._column(node.value, state)
+            if self.column_types[col] == "TIMESTAMP":
+                self._fail("TIMESTAMP group keys are not pushed down")
+            state.keys.append((self.dialect.quote(col), col))
+            return
+
+        if isinstance(node, ast.Call) and ast.unparse(node.func) == "pd.Grouper":
+            kwargs = {kw.arg: self._const(kw.value) for kw in node.keywords}
+            if node.args or set(kwargs) != {"key", "freq"}:
+                self._fail("pd.Grouper needs exactly key= and freq=")
+            col = self._column(kwargs["key"], state)
+            col_type = self.column_types[col]
+            freq = _GROUPER_FREQS.get(kwargs["freq"])
+            if col_type not in DATE_TYPES or freq is None:
+                self._fail(f"unsupported Grouper freq {kwargs['freq']!r} on {col_type}")
+            state.keys.append((self.dialect.bucket(self.dialect.quote(col), col_type, freq), col))
+            state.grouper = (col, freq)
+            return
+
+        part = self._dt_part(node, state)
+        if part is not None:
+            state.keys.append(part)
+            return
+
+        self._fail(f"unsupported groupby key: {ast.unparse(node)}")
+
+    def agg_sql(self, agg: _Agg) -> str:
+        if agg.func == "size":
+            return "COUNT(*)"
+        col = self.dialect.quote(agg.column)
+        if self.column_types[agg.column] == "TIMESTAMP":
+            self._fail("TIMESTAMP aggregations are not pushed down")
+        if agg.func in ("sum", "mean") and self.column_types[agg.column] not in NUMERIC_TYPES:
+            self._fail(f"{agg.func}() of a non-numeric column")
+        return {
+            "sum": self.dialect.sum(col, self.column_types[agg.column]),
+            "mean": f"AVG({col})",
+            "count": f"COUNT({col})",
+            "nunique": f"COUNT(DISTINCT {col})",
+            "min": f"MIN({col})",
+            "max": f"MAX({col})",
+        }[agg.func]
+
+    # ── method chain ─────────────────────────────────────────
+
+    def visit(self, node: ast.AST) -> _State:
+        if isinstance(node, ast.Name) and node.id == "df":
+            return _State()
+
+        if isinstance(node, ast.Subscript):
+            state = self.visit(node.value)
+            return self._subscript(state, node.slice)
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            state = self.visit(node.func.value)
+            return self._method(state, node.func.attr, node.args, {kw.arg: kw.value for kw in node.keywords})
+
+        self._fail(f"unsupported node: {ast.unparse(node)}")
+
+    def _subscript(self, state: _State, key: ast.AST) -> _State:
+        if state.order or state.limit is not None:
+            self._fail("selection after sort/head")
+
+        if state.stage == "rows":
+            if isinstance(key, ast.Constant) or isinstance(key, ast.List):
+                cols = self._str_list(key)
+                if isinstance(key, ast.Constant):
+                    # A bare Series of rows would be serialized with its row index
+                    self._fail("row-level Series selection")
+                state.columns = [self._column(c, state) for c in cols]
+                return state
+            if state.columns is not None:
+                self._fail("filter after column selection")
+            state.filters.append(self.mask(key, state))
+            return state
+
+        if state.stage == "groupby" and state.selection is None:
+            cols = self._str_list(key)
+            state.selection = [self._column(c, state) for c in cols]
+            state.selection_is_series = isinstance(key, ast.Constant)
+            return state
+
+        self._fail("unsupported selection")
+
+    def _method(self, state: _State, method: str, args: list, kwargs: dict) -> _State:
+        if method == "groupby":
+            return self._groupby(state, args, kwargs)
+        if method in _AGG_FUNCS:
+            return self._aggregate(state, method, args, kwargs)
+        if method in ("agg", "aggregate"):
+            return self._agg_call(state, args, kwargs)
+        if method == "reset_index":
+            return self._reset_index(state, args, kwargs)
+        if method in ("sort_values", "sort_index"):
+            return self._sort(state, method, args, kwargs)
+        if method in ("head", "nlargest", "nsmallest"):
+            return self._limit(state, method, args, kwargs)
+        if method == "rename":
+            if args or set(kwargs) != {"columns"}:
+                self._fail("rename() needs columns=")
+            mapping = self._const(kwargs["columns"])
+            if not isinstance(mapping, dict):
+                self._fail("rename(columns=...) must be a dict")
+            state.rename.update(mapping)
+            return state
+        if method == "round":
+            if kwargs or len(args) > 1 or state.stage != "aggregated":
+                self._fail("unsupported round()")
+            state.round_digits = self._const(args[0]) if args else 0
+            return state
+        self._fail(f"unsupported method .{method}()")
+
+    def _groupby(self, state: _State, args: list, kwargs: dict) -> _State:
+        if state.stage != "rows" or state.columns is not None:
+            self._fail("groupby after selection")
+        if len(args) != 1:
+            self._fail("groupby() needs exactly one key argument")
+        for name, value in kwargs.items():
+            if name == "as_index":
+                state.as_index = bool(self._const(value))
+            elif name in ("sort", "dropna") and self._const(value) is True:
+                continue
+            else:
+                self._fail(f"groupby({name}=...)")
+
+        keys = args[0].elts if isinstance(args[0], ast.List) else [args[0]]
+        for key in keys:
+            self.group_key(key, state)
+        if state.grouper and len(state.keys) > 1:
+            self._fail("pd.Grouper combined with other keys")
+        if len({name for _, name in state.keys}) != len(state.keys):
+            self._fail("duplicate group keys")
+        state.stage = "groupby"
+        return state
+
+    def _aggregate(self, state: _State, func: str, args: list, kwargs: dict) -> _State:
+        if state.stage != "groupby" or args or kwargs:
+            self._fail(f"unsupported .{func}()")
+
+        if func == "size":
+            if state.as_index:
+                state.aggs = [_Agg("size", None, 0)]
+                state.is_series = True
+            else:
+                state.aggs = [_Agg("size", None, "size")]
+            state.stage = "aggregated"
+            return state
+
+        if state.selection is None:
+            self._fail(f"{func}() over every column")
+        state.aggs = [_Agg(func, col, col) for col in state.selection]
+        state.is_series = state.selection_is_series and state.as_index
+        state.stage = "aggregated"
+        return state
+
+    def _agg_call(self, state: _State, args: list, kwargs: dict) -> _State:
+        if state.stage != "groupby":
+            self._fail("agg() outside groupby")
+
+        if args and not kwargs and len(args) == 1:
+            spec = self._const(args[0])
+            if not isinstance(spec, dict) or state.selection is not None:
+                self._fail("only dict-form agg() is supported")
+            for col, func in spec.items():
+                if func not in _AGG_FUNCS - {"size"}:
+                    self._fail(f"agg function {func!r}")
+                state.aggs.append(_Agg(func, self._column(col, state), col))
+        elif kwargs and not args:
+            if state.selection is not None:
+                self._fail("named agg() after a selection")
+            for name, value in kwargs.items():
+                spec = self._const(value)
+                if not (isinstance(spec, tuple) and len(spec) == 2 and spec[1] in _AGG_FUNCS - {"size"}):
+                    self._fail("named agg() needs (column, func) tuples")
+                state.aggs.append(_Agg(spec[1], self._column(spec[0], state), name))
+        else:
+            self._fail("unsupported agg() call")
+
+        state.stage = "aggregated"
+        return state
+
+    def _reset_index(self, state: _State, args: list, kwargs: dict) -> _State:
+        if state.stage != "aggregated" or args:
+            self._fail("reset_index() outside an aggregation")
+        for name, value in kwargs.items():
+            if name == "name" and state.is_series:
+                state.aggs[0].name = self._const(value)
+            elif name == "drop" and self._const(value) is False:
+                continue
+            else:
+                self._fail(f"reset_index({name}=...)")
+        state.as_index = False
+        state.is_series = False
+        return state
+
+    def _output_names(self, state: _State) -> list[Any]:
+        if state.stage == "aggregated":
+            return [name for _, name in state.keys] + [agg.name for agg in state.aggs]
+        return list(state.columns or self.column_types)
+
+    def _sort(self, state: _State, method: str, args: list, kwargs: dict) -> _State:
+        if state.stage == "groupby" or state.limit is not None or state.order:
+            self._fail(f"{method}() here")
+        ascending_node = kwargs.pop("ascending", None)
+
+        if method == "sort_index":
+            if args or kwargs or state.stage != "aggregated" or not state.as_index:
+                self._fail("unsupported sort_index()")
+            by = [name for _, name in state.keys]
+        elif state.is_series:
+            if args or kwargs:
+                self._fail("Series.sort_values() takes only ascending=")
+            by = [state.aggs[0].name]
+        else:
+            by_node = args[0] if args else kwargs.pop("by", None)
+            if by_node is None or len(args) > 1 or kwargs:
+                self._fail("unsupported sort_values() arguments")
+            by = self._str_list(by_node)
+
+        ascending = self._const(ascending_node) if ascending_node is not None else True
+        if isinstance(ascending, bool):
+            ascending = [ascending] * len(by)
+        if not isinstance(ascending, list) or len(ascending) != len(by):
+            self._fail("ascending must be a bool or a list matching by")
+
+        names = self._output_names(state)
+        for col in by:
+            if col not in names:
+                self._fail(f"sort by {col!r} which is not in the result")
+        state.order = list(zip(by, ascending))
+        return state
+
+    def _limit(self, state: _State, method: str, args: list, kwargs: dict) -> _State:
+        if state.stage == "groupby" or state.limit is not None:
+            self._fail(f"{method}() here")
+        if kwargs:
+            self._fail(f"{method}() keyword arguments")
+
+        if method == "head":
+            n = self._const(args[0]) if args else 5
+        else:
+            if state.order:
+                self._fail(f"{method}() after sort")
+            if state.is_series and len(args) == 1:
+                by = state.aggs[0].name
+            elif not state.is_series and len(args) == 2:
+                by = self._const(args[1])
+            else:
+                self._fail(f"unsupported {method}() arguments")
+            n = self._const(args[0])
+            if by not in self._output_names(state):
+                self._fail(f"{method}() on a column not in the result")
+            state.order = [(by, method == "nsmallest")]
+
+        if not isinstance(n, int) or isinstance(n, bool) or n < 0:
+            self._fail("head() needs a non-negative integer")
+        state.limit = n
+        return state
+
+    # ── SQL assembly ─────────────────────────────────────────
+
+    def build(self, state: _State, table_ref: str) -> CompiledQuery:
+        if state.stage == "groupby":
+            self._fail("groupby without aggregation")
+        if state.stage == "rows" and state.columns is None:
+            # Full rows — every column is needed in the output
+            state.referenced.update(self.column_types)
+        elif state.stage == "rows":
+            state.referenced.update(state.columns)
+
+        q = self.dialect.quote
+        source_cols = ", ".join(q(c) for c in self.column_types if c in state.referenced)
+        source = f"(SELECT {source_cols} FROM {q(table_ref)})"
+
+        # Output columns use positional aliases; real names are restored in postprocess
+        if state.stage == "aggregated":
+            select = [sql for sql, _ in state.keys] + [self.agg_sql(a) for a in state.aggs]
+        else:
+            select = [q(c) for c in (state.columns or list(self.column_types))]
+        names = self._output_names(state)
+        if len(set(map(str, names))) != len(names):
+            self._fail("duplicate output column names")
+        aliases = [f"c{i}" for i in range(len(select))]
+        alias_of = dict(zip(names, aliases))
+
+        where = list(state.filters)
+        if state.stage == "aggregated":
+            # pandas groupby drops null keys (dropna=True)
+            where += [f"{sql} IS NOT NULL" for sql, _ in state.keys]
+
+        sql = "SELECT " + ", ".join(f"{expr} AS {alias}" for expr, alias in zip(select, aliases))
+        sql += f" FROM {source} AS t"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if state.stage == "aggregated" and state.keys:
+            sql += " GROUP BY " + ", ".join(aliases[: len(state.keys)])
+
+        # Gap-filled Grouper results are ordered and limited locally, after filling
+        local_tail = state.grouper is not None
+        order = state.order
+        if not order and state.stage == "aggregated":
+            order = [(name, True) for _, name in state.keys]
+        if order and not local_tail:
+            sql += " ORDER BY " + ", ".join(
+                f"{alias_of[name]} {'ASC' if asc else 'DESC'} NULLS LAST" for name, asc in order
+            )
+        if state.limit is not None and not local_tail:
+            sql += f" LIMIT {state.limit}"
+
+        return CompiledQuery(sql=sql, params=dict(self.params), postprocess=_postprocessor(state, names, aliases, order, local_tail))
+
+
+def _postprocessor(state: _State, names: list, aliases: list[str], order: list, local_tail: bool):
+    key_names = [name for _, name in state.keys]
+
+    def postprocess(frame: pd.DataFrame) -> pd.DataFrame:
+        frame = frame.rename(columns=dict(zip(aliases, names)))
+        if state.grouper is not None:
+            key, freq = state.grouper
+            frame[key] = pd.to_datetime(frame[key])
+            if len(frame):
+                full = pd.date_range(frame[key].min(), frame[key].max(), freq=_PANDAS_FREQS[freq], name=key)
+                indexed = frame.set_index(key)
+                frame = pd.DataFrame({
+                    agg.name: indexed[agg.name].reindex(full, fill_value=_EMPTY_BUCKET_FILL.get(agg.func))
+                    for agg in state.aggs
+                }).reset_index()
+            if order:
+                frame = frame.sort_values([n for n, _ in order], ascending=[a for _, a in order], kind="stable")
+            if state.limit is not None:
+                frame = frame.head(state.limit)
+
+        if state.round_digits is not None:
+            frame = frame.round(state.round_digits)
+        if state.stage == "aggregated" and state.as_index and not state.is_series:
+            # A grouped DataFrame keeps its keys in the index, which is not serialized
+            frame = frame.drop(columns=key_names)
+        if state.rename:
+            frame = frame.rename(columns=state.rename)
+        return frame.reset_index(drop=True)
+
+    return postprocess
+
+
+def compile_expression(
+    operation: str,
+    table_ref: str,
+    column_types: dict[str, str],
+    dialect: Dialect = BIGQUERY,
+) -> CompiledQuery:
+    """
+    Compile a `query_data` pandas expression into SQL.
+
+    Args:
+        operation: The pandas expression, with the frame named `df`.
+        table_ref: Fully-qualified table name to select from.
+        column_types: {column: BigQuery type} of the table.
+        dialect: SQL flavour to emit.
+
+    The query reads the whole table. Callers must not push down against tables
+    the in-memory path only sees a truncated sample of (see
+    `table_loader.make_pushdown_runner`), since no row cap would select the
+    same rows.
+
+    Raises:
+        UnsupportedExpression: if the expression is outside the supported shapes.
+    """
+    try:
+        tree = ast.parse(operation.strip(), mode="eval")
+    except SyntaxError as e:
+        raise UnsupportedExpression(f"syntax error: {e}")
+
+    compiler = _Compiler(column_types, dialect)
+    state = compiler.visit(tree.body)
+    return compiler.build(state, table_ref)
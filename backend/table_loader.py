@@ -0,0 +1,131 @@
+"""
+Table Loader — resolves a BigQuery datamart into a ready-to-query DataFrame.
+
+Loading is two-phase: `get_table_metadata` returns the table schema from
+BigQuery metadata (no rows read), then `load_table` fetches only the columns
+a query actually needs. Frames are served from the shared snapshot cache,
+keyed by the table's `modified` timestamp, and downloaded from BigQuery only
+on a miss.
+"""
+import logging
+import time
+from typing import Callable
+
+import pandas as pd
+
+from bq_client import bq, MAX_ROWS
+from data_manager import data_manager
+from snapshot_cache import snapshot_cache
+from sql_pushdown import compile_expression, UnsupportedExpression
+
+logger = logging.getLogger(__name__)
+
+# BigQuery type → the pandas dtype the column will have once loaded
+_BQ_TO_PANDAS_DTYPE = {
+    "STRING": "object",
+    "INTEGER": "int64",
+    "INT64": "int64",
+    "FLOAT": "float64",
+    "FLOAT64": "float64",
+    "NUMERIC": "float64",
+    "BIGNUMERIC": "float64",
+    "BOOLEAN": "bool",
+    "BOOL": "bool",
+    "DATE": "datetime64[ns]",
+    "DATETIME": "datetime64[ns]",
+    "TIMESTAMP": "datetime64[ns, UTC]",
+}
+
+
+def get_table_metadata(dataset: str, table_name: str) -> dict:
+    """Return version, row count and column types of a table (see BQClient.get_table_metadata)."""
+    return bq.get_table_metadata(table_name, dataset)
+
+
+def schema_from_metadata(metadata: dict) -> dict:
+    """Build a `get_data_schema`-shaped dict from table metadata, without reading rows."""
+    return {
+        "columns": list(metadata["columns"]),
+        "dtypes": {
+            col: _BQ_TO_PANDAS_DTYPE.get(bq_type, "object")
+            for col, bq_type in metadata["columns"].items()
+        },
+        "row_count": min(metadata["num_rows"], MAX_ROWS),
+    }
+
+
+def load_table(
+    dataset: str,
+    table_name: str,
+    columns: list[str] | None = None,
+    metadata: dict | None = None,
+) -> pd.DataFrame:
+    """
+    Return the (shared, read-only) snapshot of `dataset.table_name`.
+
+    Args:
+        columns: Columns the caller needs; None loads every column.
+        metadata: Result of `get_table_metadata`, to skip the metadata call.
+
+    The returned frame contains at least `columns`, possibly more if a wider
+    snapshot of the same table version is already cached.
+    """
+    metadata = metadata or get_table_metadata(dataset, table_name)
+    all_columns = list(metadata["columns"])
+    wanted = [c for c in all_columns if c in set(columns)] if columns else all_columns
+
+    def _fetch(fetch_columns: list[str]) -> pd.DataFrame:
+        start = time.perf_counter()
+        # Keep table order; fetch everything with SELECT * when nothing is projected away
+        ordered = [c for c in all_columns if c in set(fetch_columns)]
+        projection = None if len(ordered) == len(all_columns) else ordered
+        frame = data_manager.prepare_frame(
+            bq.fetch_table_frame(table_name, dataset, columns=projection),
+            table_key=(dataset, table_name),
+            bq_types=metadata["columns"],
+        )
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        logger.info(
+            f"[BQ] Fetched {len(frame)} rows x {len(frame.columns)}/{len(all_columns)} columns "
+            f"from {dataset}.{table_name} in {elapsed_ms:.0f} ms"
+        )
+        return frame
+
+    return snapshot_cache.get_or_load((dataset, table_name, metadata["version"]), _fetch, wanted)
+
+
+def make_pushdown_runner(dataset: str, table_name: str, metadata: dict) -> Callable[[str], pd.DataFrame | None]:
+    """
+    Build a `DataManager.set_pushdown` runner for a BigQuery table.
+
+    The runner compiles a pandas expression to BigQuery SQL and returns the
+    (small) result frame, or None when the expression cannot be compiled.
+
+    Tables larger than MAX_ROWS are never pushed down: the in-memory path sees
+    an arbitrary MAX_ROWS-row sample of them, and SQL over the whole table (or
+    over a differently chosen sample) would answer a different question.
+    """
+    table_ref = bq.table_ref(table_name, dataset)
+    truncated = metadata["num_rows"] > MAX_ROWS
+    if truncated:
+        logger.info(
+            f"[PUSHDOWN] {dataset}.{table_name} has {metadata['num_rows']:,} rows (> {MAX_ROWS:,}), "
+            f"evaluating in memory so results match the loaded rows"
+        )
+
+    def _run(operation: str) -> pd.DataFrame | None:
+        if truncated:
+            return None
+        try:
+            compiled = compile_expression(operation, table_ref, metadata["columns"])
+        except UnsupportedExpression as e:
+            logger.info(f"[PUSHDOWN] Falling back to pandas ({e}): {operation}")
+            return None
+
+        start = time.perf_counter()
+        frame = bq.run_query_frame(compiled.sql, compiled.params)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        logger.info(f"[PUSHDOWN] {dataset}.{table_name} returned {len(frame)} rows in {elapsed_ms:.0f} ms")
+        return compiled.postprocess(frame)
+
+    return _run
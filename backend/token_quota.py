@@ -3,11 +3,27 @@ Token quota manager.
 
 Tracks per-user daily token usage against limits stored in Firestore.
 Users not registered in Firestore are denied access.
-Usage counters reset automatically at the start of each new day.
+Usage counters reset automatically at the start of each new day; daily
+usage is kept in sharded counter docs (see firestore_config).
+
+Each request reserves an estimate (QUOTA_RESERVATION_TOKENS) in the counters
+before it runs and settles the difference when it finishes, so requests
+starting meanwhile — on any instance — already see it.
+
+QUOTA_MAX_IN_FLIGHT caps concurrent requests per user per instance only: the
+count lives in this process, so with N instances a user can have up to
+N × QUOTA_MAX_IN_FLIGHT requests running. Their reservations are in
+Firestore, so the quota is overshot only by requests admitted at the same
+moment (before either reservation is visible) and by what requests use
+beyond their reserved estimates.
 
 All state is persisted in Firestore — survives container redeployments.
 """
 
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
 from datetime import date
 
 from firestore_config import (
@@ -20,53 +36,120 @@ from firestore_config import (
     delete_user,
     get_all_datamarts as _fs_get_all_datamarts,
     get_datamart,
+    get_datamarts_for_dataset,
     set_datamart,
     delete_datamart,
-    consume_tokens_transactional,
+    get_user_datamarts,
+    remove_user_from_datamarts,
+    get_token_usage,
+    get_token_usage_many,
+    add_token_usage,
 )
 
 
+# Tokens held for a request while it runs (capped at what the user has left)
+QUOTA_RESERVATION_TOKENS = int(os.getenv("QUOTA_RESERVATION_TOKENS", "20000"))
+# Requests one user may have running at once on this instance (not across instances)
+QUOTA_MAX_IN_FLIGHT = int(os.getenv("QUOTA_MAX_IN_FLIGHT", "3"))
+
+
 def _get_today() -> str:
     """Get today's date as ISO string."""
     return date.today().isoformat()
 
 
+def _daily_limit(user: dict | None, settings: dict) -> int:
+    default = settings.get("default_daily_limit", 100_000)
+    return user.get("daily_limit", default) if user else default
+
+
+def _used_today(user: dict | None, sharded: int = 0) -> int:
+    """
+    Today's usage: the sharded counters plus any legacy `used_today` on the
+    user doc (written before usage moved to shards; 0 once its day is over).
+    """
+    if not user:
+        return 0
+    legacy = user.get("used_today", 0) if user.get("usage_date") == _get_today() else 0
+    return legacy + sharded
+
+
+# ── Request Context ──────────────────────────────────────────────────
+
+
+@dataclass
+class UserContext:
+    """
+    Everything the quota and ACL checks need about one user, read once.
+
+    Build it with `get_user_context` at the start of a request and pass it to
+    the functions below; without one, each function reads Firestore itself.
+    """
+    email: str
+    user: dict | None              # prompt_to_viz_users doc, None if not registered
+    settings: dict
+    admins: list[str]
+    datamarts: list[str] | None    # per-user datamart index, None if not built yet or the user has no doc
+    usage: int = 0                 # today's tokens from the sharded usage counters
+
+    @property
+    def registered(self) -> bool:
+        return self.user is not None
+
+    @property
+    def is_admin(self) -> bool:
+        return self.email.lower() in {a.lower() for a in self.admins}
+
+
+# The reads of a context are independent — issue them concurrently
+_context_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="user-context")
+
+
+def get_user_context(email: str) -> UserContext:
+    """Read the user doc, settings, admins, datamart index and today's usage in parallel."""
+    user = _context_pool.submit(get_user, email)
+    settings = _context_pool.submit(get_settings)
+    admins = _context_pool.submit(get_admins)
+    datamarts = _context_pool.submit(get_user_datamarts, email)
+    usage = _context_pool.submit(get_token_usage, email, _get_today())
+    return UserContext(
+        email, user.result(), settings.result(), admins.result(), datamarts.result(), usage.result()
+    )
+
+
 # ── User Checks ──────────────────────────────────────────────────────
 
 
-def is_admin(email: str) -> bool:
+def is_admin(email: str, ctx: UserContext | None = None) -> bool:
     """Check if an email is in the admins list."""
+    if ctx is not None:
+        return ctx.is_admin
     admins = get_admins()
     return email.lower() in {a.lower() for a in admins}
 
 
-def is_registered(email: str) -> bool:
+def is_registered(email: str, ctx: UserContext | None = None) -> bool:
     """Check if an email is registered in the quota config."""
+    if ctx is not None:
+        return ctx.registered
     return get_user(email) is not None
 
 
-def get_daily_limit(email: str) -> int:
+def get_daily_limit(email: str, ctx: UserContext | None = None) -> int:
     """Get the daily token limit for a user."""
-    user = get_user(email)
-    if user:
-        settings = get_settings()
-        return user.get("daily_limit", settings.get("default_daily_limit", 100_000))
-    settings = get_settings()
-    return settings.get("default_daily_limit", 100_000)
+    if ctx is not None:
+        return _daily_limit(ctx.user, ctx.settings)
+    return _daily_limit(get_user(email), get_settings())
 
 
-def get_usage(email: str) -> int:
+def get_usage(email: str, ctx: UserContext | None = None) -> int:
     """Get today's token usage for a user. Resets if date has changed."""
-    user = get_user(email)
-    if not user:
-        return 0
-    today = _get_today()
-    if user.get("usage_date") != today:
-        return 0
-    return user.get("used_today", 0)
+    if ctx is not None:
+        return _used_today(ctx.user, ctx.usage)
+    return _used_today(get_user(email), get_token_usage(email, _get_today()))
 
 
-def get_quota_info(email: str) -> dict:
+def get_quota_info(email: str, ctx: UserContext | None = None) -> dict:
     """
     Get full quota information for a user.
 
@@ -81,8 +164,9 @@ def get_quota_info(email: str) -> dict:
             "is_admin": bool,
         }
     """
-    registered = is_registered(email)
-    admin = is_admin(email)
+    ctx = ctx or get_user_context(email)
+    registered = ctx.registered
+    admin = ctx.is_admin
 
     if not registered:
         return {
@@ -95,8 +179,8 @@ def get_quota_info(email: str) -> dict:
             "is_admin": admin,
         }
 
-    limit = get_daily_limit(email)
-    used = get_usage(email)
+    limit = _daily_limit(ctx.user, ctx.settings)
+    used = _used_today(ctx.user, ctx.usage)
     remaining = max(0, limit - used)
 
     return {
@@ -110,33 +194,110 @@ def get_quota_info(email: str) -> dict:
     }
 
 
-def consume_tokens(email: str, amount: int) -> dict:
+# ── Reservations ─────────────────────────────────────────────────────
+
+
+@dataclass
+class TokenReservation:
+    """Tokens added to a user's counters for a request that is still running."""
+    email: str
+    day: str
+    amount: int
+    settled: bool = False
+
+
+_in_flight: dict[str, int] = {}
+_in_flight_lock = threading.Lock()
+
+
+def _leave(email: str):
+    with _in_flight_lock:
+        remaining = _in_flight.get(email, 0) - 1
+        if remaining > 0:
+            _in_flight[email] = remaining
+        else:
+            _in_flight.pop(email, None)
+
+
+def reserve_tokens(email: str, ctx: UserContext | None = None) -> TokenReservation | None:
     """
-    Deduct tokens from a user's daily quota using a Firestore transaction.
+    Reserve QUOTA_RESERVATION_TOKENS (at most what remains today) before a request runs.
+
+    Returns None when the user already has QUOTA_MAX_IN_FLIGHT requests
+    running on this instance. Settle the reservation with `consume_tokens`,
+    or return it with `release_tokens` if the request ends without a charge.
+    """
+    key = email.lower()
+    with _in_flight_lock:
+        if _in_flight.get(key, 0) >= QUOTA_MAX_IN_FLIGHT:
+            return None
+        _in_flight[key] = _in_flight.get(key, 0) + 1
+
+    try:
+        amount = min(QUOTA_RESERVATION_TOKENS, get_quota_info(email, ctx)["remaining"])
+        day = _get_today()
+        if amount > 0:
+            add_token_usage(email, amount, day)
+    except Exception:
+        _leave(key)
+        raise
+    return TokenReservation(key, day, max(amount, 0))
+
+
+def release_tokens(reservation: TokenReservation | None):
+    """Give back an unsettled reservation (no-op once `consume_tokens` has settled it)."""
+    if reservation is None or reservation.settled:
+        return
+    reservation.settled = True
+    _leave(reservation.email)
+    if reservation.amount:
+        add_token_usage(reservation.email, -reservation.amount, reservation.day)
+
+
+def consume_tokens(
+    email: str, amount: int, ctx: UserContext | None = None, reservation: TokenReservation | None = None
+) -> dict:
+    """
+    Record tokens used by a finished request against the user's daily quota.
+
+    With a `reservation`, only the difference between `amount` and the
+    reserved estimate is added (on the reservation's day). The increment goes
+    to one of the user's sharded usage counters, so concurrent requests do
+    not contend on a transaction. The returned usage is computed from the
+    context and this request's increments; the counters are not re-read.
 
     Args:
         email: User's email
         amount: Number of tokens to consume
+        ctx: The request's user context, if already loaded
+        reservation: The request's reservation from `reserve_tokens`, if any
 
     Returns:
         Updated quota info dict
 
     Raises:
-        ValueError: If user is not registered or has exceeded quota
+        ValueError: If user is not registered
     """
-    if not is_registered(email):
+    preloaded = ctx is not None  # read at request start, before the reservation
+    ctx = ctx or get_user_context(email)
+    if not ctx.registered:
+        release_tokens(reservation)
         raise ValueError(f"User {email} is not registered for token quota.")
 
-    consume_tokens_transactional(email, amount)
-    return get_quota_info(email)
+    day, delta = _get_today(), amount
+    if reservation is not None and not reservation.settled:
+        reservation.settled = True
+        _leave(reservation.email)
+        day, delta = reservation.day, amount - reservation.amount
+    if delta:
+        add_token_usage(email, delta, day)
+    return get_quota_info(email, replace(ctx, usage=ctx.usage + (amount if preloaded else delta)))
 
 
-def check_quota(email: str) -> bool:
+def check_quota(email: str, ctx: UserContext | None = None) -> bool:
     """Quick check if user has tokens remaining today."""
-    if not is_registered(email):
-        return False
-    info = get_quota_info(email)
-    return info["remaining"] > 0
+    info = get_quota_info(email, ctx)
+    return info["registered"] and info["remaining"] > 0
 
 
 # ── Admin Functions ──────────────────────────────────────────────────
@@ -150,11 +311,12 @@ def get_all_quota_settings() -> list[dict]:
     users = get_all_users()
     admins = {a.lower() for a in get_admins()}
     settings = get_settings()
+    usage = get_token_usage_many(list(users), _get_today())
     result = []
 
     for email, info in users.items():
-        used = get_usage(email)
-        limit = info.get("daily_limit", settings.get("default_daily_limit", 100_000))
+        used = _used_today(info, usage.get(email.lower(), 0))
+        limit = _daily_limit(info, settings)
         result.append({
             "email": email,
             "name": info.get("name", ""),
@@ -217,6 +379,9 @@ def remove_user_quota(email: str) -> bool:
     removed = delete_user(email)
 
     if removed:
+        # Revoke datamart access (access lists + per-user index)
+        remove_user_from_datamarts(email)
+
         # Also remove from admins if present
         admins = get_admins()
         new_admins = [a for a in admins if a.lower() != email.lower()]
@@ -256,7 +421,7 @@ def sync_datamarts(available_tables: list[dict]) -> dict:
     Reconciles Firestore with the list of tables found in BQ:
     - If a table exists in BQ but not in Firestore: Add it (0 access).
     - If a table exists in both: Skip it (preserves existing permissions).
-    - If a table exists in Firestore but not in BQ: Delete it.
+    - If a table exists in Firestore but not in BQ: Delete it (and its per-user index entries).
     
     available_tables: [{"dataset": "...", "table": "..."}]
     """
@@ -295,16 +460,46 @@ def update_datamart_access(dataset: str, table: str, emails: list[str]) -> dict:
     return _fs_get_all_datamarts()
 
 
-def has_datamart_access(email: str, dataset: str, table: str) -> bool:
+def has_datamart_access(email: str, dataset: str, table: str, ctx: UserContext | None = None) -> bool:
     """Check if a user has access to a specific datamart."""
     # Admins always have access
-    if is_admin(email):
+    if is_admin(email, ctx):
         return True
 
     key = f"{dataset}.{table}"
+    indexed = ctx.datamarts if ctx is not None else get_user_datamarts(email)
+    if indexed is not None:
+        return key in indexed
+
+    # Index not built yet, or no index doc for this user — fall back to the table's access list
     allowed_users = get_datamart(key)
 
     if allowed_users is None:
         return False
 
     return email.lower() in {u.lower() for u in allowed_users}
+
+
+def accessible_tables(email: str, dataset: str, tables: list[str], ctx: UserContext | None = None) -> list[str]:
+    """
+    Filter `tables` of `dataset` down to those the user may access.
+
+    Resolves the whole list with one admin check and one read of the user's
+    datamart index (or, before the index is built and for users without an
+    index doc, one datamart query)
+    instead of `has_datamart_access` per table.
+    """
+    if is_admin(email, ctx):
+        return list(tables)
+
+    indexed = ctx.datamarts if ctx is not None else get_user_datamarts(email)
+    if indexed is not None:
+        allowed = set(indexed)
+        return [table for table in tables if f"{dataset}.{table}" in allowed]
+
+    email = email.lower()
+    datamarts = get_datamarts_for_dataset(dataset)
+    return [
+        table for table in tables
+        if email in {u.lower() for u in datamarts.get(f"{dataset}.{table}", [])}
+    ]
@@ -16,6 +16,8 @@ export default function App() {
   const { user, loading: authLoading, logout } = useAuth();
   const [prompt, setPrompt] = useState("");
   const [messages, setMessages] = useState([]); // { role, content, visualization?, insight?, token_usage?, error? }
+  // Follow-ups in the same conversation reuse the data the backend already loaded
+  const [conversationId, setConversationId] = useState(() => crypto.randomUUID());
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState("");
 
@@ -95,6 +97,7 @@ export default function App() {
     setTableDropdownOpen(false);
     setTableSearch("");
     setMessages([]);
+    setConversationId(crypto.randomUUID());
   };
 
 
@@ -104,6 +107,7 @@ export default function App() {
     setTableDropdownOpen(false);
     setTableSearch("");
     setMessages([]);
+    setConversationId(crypto.randomUUID());
   };
 
 
@@ -130,7 +134,8 @@ export default function App() {
       const response = await generateVisualization(currentPrompt, {
         tableName: selectedTable,
         dataset: selectedCompany,
-        history: history
+        history: history,
+        conversationId
       });
 
       if (response.rejected) {
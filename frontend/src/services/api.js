@@ -38,10 +38,10 @@ async function handleResponse(response) {
 /**
  * Call the /api/visualize endpoint.
  * @param {string} prompt - The user's question
- * @param {Object} options - { tableName, dataset, history } or { data, history }
+ * @param {Object} options - { tableName, dataset, history, conversationId } or { data, history, conversationId }
  * @returns {Promise<Object>} The visualization response
  */
-export async function generateVisualization(prompt, { data, tableName, dataset, history = [] }) {
+export async function generateVisualization(prompt, { data, tableName, dataset, history = [], conversationId }) {
     const body = { prompt };
     if (tableName) {
         body.table_name = tableName;
@@ -52,6 +52,9 @@ export async function generateVisualization(prompt, { data, tableName, dataset,
     if (history && history.length > 0) {
         body.history = history;
     }
+    if (conversationId) {
+        body.conversation_id = conversationId;
+    }
 
     const response = await fetch(`${API_BASE}/api/visualize`, {
 
@@ -63,6 +66,60 @@ export async function generateVisualization(prompt, { data, tableName, dataset,
     return handleResponse(response);
 }
 
+/**
+ * Call the streaming /api/visualize/stream endpoint (Server-Sent Events).
+ * @param {string} prompt - The user's question
+ * @param {Object} options - Same as generateVisualization
+ * @param {Function} onEvent - Called as onEvent(eventName, payload) for each stage:
+ *   data_loaded, tool_call, query_result, chart, token_usage, error, done
+ * @returns {Promise<void>} Resolves when the stream ends
+ */
+export async function streamVisualization(prompt, { data, tableName, dataset, history = [], conversationId }, onEvent) {
+    const body = { prompt };
+    if (tableName) {
+        body.table_name = tableName;
+        body.dataset = dataset;
+    } else {
+        body.data = data;
+    }
+    if (history && history.length > 0) {
+        body.history = history;
+    }
+    if (conversationId) {
+        body.conversation_id = conversationId;
+    }
+
+    const response = await fetch(`${API_BASE}/api/visualize/stream`, {
+        method: "POST",
+        headers: authHeaders({ "Content-Type": "application/json" }),
+        body: JSON.stringify(body),
+    });
+    if (!response.ok) {
+        await handleResponse(response);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Events are separated by a blank line: "event: <name>\ndata: <json>\n\n"
+        let boundary;
+        while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+            const chunk = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            const event = chunk.match(/^event: (.*)$/m);
+            const payload = chunk.match(/^data: (.*)$/m);
+            if (event && payload) {
+                onEvent(event[1], JSON.parse(payload[1]));
+            }
+        }
+    }
+}
+
 /**
  * Fetch available BigQuery tables for a given dataset (company).
  * @param {string} dataset - The dataset/company name